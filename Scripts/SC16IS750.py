@@ -1,5 +1,6 @@
 import sys
 import time
+import threading
 try:
 	import pigpio
 except:pass
@@ -204,25 +205,157 @@ I2C_WRITE   = 0x07 # Write P bytes of data
 PI_WRITE = 20
 PI_READ = 21
 
+# TX engine
+TX_FIFO_SIZE = 64 # bytes
+TX_MIN_WAIT = .0005 # seconds. Shortest wait for FIFO space so we don't spin on the bus
+TX_DEADLINE_MARGIN = .05 # seconds added to the wire time of a frame before a write gives up
+
+# Register shadow
+# Write-only and configuration registers are kept by name since addresses are shared between register sets.
+# The second value is the register set LCR has to select before the register can be reached (None if any set works)
+SET_GENERAL  = 0
+SET_SPECIAL  = 1
+SET_ENHANCED = 2
+LCR_ENHANCED_ACCESS = 0xBF
+SHADOW_REGISTERS = {
+	'LCR': (REG_LCR, None),
+	'MCR': (REG_MCR, SET_GENERAL),
+	'IER': (REG_IER, SET_GENERAL),
+	'FCR': (REG_FCR, SET_GENERAL),
+	'DLL': (REG_DLL, SET_SPECIAL),
+	'DLH': (REG_DLH, SET_SPECIAL),
+	'EFR': (REG_EFR, SET_ENHANCED)
+}
+# Values after a hardware or software reset. The divisor latch is not reset so it is unknown.
+SHADOW_DEFAULTS = {'LCR': 0x1D, 'MCR': 0x00, 'IER': 0x00, 'FCR': 0x00, 'DLL': None, 'DLH': None, 'EFR': 0x00}
+# General register addresses that have a shadow
+SHADOW_GENERAL_NAMES = {REG_LCR: 'LCR', REG_MCR: 'MCR', REG_IER: 'IER', REG_FCR: 'FCR'}
+
+# Instrumentation
+# Upper bounds (seconds) of the latency histogram buckets. Anything slower lands in one last bucket.
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1)
+# Names for general register addresses in the stats
+REGISTER_NAMES = {REG_RHR: 'RHR/THR', REG_IER: 'IER', REG_IIR: 'IIR/FCR', REG_LCR: 'LCR', REG_MCR: 'MCR', REG_LSR: 'LSR',
+				  REG_MSR: 'MSR', REG_SPR: 'SPR', REG_TXLVL: 'TXLVL', REG_RXLVL: 'RXLVL', REG_IOCONTROL: 'IOCONTROL', REG_EFCR: 'EFCR'}
+
+# Counts, bytes and latency histograms of every bus operation by (operation, register), along with
+# pigpio error codes (and TX writes cut short), LSR line errors and the time spent waiting on the wave mirror of TX.
+# busy is the share of wall time spent on the bus: close to 1 means the link is bus bound.
+class BusStats:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.lsrErrors = {'overflow': 0, 'parity': 0, 'framing': 0, 'break': 0, 'fifo': 0}
+		self.reset()
+
+	# Start counting again from zero (lsrErrors is cleared in place since the driver shares it)
+	def reset(self):
+		with self.lock:
+			self.started = time.time()
+			self.ops = {}
+			self.errors = {}
+			self.waveWaits = 0
+			self.waveWaitTime = 0.0
+			for key in self.lsrErrors: self.lsrErrors[key] = 0
+
+	def record(self, op, reg, seconds, size):
+		key = (op, REGISTER_NAMES.get(reg, reg) if isinstance(reg, int) else reg)
+		bucket = 0
+		while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]: bucket += 1
+		with self.lock:
+			entry = self.ops.get(key)
+			if entry is None:
+				entry = self.ops[key] = {'count': 0, 'bytes': 0, 'time': 0.0, 'max': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+			entry['count'] += 1
+			entry['bytes'] += size
+			entry['time'] += seconds
+			if seconds > entry['max']: entry['max'] = seconds
+			entry['histogram'][bucket] += 1
+
+	def record_error(self, op, code):
+		with self.lock:
+			key = (op, code)
+			self.errors[key] = self.errors.get(key, 0) + 1
+
+	def record_wave_wait(self, seconds):
+		with self.lock:
+			self.waveWaits += 1
+			self.waveWaitTime += seconds
+
+	# Return a copy of everything recorded so far that is safe to hand to other threads
+	def snapshot(self):
+		with self.lock:
+			uptime = max(time.time() - self.started, 1e-9)
+			busTime = sum(entry['time'] for entry in self.ops.values())
+			ops = {}
+			for (op, reg), entry in self.ops.items():
+				copy = dict(entry)
+				copy['histogram'] = list(entry['histogram'])
+				copy['mean'] = entry['time'] / entry['count']
+				ops['{} {}'.format(op, reg)] = copy
+			return {
+				'uptime': uptime,
+				'busTime': busTime,
+				'busy': busTime / uptime,
+				'calls': sum(entry['count'] for entry in self.ops.values()),
+				'bytes': sum(entry['bytes'] for entry in self.ops.values()),
+				'ops': ops,
+				'errors': dict(('{} {}'.format(op, code), count) for (op, code), count in self.errors.items()),
+				'lsrErrors': dict(self.lsrErrors),
+				'waveWaits': self.waveWaits,
+				'waveWaitTime': self.waveWaitTime,
+				'buckets': LATENCY_BUCKETS
+			}
+
+	# Human readable report of a snapshot
+	@staticmethod
+	def format(snapshot):
+		lines = ['Bus: {} calls, {} bytes, {:.1f}% busy over {:.0f}s'.format(snapshot['calls'], snapshot['bytes'], 100 * snapshot['busy'], snapshot['uptime'])]
+		for name, entry in sorted(snapshot['ops'].items()):
+			lines.append('  {:<22} n={:<7} bytes={:<8} mean={:.3f}ms max={:.3f}ms hist={}'.format(
+				name, entry['count'], entry['bytes'], 1000 * entry['mean'], 1000 * entry['max'], entry['histogram']))
+		lines.append('  pigpio errors: {}'.format(snapshot['errors'] or 'none'))
+		lines.append('  LSR errors: {}'.format(snapshot['lsrErrors']))
+		lines.append('  wave TX waits: {} ({:.1f}ms total)'.format(snapshot['waveWaits'], 1000 * snapshot['waveWaitTime']))
+		return '\n'.join(lines)
+
 class SC16IS750:
 
 	pi = None
 	i2c = None
+	i2cbus = None
+	i2caddr = None
 	xtalfreq = None
 	baudrate = None
 	databits = None
 	stopbits = None
 	parity = None
+	wave_tx = True
+	waveDone = 0
+	lsrErrors = None
+	stats = None
+	shadow = None
+	pending = None
+	regLock = None
 
-	def __init__(self, pi, i2cbus = 1, i2caddr = 0x48, xtalfreq = 11059200, baudrate = 115200, databits = LCR_DATABITS_8, stopbits = LCR_STOPBITS_1, parity = LCR_PARITY_NONE):
+	def __init__(self, pi, i2cbus = 1, i2caddr = 0x48, xtalfreq = 11059200, baudrate = 115200, databits = LCR_DATABITS_8, stopbits = LCR_STOPBITS_1, parity = LCR_PARITY_NONE, wave_tx = True):
 
 		self.pi = pi
+		self.i2cbus = i2cbus
+		self.i2caddr = i2caddr
 		self.i2c = pi.i2c_open(i2cbus, i2caddr)
 		self.xtalfreq = xtalfreq
 		self.baudrate = baudrate
 		self.databits = databits
 		self.stopbits = stopbits
 		self.parity = parity
+		self.wave_tx = wave_tx
+		self.waveDone = 0
+		self.stats = BusStats()
+		self.lsrErrors = self.stats.lsrErrors
+		self.shadow = dict(SHADOW_DEFAULTS)
+		self.pending = []
+		self.regLock = threading.RLock()
 
 		self.pi.set_mode(PI_WRITE, pigpio.OUTPUT)
 		self.pi.set_mode(PI_READ, pigpio.INPUT)
@@ -240,6 +373,52 @@ class SC16IS750:
 		#("done!")
 		return self.block_read(REG_RHR, num)
 
+	# Drain the RX FIFO until num bytes are collected or timeout seconds pass without completing
+	# Return the bytes collected (short if the sender stalled)
+	def read_frame(self, num, timeout):
+		out = bytearray()
+		deadline = time.time() + timeout
+		while len(out) < num:
+			level = self.byte_read(REG_RXLVL)
+			if level > 0:
+				out += self.drain_level(level, num - len(out))
+			elif time.time() > deadline:
+				break
+		return bytes(out)
+
+	# RX drain for the IRQ path. One zip reads IIR, LSR and RXLVL, then each following zip reads
+	# the waiting payload together with LSR and RXLVL so we know if more arrived while reading.
+	# Loops until the FIFO is empty or limit bytes were read.
+	# Return the bytes drained
+	def drain_rx(self, limit = None):
+		iir, lsr, level = self.get_interrupt_status()
+		self.record_lsr(lsr)
+		return self.drain_level(level, limit)
+
+	# Read level bytes from RHR and keep going while RXLVL reports more (up to limit bytes)
+	def drain_level(self, level, limit = None):
+		out = bytearray()
+		while level > 0:
+			if limit is not None:
+				level = min(level, limit - len(out))
+				if level <= 0: break
+			n, d = self.zip('drain', 'RHR', [I2C_WRITE, 1, self.reg_conv(REG_RHR), I2C_READ, level, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_LSR), I2C_READ, 1, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_RXLVL), I2C_READ, 1, I2C_END], level)
+			if n != level + 2: raise ValueError("all available bytes were not successfully read")
+			out += d[:level]
+			self.record_lsr(int(d[level]))
+			level = int(d[level + 1])
+		return bytes(out)
+
+	# Count line errors reported by LSR
+	def record_lsr(self, lsr):
+		if not lsr & (LSR_OVERFLOW_ERROR | LSR_PARITY_ERROR | LSR_FRAMING_ERROR | LSR_BREAK_INTERRUPT | LSR_FIFO_DATA_ERROR): return
+		with self.stats.lock:
+			if lsr & LSR_OVERFLOW_ERROR: self.lsrErrors['overflow'] += 1
+			if lsr & LSR_PARITY_ERROR:   self.lsrErrors['parity'] += 1
+			if lsr & LSR_FRAMING_ERROR:  self.lsrErrors['framing'] += 1
+			if lsr & LSR_BREAK_INTERRUPT: self.lsrErrors['break'] += 1
+			if lsr & LSR_FIFO_DATA_ERROR: self.lsrErrors['fifo'] += 1
+
 	def readline(self):
 		out = bytearray()
 		char = None
@@ -253,12 +432,43 @@ class SC16IS750:
 		return out
 
 	def write(self, bytestring):
-		self.block_write(REG_THR, bytestring)
-		#self.gpio_write(bytestring)
+		return self.tx_write(bytestring)
+
+	# Bus statistics recorded since the driver was created (see BusStats.snapshot)
+	def snapshot(self):
+		return self.stats.snapshot()
 
 	def close(self):
 		self.pi.i2c_close(self.i2c)
 
+	# Bring the link back after a bus error without restarting anything above the driver.
+	# Reopens the I2C handle, soft resets the chip, clears both FIFOs and writes the configuration
+	# back from the shadow in one transaction.
+	# Return True if IER reads back as it was before the reset. Bus errors are raised to the caller.
+	def recover(self):
+		with self.regLock:
+			saved = dict(self.shadow)
+			try: self.pi.i2c_close(self.i2c)
+			except Exception: pass
+			self.i2c = self.pi.i2c_open(self.i2cbus, self.i2caddr)
+			self.reset()
+			self.restore_registers(saved)
+			self.waveDone = 0
+			return self.commit('IER')
+
+	# Queue every known register value from shadow (EFR first since it unlocks the enhanced bits)
+	# along with a reset of both FIFOs. Call commit to send.
+	def restore_registers(self, shadow):
+		if shadow['EFR']: self.queue_register('EFR', shadow['EFR'])
+		if shadow['DLH'] is not None and shadow['DLL'] is not None:
+			self.queue_register('DLH', shadow['DLH'])
+			self.queue_register('DLL', shadow['DLL'])
+		self.queue_register('LCR', shadow['LCR'])
+		self.queue_register('FCR', FCR_TX_FIFO_RESET | FCR_RX_FIFO_RESET)
+		self.queue_register('FCR', shadow['FCR'])
+		self.queue_register('MCR', shadow['MCR'])
+		self.queue_register('IER', shadow['IER'])
+
 	def print_register(self, reg, prefix):
 		print("%s 0x%02X" % (prefix, self.byte_read(reg)))
 
@@ -280,12 +490,11 @@ class SC16IS750:
 		self.print_register(REG_EFCR,      "0x0F REG_EFCR:     ")
 
 	# Initialize UART settings
+	# Divisor latch and line settings go out in one transaction, LCR is read back at the end as a check
 	def init_uart(self):
-		s1, v1 = self.byte_write_verify(REG_LCR, LCR_DIVISOR_ENABLE)
-		s2, v2 = self.set_divisor_latch(MCR_PRESCALER_1)
-		lcr = self.databits | self.stopbits | self.parity
-		s3, v3 = self.byte_write_verify(REG_LCR, lcr)
-		if not (s1 and s2 and s3):
+		self.set_divisor_latch(MCR_PRESCALER_1)
+		self.queue_register('LCR', self.databits | self.stopbits | self.parity)
+		if not self.commit('LCR'):
 			#print("Error setting up UART port!")
 			sys.exit(1)
 
@@ -293,6 +502,9 @@ class SC16IS750:
 	def reset(self):
 		try: self.byte_write(REG_IOCONTROL, IOCONTROL_SOFTWARE_RESET)
 		except pigpio.error: pass
+		with self.regLock:
+			self.shadow = dict(SHADOW_DEFAULTS)
+			self.pending = []
 
 	# Write some test patterns to the scratchpad and verify receipt
 	def scratchpad_test(self):
@@ -301,34 +513,109 @@ class SC16IS750:
 		t3b, t3v = self.byte_write_verify(REG_SPR, 0x00)
 		return t1b and t2b and t3b
 
-	# Compute required divider values for DLH and DLL registers
-	# Return tuple indicating (boolean success, new values in registers)
+	# Compute required divider values for DLH and DLL registers and queue them (call commit to send)
+	# Return the divisor
 	def set_divisor_latch(self, prescaler = MCR_PRESCALER_1):
 		prescaler = 4 if prescaler == MCR_PRESCALER_4 else 1
 		div = round(self.xtalfreq/(prescaler*self.baudrate*16))
 		dlh, dll = divmod(div, 0x100)
-		dlhb, dlhv = self.byte_write_verify(REG_DLH, dlh)
-		dllb, dllv = self.byte_write_verify(REG_DLL, dll)
-		return (dlhb and dllb, (dlhv<<8)|dllv)
+		self.queue_register('DLH', dlh)
+		self.queue_register('DLL', dll)
+		return div
+
+	# LCR value that has to be selected to reach regset, or None if the current LCR already reaches it
+	def select_register_set(self, regset, lcr):
+		if regset == SET_GENERAL and lcr & LCR_DIVISOR_ENABLE and lcr != LCR_ENHANCED_ACCESS:
+			return lcr & ~LCR_DIVISOR_ENABLE
+		if regset == SET_GENERAL and lcr == LCR_ENHANCED_ACCESS:
+			return self.databits | self.stopbits | self.parity
+		if regset == SET_SPECIAL and (not lcr & LCR_DIVISOR_ENABLE or lcr == LCR_ENHANCED_ACCESS):
+			return LCR_DIVISOR_ENABLE | (self.databits | self.stopbits | self.parity if lcr == LCR_ENHANCED_ACCESS else lcr)
+		if regset == SET_ENHANCED and lcr != LCR_ENHANCED_ACCESS:
+			return LCR_ENHANCED_ACCESS
+		return None
+
+	# Queue a write to a shadowed register by name and update the shadow.
+	# LCR is switched to the register set the register lives in and put back afterwards.
+	def queue_register(self, name, value):
+		reg, regset = SHADOW_REGISTERS[name]
+		with self.regLock:
+			lcr = self.shadow['LCR']
+			select = self.select_register_set(regset, lcr)
+			if select is not None: self.queue_raw(REG_LCR, select)
+			self.queue_raw(reg, value)
+			if select is not None: self.queue_raw(REG_LCR, lcr)
+			# FIFO resets clear themselves so they are not part of the FCR state
+			if name == 'FCR': value &= ~(FCR_TX_FIFO_RESET | FCR_RX_FIFO_RESET)
+			self.shadow[name] = value
+
+	# Queue a raw register write. Back to back LCR writes collapse into the last one and
+	# an LCR write that would not change the value is dropped.
+	def queue_raw(self, reg, byte):
+		with self.regLock:
+			if reg == REG_LCR:
+				if self.pending and self.pending[-1][0] == REG_LCR: self.pending.pop()
+				lcr = self.shadow['LCR']
+				for r, b in reversed(self.pending):
+					if r == REG_LCR:
+						lcr = b
+						break
+				if lcr == byte: return
+			self.pending.append((reg, byte))
+
+	# Send every queued register write in a single i2c_zip call.
+	# readback names a shadowed register in the general set to read back at the end of the same call.
+	# Return True if nothing was read back or the value read matches the shadow
+	def commit(self, readback = None):
+		with self.regLock:
+			if not self.pending and readback is None: return True
+			cmd = bytearray()
+			for reg, byte in self.pending:
+				cmd += bytes((I2C_WRITE, 2, self.reg_conv(reg), byte))
+			count = len(self.pending)
+			self.pending = []
+			if readback is not None:
+				cmd += bytes((I2C_WRITE, 1, self.reg_conv(SHADOW_REGISTERS[readback][0]), I2C_READ, 1))
+			cmd.append(I2C_END)
+			n, d = self.zip('config', 'batch', cmd, count)
+			if readback is None: return True
+			elif n != 1: raise ValueError("unexpected number of bytes received")
+			return int(d[0]) == self.shadow[readback]
+
+	# Write a shadowed register right away
+	def write_register(self, name, value):
+		with self.regLock:
+			self.queue_register(name, value)
+			self.commit()
 
 	# Retreive interrupt status (IIR[5:0])
 	def get_interrupt_status(self):
 		# Read IIR, LSR, and RXLVL registers
-		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 1, self.reg_conv(REG_IIR), I2C_READ, 1, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_LSR), I2C_READ, 1, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_RXLVL), I2C_READ, 1, I2C_END])
-		if n < 0: raise pigpio.error(pigpio.error_text(n))
-		elif n != 3: raise ValueError("unexpected number of bytes received")
+		n, d = self.zip('status', 'IIR', [I2C_WRITE, 1, self.reg_conv(REG_IIR), I2C_READ, 1, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_LSR), I2C_READ, 1, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_RXLVL), I2C_READ, 1, I2C_END], 3)
+		if n != 3: raise ValueError("unexpected number of bytes received")
 		# Mask out two MSBs in IIR value and return tuple
 		return (int(d[0]) & 0x3F, int(d[1]), int(d[2]))
 
-	# Change single bit inside register
+	# Enable FIFOs and set the RX FIFO trigger level (FCR is write only)
+	def set_rx_trigger(self, trigger):
+		self.write_register('FCR', FCR_FIFO_ENABLE | trigger)
+
+	# Change single bit inside register (a general register address or a shadow name)
+	# Shadowed registers are served from the shadow so only the write goes over the bus
+	# Return tuple indicating (boolean success, new value in register)
 	def enable_register_bit(self, reg, bit, enable):
 		if bit < 0 or bit > 7: return False
 		if enable not in [True, False]: return False
 
-		oldvalue = self.byte_read(reg)
-		if enable: newvalue = oldvalue |  (0x01 << bit)
-		else:      newvalue = oldvalue & ~(0x01 << bit)
-		return self.byte_write_verify(REG_LCR, newvalue)
+		name = reg if reg in SHADOW_REGISTERS else SHADOW_GENERAL_NAMES.get(reg)
+		with self.regLock:
+			if name is None: oldvalue = self.byte_read(reg)
+			else:            oldvalue = self.shadow[name] or 0
+			if enable: newvalue = oldvalue |  (0x01 << bit)
+			else:      newvalue = oldvalue & ~(0x01 << bit)
+			if name is None: return self.byte_write_verify(reg, newvalue)
+			self.write_register(name, newvalue)
+			return (True, newvalue)
 
 	# MCR[4]: True for local loopback enable, False for disable
 	def enable_local_loopback(self, enable):
@@ -342,53 +629,119 @@ class SC16IS750:
 	# Return tuple indicating (boolean success, new value in register)
 	def byte_write_verify(self, reg, byte):
 
-		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 2, self.reg_conv(reg), byte, I2C_READ, 1, I2C_END])
-		if n < 0: raise pigpio.error(pigpio.error_text(n))
-		elif n != 1: raise ValueError("unexpected number of bytes received")
+		n, d = self.zip('write_verify', reg, [I2C_WRITE, 2, self.reg_conv(reg), byte, I2C_READ, 1, I2C_END], 2)
+		if n != 1: raise ValueError("unexpected number of bytes received")
 		d = int(d[0])
 		return (d == byte, d)
 
 	# Write I2C byte to specified register
+	# Bytes for the THR go through the TX engine so they respect the TX FIFO
 	def byte_write(self, reg, byte):
-		print("Byte Writing", byte)
+		if reg == REG_THR:
+			self.tx_write(bytes([byte]) if isinstance(byte, int) else byte)
+			return
+		self.zip('byte_write', reg, [I2C_WRITE, 2, self.reg_conv(reg), byte, I2C_END], 1)
 
-		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 2, self.reg_conv(reg), byte, I2C_END])
+	# Read I2C byte from specified register
+	# Return byte received from driver
+	def byte_read(self, reg):
+		start = time.time()
+		try:
+			byte = self.pi.i2c_read_byte_data(self.i2c, self.reg_conv(reg))
+		except Exception as e:
+			self.stats.record_error('byte_read', e.args[0] if e.args else e)
+			raise
+		self.stats.record('byte_read', reg, time.time() - start, 1)
+		return byte
+
+	# Run an i2c_zip command list and record how long it held the bus under op and reg
+	# Return (count, data) from pigpio. Raise pigpio.error on a negative count
+	def zip(self, op, reg, cmd, size):
+		start = time.time()
+		n, d = self.pi.i2c_zip(self.i2c, cmd)
+		self.stats.record(op, reg, time.time() - start, size)
+		if n < 0:
+			self.stats.record_error(op, n)
+			raise pigpio.error(pigpio.error_text(n))
+		return n, d
 
-		if isinstance(byte, int):
-			byte = bytes([byte])
-		
+	# Write I2C block to specified register
+	# Blocks for the THR go through the TX engine so they respect the TX FIFO
+	def block_write(self, reg, bytestring):
+		if reg == REG_THR:
+			self.tx_write(bytestring)
+			return
+		self.zip('block_write', reg, self.zip_write(reg, memoryview(bytestring)) + bytes([I2C_END]), len(bytestring))
+
+	# Build the i2c_zip commands that write a block (memoryview or bytes) to a register
+	def zip_write(self, reg, block):
+		cmd = bytearray((I2C_WRITE, len(block) + 1, self.reg_conv(reg)))
+		cmd += block
+		return cmd
+
+	# Number of bits on the wire for each UART character
+	def bits_per_byte(self):
+		bits = 1 + 5 + (self.databits & 0x03) # Start bit + data bits
+		bits += 2 if self.stopbits == LCR_STOPBITS_2 else 1
+		bits += 0 if self.parity == LCR_PARITY_NONE else 1
+		return bits
+
+	# Seconds it takes the UART to shift out num bytes
+	def tx_time(self, num):
+		return num * self.bits_per_byte() / self.baudrate
+
+	# Wait for the TX FIFO to make room for num bytes: the time the UART takes to shift them out, cut to the deadline.
+	# Only this wait is used. The TX ready interrupt stays off (see initWTCConnection) since while it is pending the
+	# IRQ line stays low, and a WTC byte arriving while the callback is disabled would raise no edge.
+	# Return False if the deadline passed
+	def wait_tx_space(self, num, deadline):
+		remaining = deadline - time.time()
+		if remaining <= 0: return False
+		time.sleep(min(remaining, max(self.tx_time(num), TX_MIN_WAIT)))
+		return True
+
+	# FIFO-aware TX engine. Writes bytestring to the THR in blocks sized to the free TX FIFO space.
+	# Data is sliced from a memoryview so nothing is copied into lists.
+	# Return the number of bytes handed to the chip
+	# Raise ValueError if the timeout passed before all of them were, so the caller can recover the link
+	def tx_write(self, bytestring, timeout = None):
+		data = memoryview(bytestring)
+		total = len(data)
+		if timeout is None: timeout = self.tx_time(total) + TX_DEADLINE_MARGIN
+		deadline = time.time() + timeout
+		if self.wave_tx: self.wave_write(bytestring, deadline)
+		offset = 0
+		while offset < total:
+			space = self.byte_read(REG_TXLVL)
+			if space <= 0:
+				if not self.wait_tx_space(min(total - offset, TX_FIFO_SIZE), deadline): break
+				continue
+			block = data[offset:offset + space]
+			self.zip('tx', 'THR', self.zip_write(REG_THR, block) + bytes([I2C_END]), len(block))
+			offset += len(block)
+		if offset < total:
+			self.stats.record_error('tx', 'short')
+			raise ValueError("TX FIFO took {} of {} bytes before the deadline".format(offset, total))
+		return offset
+
+	# Mirror a TX block onto the PI_WRITE pin as a serial waveform without blocking on it.
+	# Only waits (until the deadline) for the previous waveform to finish, since clearing aborts it.
+	def wave_write(self, bytestring, deadline):
 		try:
+			start = time.time()
+			delay = self.waveDone - start
+			if delay > 0: time.sleep(min(delay, max(0, deadline - time.time())))
+			while self.pi.wave_tx_busy() and time.time() < deadline:
+				time.sleep(self.tx_time(1))
+			self.stats.record_wave_wait(time.time() - start)
 			self.pi.wave_clear()
-			self.pi.wave_add_serial(PI_WRITE, 115200, byte)
-			print("added wave")
+			self.pi.wave_add_serial(PI_WRITE, self.baudrate, bytes(bytestring))
 			wid = self.pi.wave_create()
-			cbs = self.pi.wave_send_once(wid)
-
-			while self.pi.wave_tx_busy():
-				print("waveform tx busy ", self.pi.wave_tx_at(), " ", self.pi.wave_get_cbs())
-				time.sleep(.1)
+			self.pi.wave_send_once(wid)
+			self.waveDone = time.time() + self.tx_time(len(bytestring))
 		except Exception as e:
 			print(e)
 
-	# Read I2C byte from specified register
-	# Return byte received from driver
-	def byte_read(self, reg):
-		return self.pi.i2c_read_byte_data(self.i2c, self.reg_conv(reg))
-
-	# Write I2C block to specified register
-	def block_write(self, reg, bytestring):
-		print(bytestring)
-		self.pi.wave_clear()
-		self.pi.wave_add_serial(PI_WRITE, 115200, bytestring)
-		wid = self.pi.wave_create()
-		cbs = self.pi.wave_send_once(wid)
-		while self.pi.wave_tx_busy():
-			print("waveform tx busy ", self.pi.wave_tx_at(), " ", self.pi.wave_get_cbs())
-			time.sleep(.1)
-
-		
-		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, len(bytestring)+1, self.reg_conv(reg)] + list(bytestring) + [I2C_END])
-		if n < 0: raise pigpio.error(pigpio.error_text(n))
 	"""
 	# Writes bytestring to the GPIO output pin
 	def gpio_write(self, bytestring):
@@ -401,9 +754,8 @@ class SC16IS750:
 	# Read I2C block from specified register
 	# Return block received from driver
 	def block_read(self, reg, num):
-		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 1, self.reg_conv(reg), I2C_READ, num, I2C_END])
-		if n < 0: raise pigpio.error(pigpio.error_text(n))
-		elif n != num: raise ValueError("all available bytes were not successfully read")
+		n, d = self.zip('block_read', reg, [I2C_WRITE, 1, self.reg_conv(reg), I2C_READ, num, I2C_END], num)
+		if n != num: raise ValueError("all available bytes were not successfully read")
 		return d
 	
 	# Convert register address given in datasheet to actual address on chip
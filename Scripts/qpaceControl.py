@@ -34,6 +34,9 @@ QPCONTROL = {
 	"CHUNK1":         0x61, # Response for the WTC Sending chunk 1
 	"CHUNK2":         0x62, # Response for the WTC Sending chunk 2
 	"CHUNK3":         0x63, # Response for the WTC Sending chunk 3
-	"CHUNK4":         0x64  # Response for the WTC Sending chunk 4
+	"CHUNK4":         0x64, # Response for the WTC Sending chunk 4. Also the packet acknowledgement in bulk RX mode.
+
+	"BULKRX":         0x65, # WTC request to upload whole packets without chunk handshakes. Pi echoes it to accept.
+	"CHUNKRX":        0x66  # WTC request to go back to the 4 chunk upload handshake. Pi echoes it to accept.
 
 }
\ No newline at end of file
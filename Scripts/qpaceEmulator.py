@@ -0,0 +1,1100 @@
+#!/usr/bin/env python3
+# qpaceEmulator.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# In-process emulation of the SC16IS740 and the WTC so the whole Pi stack can be run and measured on a
+# plain Linux box. VirtualPi stands in for pigpio.pi(), VirtualSC16IS750 models the chip registers, FIFOs,
+# baud rate and IRQ line, and VirtualWTC is a scriptable peer on the other end of the UART.
+#
+# Usage: python3 qpaceEmulator.py [scenario] [sandbox directory]
+
+import sys
+import os
+import time
+import types
+import random
+import threading
+import tempfile
+import zlib
+from collections import deque
+
+import qpaceControl
+
+qpStates = qpaceControl.QPCONTROL
+
+# pigpio values the Pi code relies on. Only used if the real pigpio is not installed.
+PI_INPUT = 0
+PI_OUTPUT = 1
+PI_RISING_EDGE = 0
+PI_FALLING_EDGE = 1
+PI_EITHER_EDGE = 2
+PI_BAD_HANDLE = -25
+PI_I2C_WRITE_FAILED = -82
+
+# pigpio i2c_zip commands
+ZIP_END     = 0x00
+ZIP_ESCAPE  = 0x01
+ZIP_START   = 0x02
+ZIP_STOP    = 0x03
+ZIP_ADDRESS = 0x04
+ZIP_FLAGS   = 0x05
+ZIP_READ    = 0x06
+ZIP_WRITE   = 0x07
+
+# Register addresses as the chip sees them (datasheet address, not shifted)
+RHR = THR = DLL = 0x00
+IER = DLH = 0x01
+IIR = FCR = EFR = 0x02
+LCR = 0x03
+MCR = 0x04
+LSR = 0x05
+MSR = 0x06
+SPR = 0x07
+TXLVL = 0x08
+RXLVL = 0x09
+IOCONTROL = 0x0E
+
+FIFO_SIZE = 64
+RX_TRIGGERS = (8, 16, 56, 60) # FCR[7:6]
+TX_TRIGGERS = (8, 16, 32, 56) # FCR[5:4], spaces available
+RX_TIMEOUT_CHARS = 4 # Character times without RX activity before the RX timeout interrupt
+
+CCDR_IRQ = 16 # GPIO the chip IRQ line is wired to
+
+DEFAULT_I2C_CLOCK = 400000 # Hz. Fast mode, the fastest the SC16IS740 supports. At 100 kHz the bus is slower than 115200 baud.
+DEFAULT_CALL_LATENCY = .0002 # seconds per pigpio call (socket round trip to the daemon)
+DEFAULT_XTAL = 1843200
+
+class VirtualError(Exception):
+	"""Raised in place of pigpio.error when the real pigpio is not installed."""
+	pass
+
+def errorText(errnum):
+	return 'virtual pigpio error {}'.format(errnum)
+
+def installPigpio():
+	"""
+	Make sure "import pigpio" works. If the real pigpio is installed it is used for its constants and
+	exceptions. Otherwise a module with the few names the Pi code uses is registered in its place.
+	Must be called before any of the qpace modules are imported.
+
+	Parameters: None
+
+	Returns: the pigpio module
+
+	Raises: None
+	"""
+	try:
+		import pigpio
+		return pigpio
+	except ImportError:
+		module = types.ModuleType('pigpio')
+		module.INPUT = PI_INPUT
+		module.OUTPUT = PI_OUTPUT
+		module.RISING_EDGE = PI_RISING_EDGE
+		module.FALLING_EDGE = PI_FALLING_EDGE
+		module.EITHER_EDGE = PI_EITHER_EDGE
+		module.error = VirtualError
+		module.error_text = errorText
+		module.pi = lambda *args, **kwargs: VirtualPi.default()
+		sys.modules['pigpio'] = module
+		return module
+
+class VirtualSC16IS750():
+	"""
+	Register level model of the SC16IS740/750.
+
+	The UART side runs on its own thread at the baud rate set by DLL/DLH, the prescaler in MCR and the
+	character format in LCR. TX FIFO bytes go to the peer (or back into RX in local loopback) one character
+	time apart and bytes from the peer fill the RX FIFO the same way, overflowing once it holds 64 bytes.
+	The IRQ line follows IER and the FIFO trigger levels, including the RX timeout interrupt.
+
+	Attributes:
+		peer - object with a receive(byte) method that gets every byte shifted out of TX
+		irqListener - called with the new IRQ level (0 = asserted) whenever it changes
+		overruns - bytes written to a full TX FIFO
+		rxOverflows - bytes lost because the RX FIFO was full
+	"""
+	def __init__(self, xtalfreq = DEFAULT_XTAL):
+		self.xtalfreq = xtalfreq
+		self.peer = None
+		self.irqListener = None
+		self.overruns = 0
+		self.rxOverflows = 0
+		self.cond = threading.Condition()
+		self.txFifo = deque()
+		self.rxFifo = deque()
+		self.wireIn = deque()
+		self.running = True
+		self.resetRegisters()
+		self.lineThread = threading.Thread(name = 'virtualSC16IS750', target = self._line)
+		self.lineThread.daemon = True
+		self.lineThread.start()
+
+	def resetRegisters(self):
+		"""Put every register and FIFO in the state the datasheet gives after a reset."""
+		self.regs = {'IER': 0x00, 'FCR': 0x00, 'LCR': 0x1D, 'MCR': 0x00, 'SPR': 0xFF, 'EFR': 0x00,
+					 'DLL': 0x01, 'DLH': 0x00, 'TCR': 0x00, 'TLR': 0x00, 'IOCONTROL': 0x00, 'EFCR': 0x00}
+		self.txFifo.clear()
+		self.rxFifo.clear()
+		self.lsrErrors = 0
+		self.txReadyPending = False
+		self.txNext = None
+		self.rxNext = None
+		self.lastRxActivity = time.monotonic()
+		self.irqLevel = 1
+
+	def stop(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+
+	# Timing
+
+	def charTime(self):
+		"""Seconds it takes to shift one character at the configured baud rate."""
+		lcr = self.regs['LCR']
+		bits = 1 + 5 + (lcr & 0x03) + (2 if lcr & 0x04 else 1) + (1 if lcr & 0x08 else 0)
+		return bits / self.baudrate()
+
+	def baudrate(self):
+		divisor = (self.regs['DLH'] << 8 | self.regs['DLL']) or 1
+		prescaler = 4 if self.regs['MCR'] & 0x80 else 1
+		return self.xtalfreq / (prescaler * 16 * divisor)
+
+	# Register access (caller holds self.cond)
+
+	def _registerSet(self):
+		lcr = self.regs['LCR']
+		if lcr == 0xBF: return 'enhanced'
+		if lcr & 0x80: return 'special'
+		return 'general'
+
+	def writeRegister(self, reg, byte):
+		regset = self._registerSet()
+		if reg == THR and regset == 'special': self.regs['DLL'] = byte
+		elif reg == THR:
+			if len(self.txFifo) >= FIFO_SIZE:
+				self.overruns += 1
+			else:
+				if not self.txFifo and self.txNext is None:
+					self.txNext = time.monotonic() + self.charTime()
+				self.txFifo.append(byte)
+			self.txReadyPending = False
+		elif reg == IER and regset == 'special': self.regs['DLH'] = byte
+		elif reg == IER: self.regs['IER'] = byte
+		elif reg == FCR and regset == 'enhanced': self.regs['EFR'] = byte
+		elif reg == FCR:
+			if byte & 0x02:
+				self.rxFifo.clear()
+				self.rxNext = None if not self.wireIn else self.rxNext
+			if byte & 0x04:
+				self.txFifo.clear()
+				self.txNext = None
+			self.regs['FCR'] = byte & ~0x06
+		elif reg == LCR: self.regs['LCR'] = byte
+		elif reg == MCR and regset != 'enhanced': self.regs['MCR'] = byte
+		elif reg == MSR and regset != 'enhanced': self.regs['TCR'] = byte
+		elif reg == SPR and regset != 'enhanced': self.regs['SPR'] = byte
+		elif reg == IOCONTROL:
+			if byte & 0x08:
+				self.resetRegisters()
+				self.wireIn.clear()
+			else:
+				self.regs['IOCONTROL'] = byte
+		elif reg == 0x0F: self.regs['EFCR'] = byte
+		self.cond.notify_all()
+
+	def readRegister(self, reg):
+		regset = self._registerSet()
+		if reg == RHR and regset == 'special': return self.regs['DLL']
+		if reg == RHR:
+			self.lastRxActivity = time.monotonic()
+			return self.rxFifo.popleft() if self.rxFifo else 0x00
+		if reg == IER: return self.regs['DLH'] if regset == 'special' else self.regs['IER']
+		if reg == IIR:
+			if regset == 'enhanced': return self.regs['EFR']
+			iir = self.interruptId()
+			if iir == 0x02: self.txReadyPending = False
+			return iir | (0xC0 if self.regs['FCR'] & 0x01 else 0x00)
+		if reg == LCR: return self.regs['LCR']
+		if reg == MCR: return self.regs['MCR']
+		if reg == LSR:
+			lsr = self.lsrErrors
+			self.lsrErrors = 0
+			if self.rxFifo: lsr |= 0x01
+			if not self.txFifo: lsr |= 0x20
+			if not self.txFifo and self.txNext is None: lsr |= 0x40
+			return lsr
+		if reg == MSR: return self.regs['TCR'] if self.regs['MCR'] & 0x04 else 0x00
+		if reg == SPR: return self.regs['SPR']
+		if reg == TXLVL: return FIFO_SIZE - len(self.txFifo)
+		if reg == RXLVL: return len(self.rxFifo)
+		if reg == IOCONTROL: return self.regs['IOCONTROL']
+		if reg == 0x0F: return self.regs['EFCR']
+		return 0x00
+
+	def interruptId(self, now = None):
+		"""Highest priority pending interrupt as IIR[5:0], 0x01 if nothing is pending."""
+		ier = self.regs['IER']
+		if ier & 0x04 and self.lsrErrors: return 0x06
+		if ier & 0x01 and self.rxFifo:
+			if len(self.rxFifo) >= RX_TRIGGERS[self.regs['FCR'] >> 6 & 0x03]: return 0x04
+			now = now or time.monotonic()
+			if now - self.lastRxActivity >= RX_TIMEOUT_CHARS * self.charTime(): return 0x0C
+		if ier & 0x02 and self.txReadyPending: return 0x02
+		return 0x01
+
+	# UART side
+
+	def wireReceive(self, data):
+		"""Bytes the peer puts on the line towards the chip. They land in RX one character time apart."""
+		with self.cond:
+			if not self.wireIn and self.rxNext is None:
+				self.rxNext = time.monotonic() + self.charTime()
+			self.wireIn.extend(data)
+			self.cond.notify_all()
+
+	def _line(self):
+		while True:
+			delivered = bytearray()
+			looped = bytearray()
+			with self.cond:
+				if not self.running: return
+				now = time.monotonic()
+				char = self.charTime()
+				txSpaceBefore = FIFO_SIZE - len(self.txFifo)
+				while self.txNext is not None and now >= self.txNext and self.txFifo:
+					byte = self.txFifo.popleft()
+					if self.regs['MCR'] & 0x10: looped.append(byte)
+					else: delivered.append(byte)
+					self.txNext = self.txNext + char if self.txFifo else None
+				if self.txNext is not None and not self.txFifo: self.txNext = None
+				trigger = TX_TRIGGERS[self.regs['FCR'] >> 4 & 0x03]
+				if txSpaceBefore < trigger <= FIFO_SIZE - len(self.txFifo): self.txReadyPending = True
+				if looped:
+					if not self.wireIn and self.rxNext is None: self.rxNext = now
+					self.wireIn.extend(looped)
+				while self.rxNext is not None and now >= self.rxNext and self.wireIn:
+					byte = self.wireIn.popleft()
+					if len(self.rxFifo) >= FIFO_SIZE:
+						self.rxOverflows += 1
+						self.lsrErrors |= 0x02
+					else:
+						self.rxFifo.append(byte)
+					self.lastRxActivity = self.rxNext
+					self.rxNext = self.rxNext + char if self.wireIn else None
+				self._updateIrq(now)
+				# Sleep until the next character boundary or the RX timeout, whichever is first
+				wake = [t for t in (self.txNext, self.rxNext) if t is not None]
+				rxTimeout = self.lastRxActivity + RX_TIMEOUT_CHARS * char
+				if self.rxFifo and rxTimeout > now: wake.append(rxTimeout)
+				timeout = max(min(wake) - now, 0) if wake else None
+				if not delivered: self.cond.wait(timeout)
+			if delivered and self.peer is not None:
+				for byte in delivered: self.peer.receive(byte)
+
+	def _updateIrq(self, now = None):
+		level = 0 if self.interruptId(now) != 0x01 else 1
+		if level != self.irqLevel:
+			self.irqLevel = level
+			if self.irqListener is not None: self.irqListener(level)
+
+class _VirtualCallback():
+	"""What VirtualPi.callback hands back. Mirrors pigpio's _callback."""
+	def __init__(self, pi, gpio, edge, func):
+		self.pi = pi
+		self.gpio = gpio
+		self.edge = edge
+		self.func = func
+	def cancel(self):
+		self.pi._cancel(self)
+
+class VirtualPi():
+	"""
+	Stand-in for pigpio.pi() backed by a VirtualSC16IS750.
+
+	Each I2C call costs callLatency plus the time the transfer takes at i2cClock, and the bus is held for
+	that long so concurrent callers queue up as they would on the real bus. GPIO callbacks run one at a time
+	on their own thread like pigpio's.
+	"""
+	_default = None
+
+	@staticmethod
+	def default():
+		if VirtualPi._default is None:
+			VirtualPi._default = VirtualPi()
+		return VirtualPi._default
+
+	def __init__(self, chip = None, i2cClock = DEFAULT_I2C_CLOCK, callLatency = DEFAULT_CALL_LATENCY, irqGpio = CCDR_IRQ):
+		self.chip = chip or VirtualSC16IS750()
+		self.chip.irqListener = self._irqChanged
+		self.i2cClock = i2cClock
+		self.callLatency = callLatency
+		self.irqGpio = irqGpio
+		self.connected = True
+		self.busLock = threading.Lock()
+		self.handles = set()
+		self.nextHandle = 0
+		self.callbacks = []
+		self.events = deque()
+		self.eventCond = threading.Condition()
+		self.i2cCalls = 0
+		self.i2cBusy = 0.0
+		self.faults = 0
+		self.dispatcher = threading.Thread(name = 'virtualPigpioCallbacks', target = self._dispatch)
+		self.dispatcher.daemon = True
+		self.dispatcher.start()
+
+	# I2C
+
+	def failCalls(self, count):
+		"""Make the next count I2C calls fail like a NACK or a bus glitch would."""
+		self.faults = count
+
+	def i2c_open(self, i2c_bus, i2c_address, i2c_flags = 0):
+		self.nextHandle += 1
+		self.handles.add(self.nextHandle)
+		return self.nextHandle
+
+	def i2c_close(self, handle):
+		self.handles.discard(handle)
+		return 0
+
+	def _transfer(self, handle, ops):
+		"""
+		Run a list of ('w', bytes) and ('r', count) segments against the chip.
+
+		Returns: (count, bytearray) like i2c_zip
+
+		Raises: pigpio.error if the handle is not open
+		"""
+		if self.faults > 0:
+			self.faults -= 1
+			raise sys.modules['pigpio'].error(errorText(PI_I2C_WRITE_FAILED))
+		if handle not in self.handles:
+			raise sys.modules['pigpio'].error(errorText(PI_BAD_HANDLE))
+		bits = 0
+		out = bytearray()
+		with self.busLock:
+			with self.chip.cond:
+				pointer = 0
+				for kind, value in ops:
+					if kind == 'w':
+						pointer = value[0] >> 3 & 0x0F
+						for byte in value[1:]: self.chip.writeRegister(pointer, byte)
+						bits += 20 + 9 * len(value) # start, address, stop plus one ack per byte
+					else:
+						for _ in range(value): out.append(self.chip.readRegister(pointer))
+						bits += 20 + 9 * value
+				self.chip._updateIrq()
+			busy = self.callLatency + bits / self.i2cClock
+			self.i2cCalls += 1
+			self.i2cBusy += busy
+			time.sleep(busy)
+		return len(out), out
+
+	def i2c_zip(self, handle, data):
+		ops = []
+		data = bytes(data)
+		i = 0
+		while i < len(data) and data[i] != ZIP_END:
+			command = data[i]
+			if command == ZIP_ESCAPE:
+				i += 1
+				continue
+			if command in (ZIP_START, ZIP_STOP):
+				i += 1
+			elif command == ZIP_ADDRESS:
+				i += 2
+			elif command == ZIP_FLAGS:
+				i += 3
+			elif command == ZIP_READ:
+				ops.append(('r', data[i + 1]))
+				i += 2
+			elif command == ZIP_WRITE:
+				count = data[i + 1]
+				ops.append(('w', data[i + 2:i + 2 + count]))
+				i += 2 + count
+			else:
+				return PI_I2C_WRITE_FAILED, bytearray()
+		try:
+			return self._transfer(handle, ops)
+		except sys.modules['pigpio'].error:
+			return PI_I2C_WRITE_FAILED, bytearray()
+
+	def i2c_read_byte_data(self, handle, reg):
+		count, data = self._transfer(handle, [('w', bytes([reg])), ('r', 1)])
+		return data[0]
+
+	def i2c_write_byte_data(self, handle, reg, byte_val):
+		self._transfer(handle, [('w', bytes([reg, byte_val]))])
+		return 0
+
+	def i2c_read_i2c_block_data(self, handle, reg, count):
+		return self._transfer(handle, [('w', bytes([reg])), ('r', count)])
+
+	def i2c_write_i2c_block_data(self, handle, reg, data):
+		self._transfer(handle, [('w', bytes([reg]) + bytes(data))])
+		return 0
+
+	# GPIO
+
+	def set_mode(self, gpio, mode): return 0
+	def write(self, gpio, level): return 0
+	def read(self, gpio):
+		return self.chip.irqLevel if gpio == self.irqGpio else 0
+
+	def callback(self, user_gpio, edge = PI_RISING_EDGE, func = None):
+		cb = _VirtualCallback(self, user_gpio, edge, func)
+		with self.eventCond:
+			self.callbacks.append(cb)
+		return cb
+
+	def _cancel(self, cb):
+		with self.eventCond:
+			if cb in self.callbacks: self.callbacks.remove(cb)
+
+	def _irqChanged(self, level):
+		with self.eventCond:
+			self.events.append((self.irqGpio, level, int(time.monotonic() * 1000000) & 0xFFFFFFFF))
+			self.eventCond.notify()
+
+	def _dispatch(self):
+		while True:
+			with self.eventCond:
+				while not self.events and self.connected: self.eventCond.wait()
+				if not self.connected: return
+				gpio, level, tick = self.events.popleft()
+				callbacks = [cb for cb in self.callbacks if cb.gpio == gpio and
+							 (cb.edge == PI_EITHER_EDGE or (cb.edge == PI_FALLING_EDGE) == (level == 0))]
+			for cb in callbacks:
+				try:
+					if cb.func: cb.func(gpio, level, tick)
+				except Exception as e:
+					print('VirtualPi: callback raised {}'.format(e))
+
+	# Waves. The bit-banged mirror of the TX line goes nowhere here.
+
+	def wave_clear(self): return 0
+	def wave_add_serial(self, *args, **kwargs): return 0
+	def wave_create(self): return 0
+	def wave_send_once(self, wave_id): return 0
+	def wave_tx_busy(self): return 0
+	def wave_delete(self, wave_id): return 0
+
+	def stop(self):
+		with self.eventCond:
+			self.connected = False
+			self.eventCond.notify_all()
+		self.chip.stop()
+
+class VirtualWTC():
+	"""
+	Scriptable WTC on the other end of the virtual UART. It speaks the QPCONTROL protocol: single control
+	bytes, 4 chunk or bulk packet uploads and NEXTPACKET downloads.
+
+	Attributes:
+		chip - the VirtualSC16IS750 it is wired to
+		tags - tags it may put in NOOP* packets (must match the Pi's tag file)
+		stats - timings of everything the scenario did, grouped by name
+	"""
+	def __init__(self, chip, tags = (), route = 0x01):
+		self.chip = chip
+		self.chip.peer = self
+		self.tags = list(tags)
+		self.recentTags = []
+		self.route = route
+		self.inbox = deque()
+		self.cond = threading.Condition()
+		self.stats = {}
+
+	def receive(self, byte):
+		with self.cond:
+			self.inbox.append(byte)
+			self.cond.notify_all()
+
+	def send(self, data):
+		self.chip.wireReceive(bytes(data))
+
+	def flush(self):
+		with self.cond:
+			self.inbox.clear()
+
+	def read(self, n, timeout = 2.0):
+		"""Wait for n bytes from the Pi. Returns whatever arrived before the timeout."""
+		deadline = time.monotonic() + timeout
+		out = bytearray()
+		with self.cond:
+			while len(out) < n:
+				while self.inbox and len(out) < n: out.append(self.inbox.popleft())
+				remaining = deadline - time.monotonic()
+				if len(out) >= n or remaining <= 0: break
+				self.cond.wait(remaining)
+		return bytes(out)
+
+	def record(self, name, seconds):
+		self.stats.setdefault(name, []).append(seconds)
+
+	def control(self, name, expect = 1, timeout = 2.0):
+		"""Send a QPCONTROL byte and return the Pi's response."""
+		start = time.monotonic()
+		self.send([qpStates[name]])
+		response = self.read(expect, timeout)
+		self.record(name, time.monotonic() - start)
+		return response
+
+	def setBulk(self, enable):
+		name = 'BULKRX' if enable else 'CHUNKRX'
+		return self.control(name) == bytes([qpStates[name]])
+
+	def upload(self, packet, bulk = False, timeout = 2.0):
+		"""Upload one 128 byte packet. Returns True if every ack came back."""
+		start = time.monotonic()
+		if bulk:
+			self.send(packet)
+			ok = self.read(1, timeout) == bytes([qpStates['CHUNK4']])
+		else:
+			ok = True
+			for n in range(4):
+				self.send(packet[n * 32:(n + 1) * 32])
+				if self.read(1, timeout) != bytes([qpStates['CHUNK1'] + n]):
+					ok = False
+					break
+		self.record('upload bulk' if bulk else 'upload chunks', time.monotonic() - start)
+		return ok
+
+	def download(self, timeout = 2.0):
+		"""Ask for the next packet with NEXTPACKET and return it."""
+		return self.control('NEXTPACKET', expect = 128, timeout = timeout)
+
+	def dataPacket(self, pid, data = b'', opcode = b'NOOP>'):
+		"""Build a DATA packet (NOOP> or NOOP!) with a valid checksum."""
+		from qpacePiCommands import generateChecksum
+		body = bytes([self.route]) + opcode + pid.to_bytes(4, byteorder = 'big') + bytes(data)[:114]
+		body += b'\x04' * (124 - len(body))
+		return body + generateChecksum(body)
+
+	def commandPacket(self, command, args = b''):
+		"""Build a NOOP* command packet with a valid checksum and an unused tag (sent in the clear)."""
+		from qpacePiCommands import generateChecksum
+		options = [t for t in self.tags if t not in self.recentTags] or self.tags or [b'\x00\x00']
+		tag = random.choice(options)
+		self.recentTags = (self.recentTags + [tag])[-3:]
+		information = bytes(args)[:92]
+		information += b'\x04' * (92 - len(information)) # Padded like ground pads it
+		body = bytes([self.route]) + b'NOOP*' + os.urandom(4) + command + information + tag + os.urandom(6) + b'\x00' * 12
+		return body + generateChecksum(body)
+
+	def report(self):
+		lines = []
+		for name, samples in sorted(self.stats.items()):
+			samples = sorted(samples)
+			lines.append('{:<16} n={:<5} mean={:8.2f}ms p50={:8.2f}ms max={:8.2f}ms'.format(
+				name, len(samples), 1000 * sum(samples) / len(samples), 1000 * samples[len(samples) // 2], 1000 * samples[-1]))
+		return '\n'.join(lines)
+
+def unpackRecords(packet):
+	"""
+	Split a downloaded packet into (opcode, data) responses. An AGGRG/AGGR* packet gives one per record, with the data
+	padded back out; anything else is returned as it is.
+	"""
+	from qpacePiCommands import ResponseAggregator
+	opcode = packet[1:6]
+	if opcode not in (b'AGGRG', b'AGGR*'):
+		return [(opcode, packet[6:124])]
+	data = packet[10:104] if opcode == b'AGGR*' else packet[6:124] # Privileged data sits after 4 random bytes
+	responses = []
+	i = 0
+	while i + 2 <= len(data) and data[i:i + 1] != b'\x04':
+		type, length = data[i], data[i + 1]
+		responses.append((ResponseAggregator.RECORD_TYPES[type], data[i + 2:i + 2 + length]))
+		i += 2 + length
+	return responses
+
+def waitForResponse(wtc, timeout = 5):
+	"""Poll WHATISNEXT until the Pi has a packet to send, then download it. Returns b'' on timeout."""
+	deadline = time.monotonic() + timeout
+	while wtc.control('WHATISNEXT') != bytes([qpStates['SENDPACKET']]):
+		if time.monotonic() > deadline:
+			return b''
+		time.sleep(.02)
+	return wtc.download()
+
+def scenarioThroughput(wtc, packets = 20):
+	"""
+	Default scenario. Ping, upload packets with and without chunk handshakes, queue a status packet,
+	download it and shut the Pi down. Returns a summary string.
+	"""
+	time.sleep(1) # Let the interpreter get its callback registered
+	for _ in range(10):
+		wtc.control('NOOP')
+	payload = bytes(range(114))
+	start = time.monotonic()
+	good = sum(wtc.upload(wtc.dataPacket(pid, payload)) for pid in range(packets))
+	chunked = time.monotonic() - start
+	summary = ['chunk uploads: {}/{} acked, {:.0f} B/s'.format(good, packets, 128 * packets / chunked)]
+	if wtc.setBulk(True):
+		start = time.monotonic()
+		good = sum(wtc.upload(wtc.dataPacket(pid, payload), bulk = True) for pid in range(packets))
+		bulk = time.monotonic() - start
+		summary.append('bulk uploads:  {}/{} acked, {:.0f} B/s'.format(good, packets, 128 * packets / bulk))
+		wtc.setBulk(False)
+	else:
+		summary.append('bulk uploads:  BULKRX was not accepted')
+	if wtc.tags:
+		wtc.upload(wtc.commandPacket(b'st'))
+		packet = waitForResponse(wtc)
+		summary.append('status packet: {} bytes, opcode {}'.format(len(packet), packet[1:6]))
+	wtc.control('SHUTDOWN')
+	return '\n'.join(summary)
+
+def scenarioStall(wtc):
+	"""
+	In bulk mode send half a packet and stop. Once the frame is stale a NOOP must be answered again, and the next
+	whole packet acknowledged. Returns a summary string.
+	"""
+	import qpaceFileHandler
+	time.sleep(1)
+	if not wtc.setBulk(True):
+		wtc.control('SHUTDOWN')
+		return 'BULKRX was not accepted'
+	packet = wtc.dataPacket(0, bytes(range(114)))
+	wtc.send(packet[:64])
+	time.sleep(qpaceFileHandler.ChunkPacket.TIMEDELAYDELTA + .5)
+	noop = wtc.control('NOOP') == bytes([qpStates['DONE']])
+	acked = wtc.upload(wtc.dataPacket(1, bytes(range(114))), bulk = True)
+	wtc.setBulk(False)
+	wtc.control('SHUTDOWN')
+	return 'after a stalled bulk frame: NOOP answered {}, next packet acked {}'.format(noop, acked)
+
+def scenarioRecovery(wtc, glitches = 5):
+	"""
+	Break the I2C bus a few times between pings and check the Pi keeps answering without restarting.
+	Returns a summary string.
+	"""
+	time.sleep(1)
+	pi = VirtualPi.default()
+	answered = 0
+	for _ in range(glitches):
+		wtc.control('NOOP')
+		pi.failCalls(3)
+		wtc.flush()
+		if wtc.control('NOOP', timeout = 1) == bytes([qpStates['DONE']]): answered += 1
+		else: answered += wtc.control('NOOP', timeout = 1) == bytes([qpStates['DONE']])
+	wtc.control('SHUTDOWN')
+	return 'pings answered after a bus glitch: {}/{}'.format(answered, glitches)
+
+def scenarioHandshake(wtc, requests = 10):
+	"""
+	Have the Pi ask for the solenoids the way an experiment does and time the WHATISNEXT / SOLON /
+	ACCEPTED / DONE exchange from the WTC side. Returns a summary string.
+	"""
+	import qpaceInterpreter
+	time.sleep(1)
+	nextQueue = qpaceInterpreter.cmd.nextQueue
+	accepted = 0
+	for _ in range(requests):
+		answer = []
+		asker = threading.Thread(target = lambda: answer.append(nextQueue.waitForResponse(5)))
+		nextQueue.enqueue('SOLON')
+		asker.start()
+		if wtc.control('WHATISNEXT') != bytes([qpStates['SOLON']]):
+			asker.join()
+			continue
+		done = wtc.control('ACCEPTED')
+		asker.join()
+		accepted += done == bytes([qpStates['DONE']]) and answer == [qpStates['ACCEPTED']]
+	wtc.control('SHUTDOWN')
+	return 'solenoid requests accepted: {}/{}'.format(accepted, requests)
+
+def scenarioReplay(wtc, retries = 3):
+	"""
+	Upload the same start experiment packet (same tag) several times, as ground does when a response is lost, and check
+	every copy is answered with the first response. Returns a summary string.
+	"""
+	time.sleep(1)
+	packet = wtc.commandPacket(b'se', b'emulator.txt')
+	responses = []
+	for _ in range(retries + 1):
+		start = time.monotonic()
+		wtc.upload(packet)
+		responses.append(waitForResponse(wtc))
+		wtc.record('se round trip', time.monotonic() - start)
+	wtc.control('SHUTDOWN')
+	same = sum(1 for response in responses[1:] if response and response == responses[0])
+	return 'retries answered with the original response: {}/{}'.format(same, retries)
+
+def scenarioBatch(wtc):
+	"""
+	Upload one bt packet holding two start experiment records and an unknown command, then download responses until
+	the BATCH packet arrives. The unknown command should be reported as U. Returns a summary string.
+	"""
+	time.sleep(1)
+	records = b''
+	for command, args in ((b'se', b'emulator.txt'), (b'se', b'emulator.txt'), (b'zz', b'')):
+		records += command + bytes([len(args)]) + args
+	start = time.monotonic()
+	wtc.upload(wtc.commandPacket(b'bt', records))
+	responses = []
+	results = None
+	while results is None:
+		response = waitForResponse(wtc)
+		if not response:
+			break
+		responses.append(response)
+		results = next((data for opcode, data in unpackRecords(response) if opcode == b'BATCH'), None)
+	wtc.record('bt round trip', time.monotonic() - start)
+	wtc.control('SHUTDOWN')
+	if results is None:
+		return 'no BATCH response after {} packets'.format(len(responses))
+	return 'batch answered after {} packets with results {}'.format(len(responses), [results[i:i + 3] for i in range(0, 9, 3)])
+
+def scenarioAggregate(wtc):
+	"""
+	Upload a bt packet with two log level requests, whose short responses and the BATCH response should come down
+	packed into one AGGRG packet. Returns a summary string.
+	"""
+	time.sleep(1)
+	records = b''
+	for levels in (b'debug off', b'debug on'):
+		records += b'lg' + bytes([len(levels)]) + levels
+	start = time.monotonic()
+	wtc.upload(wtc.commandPacket(b'bt', records))
+	packets = []
+	responses = []
+	while len(responses) < 3:
+		response = waitForResponse(wtc, timeout = 2)
+		if not response:
+			break
+		packets.append(response)
+		responses += unpackRecords(response)
+	wtc.record('bt round trip', time.monotonic() - start)
+	wtc.control('SHUTDOWN')
+	return '{} responses ({}) came down in {} packets'.format(len(responses), b' '.join(opcode for opcode, data in responses).decode(), len(packets))
+
+def scenarioMacro(wtc):
+	"""
+	Store a three step macro whose later steps use the output of its first step, a tar run on the executor, run it with
+	one mc packet and download its MACRO response. Returns a summary string.
+	"""
+	import json
+	import qpacePiCommands
+	steps = [{'command': 'tc', 'args': '$1'}, {'task': 'LOG', 'args': 'Emulator macro tarred @1'},
+			 {'wait': .1, 'output': '$1:@1'}]
+	with open(qpacePiCommands.MACROPATH + 'emulator.json', 'w') as macroFile:
+		json.dump({'steps': steps}, macroFile)
+	time.sleep(1)
+	start = time.monotonic()
+	wtc.upload(wtc.commandPacket(b'mc', b'emulator data/misc/macros'))
+	packets = []
+	result = None
+	while result is None:
+		response = waitForResponse(wtc)
+		if not response:
+			break
+		packets.append(response)
+		result = next((data for opcode, data in unpackRecords(response) if opcode == b'MACRO'), None)
+	wtc.record('mc round trip', time.monotonic() - start)
+	wtc.control('SHUTDOWN')
+	if result is None:
+		return 'no MACRO response after {} packets'.format(len(packets))
+	return 'macro answered in {} packet(s): {}'.format(len(packets), result.rstrip(b'\x04'))
+
+def scenarioLogLevel(wtc):
+	"""
+	Turn info logging and the Entered/Exited subsystems off with one lg packet, then send a few NOOPs, which
+	should no longer log their function tracing. Returns a summary string.
+	"""
+	time.sleep(1)
+	wtc.upload(wtc.commandPacket(b'lg', b'info off Entered off Exited off'))
+	response = waitForResponse(wtc)
+	answer = next((data for opcode, data in unpackRecords(response) if opcode == b'LOGLV'), b'') if response else b''
+	for _ in range(5):
+		wtc.control('NOOP')
+	wtc.control('SHUTDOWN')
+	return 'lg answered: {}'.format(answer.rstrip(b'\x04'))
+
+def scenarioLogQuery(wtc):
+	"""
+	Send a few NOOPs so there is something in the log, then ask for the system lines about them with one lq packet
+	and collect the LOGQR packets up to LOGQD. Returns a summary string.
+	"""
+	time.sleep(1)
+	for _ in range(3):
+		wtc.control('NOOP')
+	time.sleep(1.5) # Let the writer index them
+	wtc.upload(wtc.commandPacket(b'lq', b'from=-60 level=system max=2 re=NOOP|Queue'))
+	lines = b''
+	summary = b''
+	deadline = time.monotonic() + 10
+	while not summary and time.monotonic() < deadline:
+		response = waitForResponse(wtc)
+		for opcode, data in unpackRecords(response) if response else ():
+			if opcode == b'LOGQR':
+				lines += data.rstrip(b'\x04')
+			elif opcode == b'LOGQD':
+				summary = data.rstrip(b'\x04')
+	wtc.control('SHUTDOWN')
+	return 'lq sent {} lines, first <{}>: {}'.format(lines.count(b'\n'), lines.split(b'\n')[0], summary)
+
+def collectTail(wtc, timeout = 10):
+	"""Download packets until a whole tail (LOGTH and its LOGTL packets) is in. Returns (start, end, flags, name, bytes) or None."""
+	from qpacePiCommands import LogTail
+	header = None
+	chunks = {}
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline and (header is None or len(chunks) < header[3]):
+		response = waitForResponse(wtc)
+		for opcode, data in unpackRecords(response) if response else ():
+			if opcode == b'LOGTH':
+				data += b'\x04' * (118 - len(data))
+				header = LogTail.HEADER.unpack_from(data) + (data[LogTail.HEADER.size:].rstrip(b'\x04').decode('ascii'),)
+			elif opcode == b'LOGTL':
+				chunks[data[0]] = data[1:]
+	if header is None:
+		return None
+	start, end, length, count, flags, name = header
+	compressed = b''.join(chunks[n] for n in range(count))[:length]
+	return start, end, flags, name, zlib.decompress(compressed) if count else b''
+
+def scenarioLogTail(wtc):
+	"""
+	Ask for the log's tail, acknowledge it, log a bit more and ask again: the second tail should carry on from the
+	first. Then turn fill on and let an idle poll bring the next part down. Checks the bytes against the log on disk.
+	Returns a summary string.
+	"""
+	import qpacePiCommands
+	time.sleep(1)
+	wtc.upload(wtc.commandPacket(b'lt', b''))
+	first = collectTail(wtc)
+	wtc.upload(wtc.commandPacket(b'la', '{} {}'.format(first[3], first[1]).encode('ascii')))
+	waitForResponse(wtc)
+	for _ in range(3):
+		wtc.control('NOOP')
+	wtc.upload(wtc.commandPacket(b'lt', b'max=4'))
+	second = collectTail(wtc)
+	qpacePiCommands.LogTail.FILL_INTERVAL = 0
+	qpacePiCommands.LogTail.FILL_BYTES = 1
+	wtc.upload(wtc.commandPacket(b'lt', b'fill=on max=1'))
+	collectTail(wtc)
+	for _ in range(3):
+		wtc.control('NOOP')
+	time.sleep(1.5)
+	filled = collectTail(wtc)
+	wtc.control('SHUTDOWN')
+	with open(os.path.join(qpacePiCommands.qpLog.Logger.LOG_PATH, second[3]), 'rb') as logFile:
+		log = logFile.read()
+	matches = all(tail and log[tail[0]:tail[1]] == tail[4] for tail in (first, second, filled))
+	return 'lt sent {}-{}, then {}-{}, fill sent {}. Bytes match the log: {}'.format(first[0], first[1], second[0],
+		second[1], '{}-{}'.format(filled[0], filled[1]) if filled else 'nothing', matches)
+
+def scenarioTelemetry(wtc):
+	"""
+	Send a few NOOPs, one packet with a bad checksum and a tm packet, then decode the TELEM packets that come back.
+	Returns a summary string.
+	"""
+	import qpaceMetrics
+	time.sleep(1)
+	for _ in range(3):
+		wtc.control('NOOP')
+	bad = bytearray(wtc.commandPacket(b'tm', b''))
+	bad[-1] ^= 0xFF
+	wtc.upload(bytes(bad))
+	waitForResponse(wtc) # ~NVAL
+	wtc.upload(wtc.commandPacket(b'tm', b''))
+	metrics = {}
+	parts = None
+	deadline = time.monotonic() + 10
+	while (parts is None or len(metrics) < parts) and time.monotonic() < deadline:
+		response = waitForResponse(wtc)
+		for opcode, data in unpackRecords(response) if response else ():
+			if opcode == b'TELEM':
+				when, part, parts, values = qpaceMetrics.unpack(data + b'\x04' * (118 - len(data)))
+				metrics[part] = values
+	wtc.control('SHUTDOWN')
+	names = dict((qpaceMetrics.metricId(name), name) for name in qpaceMetrics.registry.metrics)
+	values = dict((names.get(id, id), value) for part in metrics.values() for id, kind, value in part)
+	return 'tm sent {} metrics in {} packets: packetsIn={} corrupt={} nval={}'.format(len(values), len(metrics),
+		values.get('interpreter.packetsIn'), values.get('interpreter.corruptPackets'), values.get('interpreter.nvalSent'))
+
+def scenarioTimeSeries(wtc):
+	"""
+	Let the collector take a few samples (once a second here), then ask for the last minute of two series and for
+	the whole hour, which has to be downsampled into one packet. Also checks that a series missing from some samples
+	is averaged over its own samples only. Returns a summary string.
+	"""
+	import qpaceTimeSeries
+	store = qpaceTimeSeries.TimeSeriesStore(qpaceTimeSeries.STORE_PATH + '.check', ('a', 'b'))
+	now = time.time()
+	for values in ({'a': 10}, {'a': 10, 'b': 50}, {'a': 10, 'b': 60}):
+		store.record(now, values)
+	means = [store.query(n, now, now)[2][-1] for n in range(len(store.resolutions))]
+	store.close()
+	time.sleep(3.5)
+	for _ in range(3):
+		wtc.control('NOOP')
+	time.sleep(1)
+	summaries = []
+	for args in (b'from=-60 series=cpuPercent,packetsIn', b'max=1'):
+		wtc.upload(wtc.commandPacket(b'ts', args))
+		ranges = []
+		deadline = time.monotonic() + 10
+		while not ranges and time.monotonic() < deadline:
+			response = waitForResponse(wtc)
+			for opcode, data in unpackRecords(response) if response else ():
+				if opcode == b'TSDAT':
+					ranges.append(qpaceTimeSeries.unpack(data + b'\x04' * (118 - len(data))))
+		rows = [row for step, start, names, part in ranges for row in part]
+		known = sum(1 for row in rows if any(value == value for value in row))
+		summaries.append('{} rows of {}s ({} with samples) of {}'.format(len(rows), ranges[0][0] if ranges else '-', known,
+			','.join(ranges[0][2]) if ranges else '-'))
+	wtc.control('SHUTDOWN')
+	return 'ts sent ' + '; '.join(summaries) + '. Means of a and b (b missing once, should be 10 and 55): ' + \
+		', '.join('{:g} {:g}'.format(*row) for row in means)
+
+def scenarioTrace(wtc):
+	"""
+	Turn tracing on, send a few NOOPs and a status, then dump the trace and check it opens as a Chrome trace with
+	spans from both the RX worker and the interpreter. The dr command the TRACE packet starts with is sent as it
+	came, to check the dump can be downloaded. Returns a summary string.
+	"""
+	import gzip
+	import json
+	import qpacePiCommands
+	time.sleep(1)
+	wtc.upload(wtc.commandPacket(b'tr', b'clear on'))
+	waitForResponse(wtc)
+	for _ in range(3):
+		wtc.control('NOOP')
+	wtc.upload(wtc.commandPacket(b'tm', b''))
+	waitForResponse(wtc)
+	wtc.upload(wtc.commandPacket(b'tr', b'off dump'))
+	records = {}
+	def collect(opcode):
+		deadline = time.monotonic() + 10
+		while opcode not in records and time.monotonic() < deadline:
+			response = waitForResponse(wtc)
+			for code, data in unpackRecords(response) if response else ():
+				records[code] = data.rstrip(b'\x04')
+		return records.get(opcode)
+	summary = (collect(b'TRACE') or b'').decode('ascii')
+	if not summary.startswith('dr '):
+		wtc.control('SHUTDOWN')
+		return 'tr did not dump: {}'.format(summary)
+	path = summary.split(' ')[1]
+	wtc.upload(wtc.commandPacket(b'dr', path.encode('ascii')))
+	downr = collect(b'DOWNR')
+	wtc.control('SHUTDOWN')
+	downloadable = downr is not None and b'FileNotFound' not in downr
+	with gzip.open(qpacePiCommands.ROOTPATH + path, 'rt') as traceFile:
+		events = json.load(traceFile)['traceEvents']
+	names = set(event['name'] for event in events if event['ph'] in ('X', 'i'))
+	threads = set(event['args']['name'] for event in events if event['name'] == 'thread_name')
+	return '{}. dr found it: {}. {} events; {} names incl. irq: {}, decodePacket: {}, tm: {}; threads {}'.format(summary,
+		downloadable, len(events), len(names), 'irq' in names, 'decodePacket' in names, 'tm' in names, sorted(threads))
+
+SCENARIOS = {
+	'throughput': scenarioThroughput,
+	'recovery': scenarioRecovery,
+	'stall': scenarioStall,
+	'handshake': scenarioHandshake,
+	'replay': scenarioReplay,
+	'aggregate': scenarioAggregate,
+	'macro': scenarioMacro,
+	'loglevel': scenarioLogLevel,
+	'logquery': scenarioLogQuery,
+	'logtail': scenarioLogTail,
+	'telemetry': scenarioTelemetry,
+	'timeseries': scenarioTimeSeries,
+	'trace': scenarioTrace,
+	'batch': scenarioBatch
+}
+
+def runEmulator(scenario = scenarioThroughput, sandbox = None, tags = (b'aa', b'bb', b'cc', b'dd', b'ee')):
+	"""
+	Run qpaceMain.run against the virtual chip while the virtual WTC plays a scenario.
+
+	Logs, the graveyard and the tag file are kept under sandbox (a temporary directory by default) so
+	nothing on the machine is touched.
+
+	Parameters:
+		scenario - callable taking the VirtualWTC. Should end by sending SHUTDOWN.
+		sandbox - directory to run in
+		tags - tags written to the tag file and used by the WTC
+
+	Returns: (VirtualWTC, whatever the scenario returned)
+
+	Raises: None
+	"""
+	installPigpio()
+	sandbox = sandbox or tempfile.mkdtemp(prefix = 'qpaceEmulator')
+	for folder in ('logs', 'graveyard', 'temp', 'Scripts', 'data/misc', 'data/misc/macros', 'data/text', 'data/backup'):
+		os.makedirs(os.path.join(sandbox, folder), exist_ok = True)
+	tagFile = os.path.join(sandbox, 'valid_tags.secret')
+	with open(tagFile, 'wb') as f:
+		f.write(b'/'.join(tags))
+
+	pi = VirtualPi.default()
+	import qpaceLogger
+	import qpaceTagChecker
+	import qpaceInterpreter
+	import qpaceMain
+	import qpacePiCommands
+	qpaceLogger.Logger.LOG_PATH = os.path.join(sandbox, 'logs') + os.sep
+	qpaceLogger.LogWriter.ARCHIVE_PATH = os.path.join(sandbox, 'data/backup') + os.sep
+	qpaceTagChecker.TagChecker.DEFAULT_FILEPATH = tagFile
+	qpaceInterpreter.SECRETS = os.path.join(sandbox, 'qctrl.secret')
+	qpacePiCommands.MACROPATH = os.path.join(sandbox, 'data/misc/macros') + os.sep
+	qpacePiCommands.ROOTPATH = sandbox.rstrip(os.sep) + os.sep
+	qpacePiCommands.LogTail.TAIL_STATE = os.path.join(sandbox, 'data/misc/logtail.json')
+	import qpaceTimeSeries
+	qpaceTimeSeries.STORE_PATH = os.path.join(sandbox, 'data/misc/timeseries.qts')
+	qpaceTimeSeries.COLLECT_INTERVAL = 1 # Scenarios are short
+	import qpaceTracer
+	qpaceTracer.TRACE_PATH = os.path.join(sandbox, 'data/misc') + os.sep
+	qpaceMain.gpio = pi
+	os.chdir(os.path.join(sandbox, 'Scripts'))
+	logger = qpaceLogger.Logger()
+	qpaceMain.logger = logger
+
+	wtc = VirtualWTC(pi.chip, tags = tags)
+	result = {}
+	def play():
+		result['summary'] = scenario(wtc)
+	player = threading.Thread(name = 'virtualWTC', target = play)
+	player.daemon = True
+	player.start()
+	qpaceMain.run(logger)
+	player.join(5)
+	return wtc, result.get('summary')
+
+if __name__ == '__main__':
+	name = sys.argv[1] if len(sys.argv) > 1 else 'throughput'
+	sandbox = sys.argv[2] if len(sys.argv) > 2 else None
+	sys.argv = sys.argv[:1] + ['n'] # Keep the logger quiet on the terminal
+	wtc, summary = runEmulator(SCENARIOS[name], sandbox)
+	print(summary)
+	print(wtc.report())
+	from qpacePiCommands import Command
+	import SC16IS750
+	if Command._chip is not None:
+		print(SC16IS750.BusStats.format(Command._chip.snapshot()))
+	import qpaceInterpreter
+	if qpaceInterpreter.packetBuffer is not None:
+		print(qpaceInterpreter.PacketBuffer.format(qpaceInterpreter.packetBuffer.snapshot()))
+		print(qpaceInterpreter.ProtocolState.format(qpaceInterpreter.protocol.snapshot()))
+	if Command._executor is not None:
+		import qpaceExecutor
+		print(qpaceExecutor.CommandExecutor.format(Command._executor.snapshot()))
+	if Command._aggregator is not None:
+		from qpacePiCommands import ResponseAggregator
+		print(ResponseAggregator.format(Command._aggregator.snapshot()))
+	if Command._logTail is not None:
+		from qpacePiCommands import LogTail
+		print(LogTail.format(Command._logTail.snapshot()))
+	import qpaceMetrics
+	print(qpaceMetrics.Registry.format(qpaceMetrics.registry.snapshot()))
+	import qpaceTracer
+	print(qpaceTracer.Tracer.format(qpaceTracer.Tracer.snapshot()))
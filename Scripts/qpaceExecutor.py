@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# qpaceExecutor.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Runs interpreter commands on a small pool of worker threads so a slow command (tar, ffmpeg, status)
+# never holds up the WTC link. Every command belongs to a resource class and the pool limits how many
+# jobs of each class, and of each command, run at once.
+
+import time
+import threading
+from collections import deque
+import qpaceMetrics
+import qpaceTracer
+
+# Resource classes
+CPU = 'CPU'     # Video conversion and compression, which can take minutes
+DISK = 'DISK'   # Moving, listing and archiving files
+GPIO = 'GPIO'   # Anything that drives the experiment hardware
+LIGHT = 'LIGHT' # Short commands ground is waiting on (status), kept from queueing behind CPU jobs
+BATCH = 'BATCH' # Batches and macros, which wait on the jobs of their records and steps
+
+RESOURCE_LIMITS = {CPU: 1, DISK: 2, GPIO: 1, LIGHT: 2, BATCH: 2} # Jobs of each class that may run at the same time. One worker each.
+MAX_QUEUED = 16 # Jobs that may wait for a worker before new ones are refused
+FINISHED_KEPT = 8 # Finished jobs remembered for the status file
+
+jobMs = qpaceMetrics.histogram('executor.jobMs', qpaceMetrics.LATENCY_MS)
+waitMs = qpaceMetrics.histogram('executor.waitMs', qpaceMetrics.LATENCY_MS) # Submitted until a worker picked it up
+
+class Job():
+	"""
+	One command waiting for or running on the executor.
+
+	Attributes:
+		id - sequence number given by the executor
+		name - the command name (e.g. 'tc')
+		function - the Command method to call with *args
+		resource - the resource class it belongs to
+		limit - how many jobs with this name may run at once
+		state - 'queued', 'running', 'done', 'failed' or 'dropped'
+		queued, started, finished - time.time() of each step
+		error - the exception the command raised, if any
+	"""
+	def __init__(self, id, name, function, args, resource, limit):
+		self.id = id
+		self.name = name
+		self.function = function
+		self.args = args
+		self.resource = resource
+		self.limit = limit
+		self.state = 'queued'
+		self.queued = time.time()
+		self.started = None
+		self.finished = None
+		self.error = None
+		self.ended = threading.Event()
+
+	def wait(self, timeout = None):
+		"""Block until the job has finished or was dropped. Returns: True if it has."""
+		return self.ended.wait(timeout)
+
+	def describe(self):
+		now = time.time()
+		if self.started is None:
+			return '#{} {} {} waiting {:.1f}s'.format(self.id, self.name, self.resource, now - self.queued)
+		if self.finished is None:
+			return '#{} {} {} running {:.1f}s'.format(self.id, self.name, self.resource, now - self.started)
+		return '#{} {} {} {} in {:.1f}s (waited {:.1f}s){}'.format(self.id, self.name, self.resource, self.state,
+			self.finished - self.started, self.started - self.queued, ' <{}>'.format(self.error) if self.error else '')
+
+class CommandExecutor():
+	"""
+	Bounded pool of worker threads for interpreter commands. Jobs start in the order they were submitted
+	unless their resource class or command is at its limit, in which case later jobs may go first.
+
+	Responses are sent by the commands themselves (Command.CMDPacket.send) when they finish, so the
+	interpreter only has to submit the job.
+	"""
+	def __init__(self, logger, limits = RESOURCE_LIMITS, maxQueued = MAX_QUEUED):
+		"""
+		Start the worker threads.
+
+		Parameters:
+		logger - qpaceLogger.Logger() - for logging
+		limits - dict - resource class: jobs of that class allowed to run at once
+		maxQueued - int - jobs allowed to wait before submit() refuses more
+
+		Returns: None
+
+		Raises: None
+		"""
+		self.logger = logger
+		self.limits = dict(limits)
+		self.maxQueued = maxQueued
+		self.cv = threading.Condition()
+		self.queue = deque()
+		self.running = []
+		self.finished = deque(maxlen = FINISHED_KEPT)
+		self.nextId = 0
+		self.completed = 0
+		self.failed = 0
+		self.refused = 0
+		self.stopped = False
+		self.workers = []
+		qpaceMetrics.gauge('executor.queued', lambda: len(self.queue))
+		for n in range(sum(self.limits.values())):
+			worker = threading.Thread(name = 'commandExecutor{}'.format(n), target = self._work)
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def submit(self, name, function, args, resource, limit = 1):
+		"""
+		Queue a command.
+
+		Parameters:
+		name - str - the command name, used for the per-command limit and the status
+		function - the Command method to run
+		args - tuple - arguments for function
+		resource - one of CPU, DISK, GPIO, LIGHT or BATCH
+		limit - int - how many jobs with this name may run at once
+
+		Returns: the Job, or None if the queue is full or the executor was shut down.
+
+		Raises: None
+		"""
+		with self.cv:
+			if self.stopped or len(self.queue) >= self.maxQueued:
+				self.refused += 1
+				return None
+			self.nextId += 1
+			job = Job(self.nextId, name, function, args, resource, limit)
+			self.queue.append(job)
+			self.cv.notify_all()
+			return job
+
+	def _runnable(self):
+		"""Return the first queued job whose resource class and command are under their limits. Caller holds self.cv."""
+		for job in self.queue:
+			busy = sum(1 for j in self.running if j.resource == job.resource)
+			same = sum(1 for j in self.running if j.name == job.name)
+			if busy < self.limits.get(job.resource, 1) and same < job.limit:
+				return job
+		return None
+
+	def _work(self):
+		while True:
+			with self.cv:
+				job = self._runnable()
+				while job is None and not self.stopped:
+					self.cv.wait()
+					job = self._runnable()
+				if job is None:
+					return
+				self.queue.remove(job)
+				self.running.append(job)
+				job.state = 'running'
+				job.started = time.time()
+			try:
+				with qpaceTracer.span(job.name, 'command') as span:
+					span.set(waitMs = round((job.started - job.queued) * 1000, 3))
+					job.function(*job.args)
+				job.state = 'done'
+			except StopIteration as e:
+				# Commands use StopIteration to refuse to run (e.g. an experiment is already running).
+				job.state = 'failed'
+				job.error = e
+				self.logger.logSystem('Executor: {} stopped early <{}>.'.format(job.name, e))
+			except Exception as e:
+				job.state = 'failed'
+				job.error = e
+				self.logger.logError('Executor: {} failed.'.format(job.name), e)
+			with self.cv:
+				job.finished = time.time()
+				jobMs.observe((job.finished - job.started) * 1000)
+				waitMs.observe((job.started - job.queued) * 1000)
+				self.running.remove(job)
+				self.finished.append(job)
+				if job.state == 'done':
+					self.completed += 1
+				else:
+					self.failed += 1
+				job.ended.set()
+				self.cv.notify_all()
+
+	def shutdown(self):
+		"""
+		Drop the queued jobs and let the workers exit once their current job is done.
+
+		Parameters: None
+
+		Returns: the number of jobs that were dropped
+
+		Raises: None
+		"""
+		with self.cv:
+			self.stopped = True
+			dropped = len(self.queue)
+			for job in self.queue:
+				job.state = 'dropped'
+				job.ended.set()
+			self.queue.clear()
+			self.cv.notify_all()
+		return dropped
+
+	def snapshot(self):
+		"""
+		Returns: dict with the queued, running and recently finished jobs (as text) and the job counters.
+		"""
+		with self.cv:
+			return {'queued': [job.describe() for job in self.queue], 'running': [job.describe() for job in self.running],
+					'finished': [job.describe() for job in self.finished], 'completed': self.completed,
+					'failed': self.failed, 'refused': self.refused, 'limits': dict(self.limits)}
+
+	@staticmethod
+	def format(snapshot):
+		lines = ['Executor: {} running, {} queued, {} completed, {} failed, {} refused. Limits {}'.format(len(snapshot['running']),
+			len(snapshot['queued']), snapshot['completed'], snapshot['failed'], snapshot['refused'], snapshot['limits'])]
+		lines += ['  running  ' + job for job in snapshot['running']]
+		lines += ['  queued   ' + job for job in snapshot['queued']]
+		lines += ['  finished ' + job for job in snapshot['finished']]
+		return '\n'.join(lines)
@@ -8,7 +8,14 @@ import datetime
 import time
 import qpaceExperiment as expModule
 import qpaceLogger as qpLog
+import qpaceMetrics
+import qpaceTracer
 
+runs = qpaceMetrics.counter('experiment.runs')
+instructions = qpaceMetrics.counter('experiment.instructions')
+delayErrorMs = qpaceMetrics.histogram('experiment.delayErrorMs', qpaceMetrics.LATENCY_MS) # How far a DELAY was off
+
+@qpaceTracer.traced('ExpParser.run', 'experiment')
 def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 	"""
 	This function handles the parsing and execution of the raw text experiment files.
@@ -78,6 +85,7 @@ def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 	experimentStartTime = datetime.datetime.now() # Just in case the parser gets invoked on an empty file, seed the start time.
 	experimentLog = None
 	isRecording = False
+	steps = qpaceTracer.Steps('experiment') # A span per instruction
 	try:
 		with open(expLocation + filename, 'r') as inputFile:
 			# Determine if we need solenoids and/or steppers. Act accordingly.
@@ -95,8 +103,7 @@ def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 
 				if solenoidRequest and stepperRequest:
 					break
-			disableCallback.set()
-			time.sleep(.35)
+			disableCallback.set() # Returns once the interpreter has let go of the RX FIFO.
 			# If we want the solenoids, let's request them. Failure to enable will abort the experiment.
 			if solenoidRequest:
 				logger.logSystem('ExpParser: WTC... may I have the solenoids please?')
@@ -125,6 +132,8 @@ def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 				runEvent.wait() # If we should be waiting, then wait.
 
 				if instruction:
+					instructions.inc()
+					steps.next(instruction[0], line = ' '.join(instruction))
 					# Begin interpreting the instructions that matter.
 					try:
 						if(instruction[0] == 'START'):
@@ -133,6 +142,7 @@ def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 								raise StopIteration('ExpParser: Attempted a start, but an experiment is already running: {}'.format(title))
 							title = ' '.join(instruction[1:]) or 'Unknown'
 							experimentStartTime= datetime.datetime.now()
+							runs.inc()
 							experimentLog = open('{}exp_{}_{}.qpe'.format(logLocation,experimentStartTime.strftime('%Y%m%d-%H%M%S'),title),'w')
 							isRunningEvent.set()
 							logMessage = 'ExpParser: Starting Experiment "{}" ({}).'.format(filename,title)
@@ -182,7 +192,9 @@ def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 								logMessage = 'ExpParser: Delay for {} ms'.format(ms)
 								logger.logSystem(logMessage)
 								experimentLog.write('{}\n'.format(logMessage))
+								started = time.monotonic()
 								time.sleep(ms/1000)
+								delayErrorMs.observe(abs((time.monotonic() - started) * 1000 - ms))
 						elif(instruction[0] == 'LED'):
 							if isRunningEvent.is_set():
 								# Modify the LED
@@ -331,6 +343,7 @@ def run(filename, isRunningEvent, runEvent,logger,nextQueue,disableCallback):
 	except Exception as e:
 		logger.logError('ExpParser: Aborted the experiment. Error: {}'.format(e.__class__),e)
 	finally:
+		steps.close()
 		# Clean up and close out all nicely.
 
 		if isRunningEvent.is_set(): # Ensure we are no longer running an experiment
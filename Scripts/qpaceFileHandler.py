@@ -17,6 +17,8 @@ import re
 import os
 import traceback
 import hashlib
+import qpaceMetrics
+import qpaceTracer
 
 WTC_PACKET_BUFFER_SIZE = 10
 
@@ -30,6 +32,12 @@ ROOTPATH = '/home/pi/'
 MAX_FILE_SIZE = 2147483648
 MAX_RAM_ALLOTMENT = 419430400 # This is how many bytes are in 400MB. Restrict file sizes to this because of RAM.,///
 
+packetsDown = qpaceMetrics.counter('files.packetsDown') # Data packets queued by a Transmitter
+packetsUp = qpaceMetrics.counter('files.packetsUp') # Data packets put in a Scaffold
+uploadsGood = qpaceMetrics.counter('files.uploadsGood')
+uploadsBad = qpaceMetrics.counter('files.uploadsBad') # Checksum didn't match
+chunkResyncs = qpaceMetrics.counter('files.chunkResyncs') # Chunked packets that came in the wrong size
+
 CHECKSUM_PARAM = b'HERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESATHERECOMESTHECUBESAT'
 
 
@@ -206,11 +214,18 @@ class DummyPacket(DataPacket):
 		return toSend + generateChecksum(toSend)
 
 class ChunkPacket():
-	""" Helper class to take chunks and make them into a packet if 4 are received"""
+	"""
+	Helper class to take chunks and make them into a packet if 4 are received.
+	In bulk mode the WTC sends whole packets without waiting for chunk acknowledgements,
+	so data is framed by size and acknowledged once every BULK_ACK_WINDOW packets.
+	"""
 	TIMEDELAYDELTA = 1.5 # in seconds
+	BULK_ACK_WINDOW = 1 # packets per acknowledgement in bulk mode
 	chunks = []
 	complete = False
 	lastInputTime = None
+	bulkMode = False
+	packetsSinceAck = 0
 
 	def __init__(self, chip,logger):
 		"""
@@ -228,6 +243,7 @@ class ChunkPacket():
 		self.chip = chip
 		self.logger = logger
 
+	@qpaceTracer.traced('ChunkPacket.push', 'files')
 	def push(self,data):
 		"""
 		Add a chunk to the internal list
@@ -241,20 +257,29 @@ class ChunkPacket():
 
 		"""
 		if not ChunkPacket.complete:
-			if ChunkPacket.lastInputTime is not None and (datetime.now() - ChunkPacket.lastInputTime) > timedelta(seconds = ChunkPacket.TIMEDELAYDELTA):
-				ChunkPacket.chunks[:] = [] # reset the chunks..
+			ChunkPacket.dropStale()
 			ChunkPacket.lastInputTime = datetime.now()
 			ChunkPacket.chunks.append(data)
-			#Acknowledge WTC with chunk number
-			self.chip.byte_write(SC16IS750.REG_THR,0x60 + len(ChunkPacket.chunks)) # Defined by WTC state machine
-			if len(ChunkPacket.chunks) == 4: # We are doing 4 chunks!
-				ChunkPacket.complete = True
+			if ChunkPacket.bulkMode:
+				# Frame by size. Only acknowledge once per window of whole packets.
+				if sum(map(len, ChunkPacket.chunks)) >= DataPacket.max_size:
+					ChunkPacket.complete = True
+					ChunkPacket.packetsSinceAck += 1
+					if ChunkPacket.packetsSinceAck >= ChunkPacket.BULK_ACK_WINDOW:
+						self.chip.byte_write(SC16IS750.REG_THR,0x60 + 4) # CHUNK4 doubles as the packet acknowledgement
+						ChunkPacket.packetsSinceAck = 0
+			else:
+				#Acknowledge WTC with chunk number
+				self.chip.byte_write(SC16IS750.REG_THR,0x60 + len(ChunkPacket.chunks)) # Defined by WTC state machine
+				if len(ChunkPacket.chunks) == 4: # We are doing 4 chunks!
+					ChunkPacket.complete = True
 
 		else:
 			self.logger.logSystem("ChunkPacket: Attempted to push when complete...")
 			ChunkPacket.complete = True
 
 
+	@qpaceTracer.traced('ChunkPacket.build', 'files')
 	def build(self):
 		"""
 		Build a packet out of the four chunks
@@ -267,11 +292,15 @@ class ChunkPacket():
 
 		"""
 		if ChunkPacket.complete:
-			packet = b''
-			for chunk in ChunkPacket.chunks:
-				packet += chunk
-			if len(packet) != DataPacket.max_size:
+			packet = b''.join(ChunkPacket.chunks)
+			leftover = b''
+			if ChunkPacket.bulkMode:
+				# Anything past the frame is the start of the next packet.
+				leftover = packet[DataPacket.max_size:]
+				packet = packet[:DataPacket.max_size]
+			elif len(packet) != DataPacket.max_size:
 				self.logger.logSystem("Packet is not {} bytes! It is {} bytes!".format(str(DataPacket.max_size),str(len(packet))) ,str(packet)[50:])
+				chunkResyncs.inc()
 				#print("QUICK FIX IN QPACE FILE HANDLER")
 				packet = packet[(len(packet)-DataPacket.max_size):]
 				if(packet[-4:] != generateChecksum(packet[:-4])):
@@ -280,14 +309,66 @@ class ChunkPacket():
 					Command.PrivilegedPacket(opcode=b"ERROR", plainText=b"ERROR OCCURING").send()
 				#else:
 					#print("QUICK FIX IS VALID")
-			ChunkPacket.chunks[:] = [] #reset chunks to empty
+			ChunkPacket.chunks[:] = [leftover] if leftover else [] #reset chunks to empty
 			ChunkPacket.complete = False #reset copmlete to False
-			ChunkPacket.lastInputTime = None # reset the timer.
+			ChunkPacket.lastInputTime = datetime.now() if leftover else None # reset the timer.
 			return packet
 		else:
 			#print('Packet is not complete yet.')
 			pass
 
+	@staticmethod
+	def inProgress():
+		"""
+		Check if part of a packet has been received.
+
+		Parameters: None
+
+		Returns: True if there are chunks waiting for the rest of their packet
+
+		Raises: None
+
+		"""
+		return len(ChunkPacket.chunks) > 0
+
+	@staticmethod
+	def dropStale():
+		"""
+		Drop a partial packet if nothing was added to it for TIMEDELAYDELTA seconds.
+
+		Parameters: None
+
+		Returns: True if a partial packet was dropped
+
+		Raises: None
+
+		"""
+		if ChunkPacket.lastInputTime is not None and (datetime.now() - ChunkPacket.lastInputTime) > timedelta(seconds = ChunkPacket.TIMEDELAYDELTA):
+			stale = ChunkPacket.inProgress()
+			ChunkPacket.chunks[:] = [] # reset the chunks..
+			ChunkPacket.lastInputTime = None
+			return stale
+		return False
+
+	@staticmethod
+	def setBulkMode(enable):
+		"""
+		Switch between the 4 chunk handshake and bulk (chunkless) framing.
+		Any partial packet is dropped since it was framed under the old mode.
+
+		Parameters: enable - True for bulk mode, False for the chunk handshake
+
+		Returns: None
+
+		Raises: None
+
+		"""
+		ChunkPacket.bulkMode = enable
+		ChunkPacket.chunks[:] = []
+		ChunkPacket.complete = False
+		ChunkPacket.lastInputTime = None
+		ChunkPacket.packetsSinceAck = 0
+
 class Defaults():
 	""" Helper class that only stores Default values. Nothing else"""
 	packetsPerAck_DEFAULT = 1
@@ -381,6 +462,7 @@ class Transmitter():
 		self.xtea = xtea
 		#self._updateFileProgress()
 
+	@qpaceTracer.traced('Transmitter.run', 'files')
 	def run(self):
 		"""
 		The main loop for the Transmitter()
@@ -409,6 +491,7 @@ class Transmitter():
 					self.pkt_padding = self.data_size - len(packetData[pid])
 					print("Adding packet #{0}: {1}".format(pid+self.firstPacket, packetData[pid]))
 					self.packetQueue.enqueue(packet.build()) #ADD PACKET TO BUFFER
+					packetsDown.inc()
 					#print("SUCCESSS WE ADDED HERE: %d" % pid)
 				except Exception as e:
 					#logger.logError("ERROR, WE HAVE FOUND SOME ERROR HERE: {0}".format(pid))
@@ -541,6 +624,7 @@ class Scaffold():
 
 
 	@staticmethod
+	@qpaceTracer.traced('Scaffold.construct', 'files')
 	def construct(pid,newData):
 		"""
 		Take new data and put it into a scaffold file
@@ -556,6 +640,7 @@ class Scaffold():
 		"""
 		pid = int.from_bytes(pid,byteorder='big')
 		missed_packets = []
+		packetsUp.inc()
 		filename = UploadRequest.filename
 		# useFEC = UploadRequest.useFEC
 		with open("{}{}.scaffold".format(TEMPPATH,filename),"rb+") as scaffold:
@@ -638,6 +723,7 @@ class Scaffold():
 		except:
 			pass
 	@staticmethod
+	@qpaceTracer.traced('Scaffold.finish', 'files')
 	def finish(information):
 		"""
 		Finish the scaffold, remove the extension, and remove the extra padding by the last packet.
@@ -665,6 +751,7 @@ class Scaffold():
 				else:
 					f.write(info)
 			checksumMatch = checksum == generateChecksum(open(TEMPPATH+filename+'.scaffold','rb').read())
+			(uploadsGood if checksumMatch else uploadsBad).inc()
 			try:
 				os.rename('{}{}.scaffold'.format(TEMPPATH,filename),ROOTPATH + filename.replace('@','/'))
 				os.rename('{}{}.nore'.format(TEMPPATH,filename),"{}{}.nore".format(GRAVEPATH,filename))
@@ -26,20 +26,33 @@ import os
 import traceback
 from struct import pack
 import threading
-from qpacePiCommands import generateChecksum, Command
+import bisect
+from collections import deque
+from qpacePiCommands import generateChecksum, Command, ReplayCache, ResponseAggregator, LogTail
 # import tstSC16IS750 as SC16IS750
 import SC16IS750
 import sys
 import qpaceControl
 import qpaceFileHandler as fh
 import qpaceTagChecker as tagChecker
+import qpaceLogger
+import qpaceExecutor as ex
+import qpaceMetrics
+import qpaceTracer
 
 qpStates = qpaceControl.QPCONTROL
+# Reverse lookup built once. Some values have more than one name (DEBUG and CANTSEND).
+qpNames = {value: [name for name,val in qpStates.items() if val == value] for value in set(qpStates.values())}
 
 SECRETS = '/qctrl.secret'
 
 WHATISNEXT_WAIT = 2 #in seconds
-packetBuffer = [] #TODO Possibly remove for flight. Not really an issue. used for debugging
+CHUNK_RX_TRIGGER = SC16IS750.FCR_RX_TRIGGER_56_BYTES # Chunks are picked up by the RX timeout interrupt
+BULK_RX_TRIGGER = SC16IS750.FCR_RX_TRIGGER_16_BYTES # Interrupt early so the frame can be drained as it streams in
+BULK_FRAME_TIMEOUT = .05 # in seconds. How long a bulk frame may stall before handing off what we have.
+RX_WORKER_IDLE = .5 # in seconds. How often the RX worker and the main loop check for shutdown when the WTC is quiet.
+packetBuffer = None # PacketBuffer() set up by run(). Holds data from the RX worker until the main loop dispatches it.
+protocol = None # ProtocolState() set up by run().
 # Routing ID defined in packet structure document
 validRoutes = (0x01,0x02,0x54) # Pi1, Pi2, Gnd, WTC, Dev
 # Add commands to the map. Format is "String to recognize for command" : function name
@@ -58,8 +71,46 @@ COMMANDS = {
 	b'up': 	cmd.upReq,
 	b'is':	cmd.immediateShutdown,
 	b'hb':  cmd.runHandbrake,
-	b'se':	cmd.startExperiment
+	b'se':	cmd.startExperiment,
+	b'bt':	cmd.batch,
+	b'mc':	cmd.macro,
+	b'lg':	cmd.logLevel,
+	b'lq':	cmd.logQuery,
+	b'lt':	cmd.logTailSend,
+	b'la':	cmd.logTailAck,
+	b'tm':	cmd.telemetry,
+	b'ts':	cmd.timeSeries,
+	b'tr':	cmd.trace
 }
+# Commands that run on the executor instead of the interpreter thread: (resource class, how many may run at once).
+# Commands not listed here are quick or change state the next packet depends on, so they run inline.
+COMMAND_RESOURCES = {
+	b'st':	(ex.LIGHT, 1),
+	b'ls':	(ex.DISK, 2),
+	b'dl':	(ex.DISK, 2),
+	b'mv':	(ex.DISK, 1),
+	b'te':	(ex.DISK, 1),
+	b'tc':	(ex.DISK, 1),
+	b'dr':	(ex.DISK, 1),
+	b'df':	(ex.DISK, 1),
+	b'sv':	(ex.CPU, 1),
+	b'cv':	(ex.CPU, 1),
+	b'hb':	(ex.CPU, 1),
+	b'se':	(ex.GPIO, 1),
+	b'bt':	(ex.BATCH, 1), # In their own class so a long batch or macro never holds the worker st needs
+	b'mc':	(ex.BATCH, 1),
+	b'lq':	(ex.DISK, 1),
+	b'lt':	(ex.DISK, 1),
+	b'ts':	(ex.DISK, 1),
+	b'tr':	(ex.DISK, 1) # A dump can take a while
+}
+# Commands that are always run again when re-sent: status must be fresh, shutdown needs two packets,
+# a download's data packets come from the Transmitter, not the command's response, and a log tail
+# starts again from what ground has acknowledged.
+REPLAY_EXCLUDED = (b'st', b'is', b'df', b'lt')
+# Commands a batch record or macro step may not run: another batch or macro, and the inline commands that
+# change what the next packet means (up) or must come from ground itself (is).
+BATCH_EXCLUDED = (b'bt', b'mc', b'up', b'is')
 
 class LastCommand():
 	"""
@@ -78,6 +129,358 @@ class LastCommand():
 		LastCommand.fromWhom = c
 		LastCommand.commandCount += 1
 
+# The interpreter's metrics (see qpaceMetrics).
+packetsIn = qpaceMetrics.counter('interpreter.packetsIn')
+packetsOut = qpaceMetrics.counter('interpreter.packetsOut')
+dummyPackets = qpaceMetrics.counter('interpreter.dummyPackets')
+corruptPackets = qpaceMetrics.counter('interpreter.corruptPackets') # Unknown opcode, bad route or bad checksum
+badTags = qpaceMetrics.counter('interpreter.badTags')
+nvalSent = qpaceMetrics.counter('interpreter.nvalSent') # Packets answered with ~NVAL
+busySent = qpaceMetrics.counter('interpreter.busySent') # Commands answered with ~BUSY
+handshakeMs = qpaceMetrics.histogram('interpreter.handshakeMs', qpaceMetrics.LATENCY_MS) # WHATISNEXT until the WTC answers
+qpaceMetrics.gauge('interpreter.dummyPercent', lambda: 100 * dummyPackets.value() // max(packetsOut.value(), 1))
+qpaceMetrics.gauge('interpreter.commands', lambda: LastCommand.commandCount)
+
+class LinkRecovery():
+	"""
+	Brings the WTC link back in place after an I2C error so a bus glitch doesn't throw away the queues,
+	upload state and schedule. Recovery is retried with exponential backoff and the script is only
+	restarted after RECOVERY_ATTEMPTS_MAX failures in a row.
+
+	"""
+	RECOVERY_ATTEMPTS_MAX = 6
+	RECOVERY_BACKOFF = .005 # in seconds. Doubles after every failed attempt.
+	RECOVERY_SETTLE = .25 # in seconds. Errors this soon after a recovery are from the same glitch.
+	errors = 0
+	recoveries = 0
+	lastRecovery = 0
+	lastError = None
+	lock = threading.Lock()
+
+	@staticmethod
+	def recover(chip, logger, error = None):
+		"""
+		Recover the link to the SC16IS740 after an I2C error.
+
+		Parameters:
+		chip - SC16IS750.SC16IS750() - the chip that raised the error
+		logger - qpaceLogger.Logger() - for logging
+		error - the exception that was raised, if any
+
+		Returns: True if the link is back up. Does not return if the script had to be restarted.
+
+		Raises: None
+		"""
+		with LinkRecovery.lock:
+			LinkRecovery.errors += 1
+			LinkRecovery.lastError = str(error)
+			if time.time() - LinkRecovery.lastRecovery < LinkRecovery.RECOVERY_SETTLE:
+				return True
+			logger.logWarning('LinkRecovery: Bus error <{}>. Recovering the WTC link.'.format(error))
+			backoff = LinkRecovery.RECOVERY_BACKOFF
+			start = time.time()
+			for attempt in range(1, LinkRecovery.RECOVERY_ATTEMPTS_MAX + 1):
+				try:
+					if chip.recover():
+						# The chip dropped both FIFOs, so a partly received frame can not be finished.
+						fh.ChunkPacket.setBulkMode(fh.ChunkPacket.bulkMode)
+						LinkRecovery.recoveries += 1
+						LinkRecovery.lastRecovery = time.time()
+						logger.logSystem('LinkRecovery: Link recovered in {:.1f}ms after {} attempt(s).'.format(1000 * (LinkRecovery.lastRecovery - start), attempt))
+						return True
+					logger.logWarning('LinkRecovery: Attempt {} did not restore the chip configuration.'.format(attempt))
+				except Exception as e:
+					logger.logWarning('LinkRecovery: Attempt {} failed <{}>.'.format(attempt, e))
+				time.sleep(backoff)
+				backoff *= 2
+			logger.logError('LinkRecovery: Could not recover the WTC link after {} attempts. Restarting.'.format(LinkRecovery.RECOVERY_ATTEMPTS_MAX))
+			qpaceLogger.restart_script()
+			return False
+
+class CallbackSwitch(threading.Event):
+	"""
+	threading.Event() used as the disableCallback flag. .set() suspends the RX worker and .clear() resumes it.
+	Listeners are told about every change as it happens so nothing has to poll the flag.
+	.set() waits for a drain that is already running to finish, so once it returns the RX FIFO
+	belongs to the caller.
+
+	"""
+	def __init__(self):
+		threading.Event.__init__(self)
+		self.gate = threading.RLock() # Held by the RX worker while it drains the FIFO.
+		self.listeners = []
+
+	def addListener(self, listener):
+		"""
+		Parameters: listener - function(disabled) - called after every .set() or .clear()
+
+		Returns: None
+
+		Raises: None
+		"""
+		self.listeners.append(listener)
+
+	def removeListener(self, listener):
+		try:
+			self.listeners.remove(listener)
+		except ValueError:
+			pass
+
+	def set(self):
+		with self.gate:
+			threading.Event.set(self)
+		for listener in list(self.listeners):
+			listener(True)
+
+	def clear(self):
+		threading.Event.clear(self)
+		for listener in list(self.listeners):
+			listener(False)
+
+class RXSignal():
+	"""
+	Hand off between the pigpio IRQ callback and the RX worker. The callback only counts the edge and
+	notifies; the worker and anything waiting on bytes from the WTC wake on it.
+
+	"""
+	def __init__(self):
+		self.cv = threading.Condition()
+		self.pending = 0 # Edges the worker has not looked at yet
+		self.edges = 0 # Edges seen since the interpreter started
+		self.lastTick = None
+
+	def irq(self, gpio, level, tick):
+		qpaceTracer.instant('irq' if gpio is not None else 'kick', 'interpreter')
+		with self.cv:
+			self.pending += 1
+			self.edges += 1
+			self.lastTick = tick
+			self.cv.notify_all()
+
+	def kick(self):
+		"""
+		Wake the worker without an edge. Used when the callback is re-enabled since the IRQ line stays
+		low until the FIFO is read and would not fall again on its own.
+		"""
+		self.irq(None, None, None)
+
+	def take(self, timeout = None):
+		"""
+		Wait for an edge the worker has not seen yet.
+
+		Parameters: timeout - seconds to wait. None waits forever.
+
+		Returns: True if there was an edge. False on timeout.
+
+		Raises: None
+		"""
+		with self.cv:
+			if not self.pending:
+				self.cv.wait(timeout)
+			pending = self.pending
+			self.pending = 0
+			return pending > 0
+
+	def wait(self, since, timeout):
+		"""
+		Wait for an edge without taking it from the worker.
+
+		Parameters:
+		since - value of self.edges read before the caller last checked the chip, so an edge that came in
+				between that check and this call is not missed
+		timeout - seconds to wait
+
+		Returns: True if an edge came in before timeout.
+		"""
+		with self.cv:
+			return self.cv.wait_for(lambda: self.edges != since, timeout)
+
+class PacketBuffer():
+	"""
+	Thread safe FIFO between the RX worker and the interpreter's main loop. The main loop blocks on it
+	instead of sleeping, and every item is stamped when it comes in so the time it waited before being
+	dispatched can be reported.
+
+	"""
+	DISPATCH_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1) # in seconds
+
+	def __init__(self):
+		self.cv = threading.Condition()
+		self.items = deque()
+		self.started = time.time()
+		self.count = 0
+		self.total = 0
+		self.max = 0
+		self.histogram = [0] * (len(PacketBuffer.DISPATCH_BUCKETS) + 1)
+
+	def __len__(self):
+		return len(self.items)
+
+	def append(self, data):
+		"""
+		Add data from the WTC and wake the main loop.
+
+		Parameters: data - bytes read from the SC16IS740
+
+		Returns: None
+
+		Raises: None
+		"""
+		with self.cv:
+			self.items.append((time.time(), data))
+			self.cv.notify_all()
+
+	def waitForData(self, timeout):
+		"""
+		Block until there is data or timeout passes.
+
+		Returns: True if there is data to dispatch.
+		"""
+		with self.cv:
+			return self.cv.wait_for(lambda: len(self.items) > 0, timeout)
+
+	def pop(self):
+		"""
+		Take the oldest data out of the buffer and record how long it waited.
+
+		Returns: the data, or None if the buffer is empty.
+		"""
+		with self.cv:
+			if not self.items:
+				return None
+			stamp, data = self.items.popleft()
+			waited = time.time() - stamp
+			self.count += 1
+			self.total += waited
+			self.max = max(self.max, waited)
+			self.histogram[bisect.bisect_left(PacketBuffer.DISPATCH_BUCKETS, waited)] += 1
+			return data
+
+	def clear(self):
+		with self.cv:
+			self.items.clear()
+
+	def snapshot(self):
+		"""
+		Returns: dict with the ingest to dispatch latency (count, mean, max and histogram over DISPATCH_BUCKETS)
+				 and how much is still waiting.
+		"""
+		with self.cv:
+			return {'uptime': time.time() - self.started, 'waiting': len(self.items), 'count': self.count,
+					'mean': self.total / self.count if self.count else 0, 'max': self.max,
+					'histogram': list(self.histogram), 'buckets': PacketBuffer.DISPATCH_BUCKETS}
+
+	@staticmethod
+	def format(snapshot):
+		return 'Dispatch: {} items, {} waiting, mean={:.3f}ms max={:.3f}ms hist={}'.format(
+			snapshot['count'], snapshot['waiting'], 1000 * snapshot['mean'], 1000 * snapshot['max'], snapshot['histogram'])
+
+class ProtocolState():
+	"""
+	Explicit state of the WTC protocol as pseudoStateMachine sees it, with counters and timing for every state,
+	transition and control byte so protocol problems show up in the status file.
+
+	States:
+	IDLE - waiting for control bytes or the start of a packet
+	AWAITING_TIMESTAMP - TIMESTAMP was received; the next 4 bytes set the clock
+	AWAITING_RESPONSE - the Pi asked for SOLON/STEPON and is waiting for ACCEPTED/DENIED/PENDING
+	IN_TRANSFER - part of a packet upload has been received
+
+	"""
+	IDLE = 'IDLE'
+	AWAITING_TIMESTAMP = 'AWAITING_TIMESTAMP'
+	AWAITING_RESPONSE = 'AWAITING_RESPONSE'
+	IN_TRANSFER = 'IN_TRANSFER'
+	STATES = (IDLE, AWAITING_TIMESTAMP, AWAITING_RESPONSE, IN_TRANSFER)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.state = ProtocolState.IDLE
+		self.since = time.time()
+		self.entered = {state: 0 for state in ProtocolState.STATES}
+		self.timeIn = {state: 0 for state in ProtocolState.STATES}
+		self.transitions = {} # 'FROM>TO': count
+		self.handled = {} # control name: [count, total seconds, max seconds]
+		self.unknown = 0
+
+	def enter(self, state):
+		"""
+		Move to state and account for the time spent in the old one.
+
+		Parameters: state - one of ProtocolState.STATES
+
+		Returns: None
+
+		Raises: None
+		"""
+		with self.lock:
+			if state == self.state:
+				return
+			now = time.time()
+			self.timeIn[self.state] += now - self.since
+			key = '{}>{}'.format(self.state, state)
+			self.transitions[key] = self.transitions.get(key, 0) + 1
+			self.entered[state] += 1
+			self.state = state
+			self.since = now
+
+	def transfer(self, inProgress):
+		"""
+		Track packet uploads. Only moves between IDLE and IN_TRANSFER so a chunk can't cancel a wait
+		for the timestamp or a response.
+
+		Parameters: inProgress - True if part of a packet is waiting for the rest of it
+
+		Returns: None
+
+		Raises: None
+		"""
+		if self.state in (ProtocolState.IDLE, ProtocolState.IN_TRANSFER):
+			self.enter(ProtocolState.IN_TRANSFER if inProgress else ProtocolState.IDLE)
+
+	def record(self, name, seconds):
+		"""
+		Count a control byte and how long its handler took.
+
+		Parameters:
+		name - the QPCONTROL name(s) of the byte. None if the byte is not a QPCONTROL value.
+		seconds - time spent in the handler
+
+		Returns: None
+
+		Raises: None
+		"""
+		with self.lock:
+			if name is None:
+				self.unknown += 1
+				return
+			entry = self.handled.setdefault(name, [0, 0, 0])
+			entry[0] += 1
+			entry[1] += seconds
+			entry[2] = max(entry[2], seconds)
+
+	def snapshot(self):
+		"""
+		Returns: dict with the current state, entries and seconds spent per state, transition counts,
+				 per control byte (count, mean, max) and how many unknown bytes came in.
+		"""
+		with self.lock:
+			timeIn = dict(self.timeIn)
+			timeIn[self.state] += time.time() - self.since
+			return {'state': self.state, 'entered': dict(self.entered), 'timeIn': timeIn,
+					'transitions': dict(self.transitions), 'unknown': self.unknown,
+					'handled': {name: {'count': entry[0], 'mean': entry[1] / entry[0], 'max': entry[2]} for name, entry in self.handled.items()}}
+
+	@staticmethod
+	def format(snapshot):
+		lines = ['Protocol: {} ({} unknown bytes)'.format(snapshot['state'], snapshot['unknown'])]
+		for state in ProtocolState.STATES:
+			lines.append('  {:<18} entered={:<6} time={:.1f}s'.format(state, snapshot['entered'][state], snapshot['timeIn'][state]))
+		lines.append('  transitions: {}'.format(snapshot['transitions'] or 'none'))
+		for name, entry in sorted(snapshot['handled'].items()):
+			lines.append('  {:<18} n={:<6} mean={:.3f}ms max={:.3f}ms'.format(name, entry['count'], 1000 * entry['mean'], 1000 * entry['max']))
+		return '\n'.join(lines)
+
 def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disableCallback, logger):
 	logger.logInfo("Entered: run")
 	cmd.setExperimentEvent(experimentEvent)
@@ -92,7 +495,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 	experimentEvent	- threading.Event() - Will be .set() if there's an experient running
 	runEvent	- threading.Event() - Will be .clear() if we need to pause the thread for any reason
 	shutdownEvent	- threading.Event() - will be .set() if we need to shutdown the Pi. All threads must respond to this immediately.
-	disableCallback	- threading.Event() - will be .set() if we want to disable the callback. .clear() will resume callback
+	disableCallback	- CallbackSwitch() - will be .set() if we want to disable the callback. .clear() will resume callback
 	logger	- qpaceLogger.Logger() - logging module object for logging module data
 
 	Returns:None
@@ -120,17 +523,16 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		logger.logError('Interpreter: Unable to import keys. XTEA Decoding is disabled.',e)
 
 	try:
-		# Initialize the pins
-		gpio = pigpio.pi()
+		# Initialize the pins. Share the chip's pigpio connection so the IRQ and the I2C bus go through the same daemon.
+		gpio = chip.pi
 		gpio.set_mode(CCDR_IRQ, pigpio.INPUT)
 	except NameError:
 		logger.logError('PIGPIO is not defined. Unable to set interrupt')
 		gpio = None
 
-	configureTimestamp = False
-
-	global packetBuffer #TODO Possibly remove for flight. Not really an issue used for debugging
-	packetBuffer = []
+	global packetBuffer, protocol
+	packetBuffer = PacketBuffer()
+	protocol = ProtocolState()
 	callback = None
 
 	checker = tagChecker.TagChecker()
@@ -144,13 +546,24 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 	cmd.nextQueue = nextQueue
 	cmd.shutdownEvent = shutdownEvent
 	cmd.tagChecker = checker
+	cmd.chip = chip
+	executor = ex.CommandExecutor(logger)
+	cmd.executor = executor
+	replayCache = ReplayCache()
+	cmd.replayCache = replayCache
+	aggregator = ResponseAggregator(packetQueue)
+	cmd.aggregator = aggregator
+	logTail = LogTail(logger)
+	cmd.logTail = logTail
 	lastPacketsSent = []
 	logger.logInfo("Exited: run")
 
+	rxSignal = RXSignal()
+
 	def WTCRXBufferHandler(gpio,level,tick):
-		logger.logInfo("Entered: WTCRXBufferHandler")
 		"""
-		Callback method run by pigpio to handle data when the interrupt pin is fired. May be disabled and recreated at any time
+		Callback method run by pigpio when the interrupt pin falls. Runs in pigpio's callback thread so it does
+		no bus or log work of its own, it only wakes the RX worker.
 
 		Parameters: gpio, level, tick - required by pigpio
 
@@ -159,30 +572,16 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		Raises: None
 
 		"""
-		try:
-			packetData = chip.block_read(SC16IS750.REG_RHR,chip.byte_read(SC16IS750.REG_RXLVL))
-		except:
-			logger.logError("I2C READ FAILED")
-			__, _, exc_traceback = sys.exc_info()
-			logger.logError(exc_traceback)
-			return
-
-		#This segment of code is used twice, it is read off for states and for packets,
-		#its use in both causes a race condition where the added data is read with the packet
-		#short solution is to modify when trying to build packet
-		#logger.logResults("Data came in: ", packetData)
-		logger.logResults("Data came in: ", ''.join(map(chr, packetData)))
-		packetBuffer.append(packetData)
-		logger.logInfo("Exited: WTCRXBufferHandler")
-
-	def callbackHandler(disableCallback,shutdownEvent):
-		logger.logInfo("Entered: callbackHandler")
-		"""
-		Gets its own thread. Monitors the disableCallback Event and if it is ever .set(), the callback gets disabled
-		re-enable to callback by .clear()
+		rxSignal.irq(gpio,level,tick)
+
+	def rxWorker(disableCallback,shutdownEvent):
+		logger.logInfo("Entered: rxWorker")
+		"""
+		Gets its own thread. Drains the SC16IS740 RX FIFO into the packetBuffer every time the IRQ fires.
+		While disableCallback is .set() the FIFO is left alone so the caller can read the WTC's response itself.
 
 		Parameters:
-		disableCallback - threading.Event() - If .set() disable callback. If .clear() enable callback
+		disableCallback - CallbackSwitch() - If .set() leave the FIFO alone. If .clear() drain it.
 		shutdownEvent - threading.Event() - If .set() exit immediately and prepare pi for shutdown.
 
 		Returns: None
@@ -190,29 +589,68 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		Raises:None
 
 		"""
-		if gpio:
-			callBackIsSet=True
-			callback = gpio.callback(CCDR_IRQ, pigpio.FALLING_EDGE, WTCRXBufferHandler)
-			logger.logSystem('Interpreter: Callback active. Waiting for data from the SC16IS750.')
-			while not shutdownEvent.is_set():
-				time.sleep(.12)
-				if callBackIsSet and disableCallback.is_set(): # If the callback is running and we want to disable it, cancel it.
-					callback.cancel()
-					callBackIsSet = False
-					logger.logSystem('Interpreter: Callback Disabled.')
-				if not callBackIsSet and not disableCallback.is_set(): # If the callback is not running and we want to not disable it, start it up again.
-					callback = gpio.callback(CCDR_IRQ, pigpio.FALLING_EDGE, WTCRXBufferHandler)
-					callBackIsSet = True
-					logger.logSystem('Interpreter: Callback Enabled.')
-			if callBackIsSet:
-				callback.cancel()
-		else:
-			logger.logSystem("Interpreter: Callback is not active. PIGPIO was not defined.")
-		logger.logInfo("Exited: callbackHandler")
+		while not shutdownEvent.is_set():
+			if not rxSignal.take(timeout=RX_WORKER_IDLE):
+				continue
+			with disableCallback.gate:
+				if disableCallback.is_set():
+					continue
+				try:
+					with qpaceTracer.span('drainRX', 'interpreter') as span:
+						if fh.ChunkPacket.bulkMode:
+							# In bulk mode anything longer than a control byte is a packet. Drain the rest of it now
+							# so the whole frame is handed off at once.
+							packetData = chip.drain_rx(fh.DataPacket.max_size)
+							if len(packetData) > 1:
+								packetData += chip.read_frame(fh.DataPacket.max_size - len(packetData), BULK_FRAME_TIMEOUT)
+						else:
+							packetData = chip.drain_rx()
+						span.set(bytes = len(packetData))
+				except Exception as e:
+					logger.logError("Interpreter: Read from the SC16IS740 failed.", e)
+					LinkRecovery.recover(chip, logger, e)
+					continue
+			if not packetData:
+				continue
+
+			#This segment of code is used twice, it is read off for states and for packets,
+			#its use in both causes a race condition where the added data is read with the packet
+			#short solution is to modify when trying to build packet
+			#logger.logResults("Data came in: ", packetData)
+			logger.logResults("Data came in: %s", packetData)
+			packetBuffer.append(packetData)
+		logger.logInfo("Exited: rxWorker")
+
+	def callbackChanged(disabled):
+		"""
+		Listener on disableCallback. The pigpio callback stays registered the whole time so a response the WTC
+		sends while the worker is suspended still wakes waitForBytesFromCCDR.
+
+		Parameters: disabled - bool - True if the callback was just disabled.
+
+		Returns: None
+
+		Raises: None
 
-	# Start up the thread for the callbackHandler
-	cb_hndlr=threading.Thread(name='callbackHandler',target=callbackHandler,args=(disableCallback,shutdownEvent))
-	cb_hndlr.start()
+		"""
+		if disabled:
+			logger.logSystem('Interpreter: Callback Disabled.')
+		else:
+			logger.logSystem('Interpreter: Callback Enabled.')
+			rxSignal.kick() # Pick up anything that came in while we were suspended.
+
+	if gpio:
+		callback = gpio.callback(CCDR_IRQ, pigpio.FALLING_EDGE, WTCRXBufferHandler)
+		logger.logSystem('Interpreter: Callback active. Waiting for data from the SC16IS750.')
+	else:
+		logger.logSystem("Interpreter: Callback is not active. PIGPIO was not defined.")
+	if isinstance(disableCallback, CallbackSwitch):
+		disableCallback.addListener(callbackChanged)
+
+	# Start up the thread for the rxWorker
+	rx_wrkr=threading.Thread(name='rxWorker',target=rxWorker,args=(disableCallback,shutdownEvent))
+	rx_wrkr.start()
+	rxSignal.kick() # Anything already waiting in the FIFO will not cause another edge.
 
 	def decodeXTEA(packetData):
 		logger.logInfo("Entered: decodeXTEA")
@@ -249,6 +687,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		return header + bytes(information) + footer
 		logger.logInfo("Exited: decodeXTEA")
 
+	@qpaceTracer.traced('decodePacket', 'interpreter')
 	def decodePacket(packetData):
 		logger.logInfo("Entered: decodePacket")
 		"""
@@ -265,10 +704,10 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		# Magic numbers defined in Packet Specification Document
 		try:
 			logger.logResults("--packet information:")
-			logger.logResults("--routing ID {}".format(packetData[0]))
-			logger.logResults("--opcode {}".format(packetData[1:6]))
-			logger.logResults("--content {}".format(packetData[6:124]))
-			logger.logResults("--checksum {}".format(packetData[124:]))
+			logger.logResults("--routing ID %s", packetData[0])
+			logger.logResults("--opcode %s", packetData[1:6])
+			logger.logResults("--content %s", packetData[6:124])
+			logger.logResults("--checksum %s", packetData[124:])
 
 			if packetData[1:6] == b'NOOP*':
 				logger.logInfo("NORM packet type")
@@ -327,6 +766,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 			return packet #based on packet definition document
 		logger.logInfo("Exited: decodePacket")
 
+	@qpaceTracer.traced('processIncomingPacketData', 'interpreter')
 	def processIncomingPacketData(chip, fieldData):
 		logger.logInfo("Entered: processIncomingPacketData")
 		"""
@@ -344,7 +784,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		if fh.UploadRequest.isActive():
 			if fieldData['noop'] == b'NOOP!':
 				match,who = fh.Scaffold.finish(fieldData['information'])
-				logger.logSystem('UploadRequest: Upload Request has been cleared for {}'.format(who))
+				logger.logSystem('UploadRequest: Upload Request has been cleared for %s', who)
 				if match:
 					Command.PrivilegedPacket(plainText=fieldData['pid'] + b'GOOD' + Command.PrivilegedPacket.returnRandom(86)).send()
 					logger.logSystem('Interpreter: The Upload was successful')
@@ -358,6 +798,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 				logger.logSystem("Interpreter: A packet is interpreted as data, but its opcode isn't correct.")
 		logger.logInfo("Exited: processIncomingPacketData")
 
+	@qpaceTracer.traced('processCommand', 'interpreter')
 	def processCommand(chip, fieldData, fromWhom = 'WTC'):
 		logger.logInfo("Entered: processCommand")
 		"""
@@ -372,11 +813,41 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		"""
 		if fieldData:
 			arguments = fieldData['information'] #These are bytes objects
-			logger.logSystem("Interpreter: Command Received! <{}>".format(fieldData['command']))
+			logger.logSystem("Interpreter: Command Received! <%s>", fieldData['command'])
 			LastCommand.set(fieldData['command'].decode('ascii'), str(datetime.datetime.now()), fromWhom)
-			COMMANDS[fieldData['command']](logger,arguments) # Run the command
+			function, jobArgs = COMMANDS[fieldData['command']], (logger,arguments)
+			if fieldData['command'] not in REPLAY_EXCLUDED:
+				key = ReplayCache.key(fieldData['command'], arguments, fieldData['tag'])
+				run, packets = replayCache.begin(key)
+				if not run:
+					# Ground re-sent a command we already ran. Send back what it sent the first time.
+					if packets is None:
+						logger.logSystem("Interpreter: <%s> was re-sent while it is still running. Ignoring it.", fieldData['command'])
+					else:
+						logger.logSystem("Interpreter: <%s> was re-sent. Replaying %d response packet(s).", fieldData['command'], len(packets))
+						for packet in packets:
+							packetQueue.enqueue(packet)
+					logger.logInfo("Exited: processCommand")
+					return
+				function, jobArgs = replayCache.run, (key, function) + jobArgs
+			if fieldData['command'] in COMMAND_RESOURCES:
+				resource, limit = COMMAND_RESOURCES[fieldData['command']]
+				# The command sends its own response when the job finishes.
+				if executor.submit(fieldData['command'].decode('ascii'), function, jobArgs, resource, limit) is None:
+					logger.logError("Interpreter: Command executor is full. <{}> was dropped.".format(fieldData['command']))
+					if fieldData['command'] not in REPLAY_EXCLUDED:
+						replayCache.release(key)
+					busyPacket = fh.DummyPacket()
+					busyPacket.rid = b'\x00'
+					busyPacket.opcode = b'~BUSY' # Executor full -- OP can only be 5-byte
+					busySent.inc()
+					packetQueue.enqueue(busyPacket.build())
+			else:
+				with qpaceTracer.span(fieldData['command'].decode('ascii'), 'command'):
+					function(*jobArgs) # Run the command
 		logger.logInfo("Exited: processCommand")
 
+	@qpaceTracer.traced('checkValidity', 'interpreter')
 	def checkValidity(fieldData, packetData):
 		logger.logInfo("Entered: checkValidity")
 		"""
@@ -397,18 +868,25 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 			if fieldData['TYPE'] == 'UNKNOWN':
 				isValid = False
 				fieldData = None
+				corruptPackets.inc()
 			else:
 				packetString = bytes([fieldData['route']]) + fieldData['opcode'] + fieldData['contents']
 				isValid = fieldData['route'] in validRoutes and fieldData['checksum'] == generateChecksum(packetData[:-4])
+				if not isValid:
+					corruptPackets.inc()
 
 			if fieldData['TYPE'] == 'DATA':
 				pass
 			elif fieldData['TYPE'] == 'NORM':
 				#print("The tag of this packet is", fieldData['tag'].decode("utf-8"))
 				#print("FEILD DATA TAG:", fieldData['tag'])
-				validTag =  checker.isValidTag(fieldData['tag'])
+				if isValid and fieldData['command'] not in REPLAY_EXCLUDED and replayCache.contains(ReplayCache.key(fieldData['command'], fieldData['information'], fieldData['tag'])):
+					validTag = True # A retry of a command we already ran. Its tag was used up by the first copy.
+				else:
+					validTag =  checker.isValidTag(fieldData['tag'])
 				if isValid and not validTag:
 					logger.logSystem('Interpreter: A valid packet came in, but the tag was wrong. The packet is being dropped.')
+					badTags.inc()
 				isValid = isValid and validTag
 
 			elif fieldData['TYPE'] == 'DLACK':
@@ -420,6 +898,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		logger.logInfo("Exited: checkValidity")
 		return isValid, fieldData
 
+	@qpaceTracer.traced('wtc_respond', 'interpreter')
 	def wtc_respond(response):
 		logger.logInfo("Entered: wtc_respond")
 		"""
@@ -433,17 +912,24 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 
 		"""
 		if response in qpStates:
-			logger.logResults('Sending to WTC: \'{}\' ({})'.format(response, response))
-			chip.byte_write(SC16IS750.REG_THR,qpStates[response])
-		elif response is not None:
+			logger.logResults('Sending to WTC: \'%s\' (%s)', response, response)
+			response = qpStates[response]
+		if response is not None:
 			if isinstance(response,int):
 				response = bytes([response])
 			try:
 				chip.write(response)
-			except:
-				logger.logError("=======================\nI2C WRITE ERROR OCCURRED=======================\n")
+			except Exception as e:
+				logger.logError("Interpreter: Write to the SC16IS740 failed.", e)
+				# Send it again once the link is back. The WTC is still waiting on it.
+				if LinkRecovery.recover(chip, logger, e):
+					try:
+						chip.write(response)
+					except Exception as e:
+						logger.logError("Interpreter: Write to the SC16IS740 failed after recovery.", e)
 		logger.logInfo("Exited: wtc_respond")
 
+	@qpaceTracer.traced('sendPacketToWTC', 'interpreter')
 	def sendPacketToWTC():
 		logger.logInfo("Entered: sendPacketToWTC")
 		"""
@@ -457,12 +943,14 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 
 		"""
 		nextPacket = packetQueue.dequeue()
+		packetsOut.inc()
 		if nextPacket:
 			logger.logInfo("--Response with next packet")
 			wtc_respond(nextPacket)
 			lastPacketsSent.append(nextPacket)
 		else:
 			logger.logInfo("--Response with dummy packet")
+			dummyPackets.inc()
 			dummy = fh.DummyPacket().build()
 			wtc_respond(dummy)
 			lastPacketsSent.append(dummy)
@@ -471,16 +959,18 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 	def waitForBytesFromCCDR(chip,n,timeout = 2.5,interval = 0.25):
 		logger.logInfo("Entered: waitForBytesFromCCDR")
 		"""
-		Returns true when the number of bytes in the buffer is equal to n
+		Returns true when there are at least n bytes in the buffer
 		Returns false when timeout occurs
 
+		Wakes on the IRQ instead of sleeping, so the bytes are seen as soon as the chip reports them.
+
 		Parameters
 		----------
 		chip - SC16IS750 Object
 		n - int - How many bytes to wait for.
 		timeout - int - How long in seconds to wait for those bytes. DEFAULT 2.5s
 						If timeout is None or 0, check without a timeout.
-		interval - int - How often to check if N bytes are in the buffer. DEFAULT .25s
+		interval - int - Longest time to go without checking RXLVL in case an edge was missed. DEFAULT .25s
 
 		Returns
 		-------
@@ -491,131 +981,190 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		------
 		Any exception gets poppuped up the stack.
 		"""
-		if interval > timeout:
-			interval = .25
-		total_attempts = timeout//interval
-		attempts = 0
-		if timeout:
-			logger.logInfo("--Response with next packet")
-			while(attempts < total_attempts and chip.byte_read(SC16IS750.REG_RXLVL) is not n):
-				time.sleep(interval)
-				attempts += 1
-
-			if attempts >= total_attempts:
-				logger.logInfo("Exited: waitForBytesFromCCDR")
-				return False
-		else:
-			while(chip.byte_read(SC16IS750.REG_RXLVL) < n):
-				time.sleep(interval)
+		deadline = time.time() + timeout if timeout else None
+		while True:
+			edges = rxSignal.edges
+			if chip.byte_read(SC16IS750.REG_RXLVL) >= n:
+				break
+			wait = interval
+			if deadline is not None:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					logger.logInfo("Exited: waitForBytesFromCCDR")
+					return False
+				wait = min(wait, remaining)
+			rxSignal.wait(edges, wait)
 		logger.logInfo("Exited: waitForBytesFromCCDR")
 		return True
 
-	def pseudoStateMachine(packetData,configureTimestamp,nextQueue):
-		logger.logInfo("Entered: Psuedo State Machine")
+	def configureTimestamp(packetData):
+		"""
+		Set the clock from the 4 byte timestamp the WTC sends after TIMESTAMP and echo it back.
+
+		Parameters: packetData - the 4 bytes from the WTC
+
+		Returns: None
+
+		Raises: Any exception gets popped up the stack.
+		"""
+		timestamp = int.from_bytes(packetData,byteorder='little')
+		logger.logSystem('PseudoSM: Configuring the timestamp.')
+		os.system("sudo date -s '@" + str(timestamp) +"'")
+		chip.block_write(SC16IS750.REG_THR,packetData)
+		protocol.enter(ProtocolState.IDLE)
+		logger.setBoot(newTimestamp=timestamp)
+		logger.logSystem('Timestamp: %s', timestamp)
+
+	def handleNoop(byte):
+		logger.logSystem('PseudoSM: NOOP.')
+		wtc_respond('DONE')
+
+	def handleShutdown(byte):
+		logger.logSystem('PseudoSM: Shutdown was set!')
+		wtc_respond('DONE')
+		shutdownEvent.set()	# Set for shutdown
+
+	def handleReboot(byte):
+		logger.logSystem('PseudoSM: Reboot was set!')
+		wtc_respond('DONE')
+		shutdownEvent.set() # Set for shutdown
+
+	def handleTimestamp(byte):
+		print("Test: We got the timestamp from the WTC")
+		logger.logSystem('PseudoSM: TIMESTAMP from WTC.')
+		wtc_respond('TIMESTAMP')
+		# Yo, configure the timestamp after this
+		protocol.enter(ProtocolState.AWAITING_TIMESTAMP)
+		logger.clearBoot()
+
+	def handleWhatIsNext(byte):
+		next = nextQueue.peek()
+
+		idle = not next and not packetQueue.peek() and not aggregator.pending()
+		if not next and packetQueue.peek():
+			next = 'SENDPACKET'
+		if not next:
+			next = 'IDLE'
+		awaitResponse = next == qpStates['SOLON'] or next == qpStates['STEPON']
+		if awaitResponse:
+			# Suspend the RX worker before asking so it can't take the WTC's answer.
+			disableCallback.set()
+		wtc_respond(next) # Respond with what the Pi would like the WTC to know.
+		if awaitResponse:
+			protocol.enter(ProtocolState.AWAITING_RESPONSE)
+			try:
+				# Wait for a response from the WTC.
+				logger.logSystem('PseudoSM: Waiting %ss for a response from WTC', WHATISNEXT_WAIT)
+				started = time.monotonic()
+				if waitForBytesFromCCDR(chip,1,timeout=WHATISNEXT_WAIT): # Wait for 15s for a response from the WTC
+					handshakeMs.observe((time.monotonic() - started) * 1000)
+					response = chip.byte_read(SC16IS750.REG_RHR)
+					# THIS IS A BLOCKING CALL
+					nextQueue.blockWithResponse(response,timeout=1) # Blocking until the response is read or timeout.
+
+					if not nextQueue.isEmpty():
+						# If SENDPACKET was queued, but a BUFFERFUL came in as a response, then dont dequeue the SENDPACKET
+						if (next == 'SENDPACKET' or next == qpStates['SENDPACKET']) and response != qpStates['BUFFERFULL']:
+							nextQueue.dequeue() # After "waiting" for the bytes, dequeue the items.
+			finally:
+				protocol.enter(ProtocolState.IDLE)
+				# If we cancel the callback earlier, re-initialize it here.
+				disableCallback.clear()
+			if next != 'SENDPACKET' and next != qpStates['SENDPACKET']:
+				wtc_respond('DONE') # Always respond with done for an "ACCEPTED or PENDING"
+		if idle and logTail.fillDue():
+			# The link is idle, so it may as well bring down the log. Off this thread, the WTC has its answer already.
+			executor.submit('fill', logTail.fillIdle, (), ex.DISK, 1)
+
+	def handleBulkRX(byte):
+		logger.logSystem('PseudoSM: Switching to bulk RX mode.')
+		chip.set_rx_trigger(BULK_RX_TRIGGER)
+		fh.ChunkPacket.setBulkMode(True)
+		protocol.enter(ProtocolState.IDLE) # Any partial packet was dropped
+		wtc_respond('BULKRX')
+
+	def handleChunkRX(byte):
+		logger.logSystem('PseudoSM: Switching to chunk RX mode.')
+		chip.set_rx_trigger(CHUNK_RX_TRIGGER)
+		fh.ChunkPacket.setBulkMode(False)
+		protocol.enter(ProtocolState.IDLE) # Any partial packet was dropped
+		wtc_respond('CHUNKRX')
+
+	def handleNextPacket(byte):
+		if not packetQueue.peek():
+			aggregator.flush() # The link is free, so held responses would only wait.
+		sendPacketToWTC()
+
+	def handleCantSend(byte):
+		aggregator.clear()
+		packetQueue.clear()
+		wtc_respond('DONE')
+
+	def respondDone(byte):
+		wtc_respond('DONE')
+
+	# Dispatch table for control bytes from the WTC. Built once; values without a handler are logged.
+	controlHandlers = {
+		qpStates['NOOP']:		handleNoop,
+		qpStates['SHUTDOWN']:	handleShutdown,
+		qpStates['REBOOT']:		handleReboot,
+		qpStates['TIMESTAMP']:	handleTimestamp,
+		qpStates['WHATISNEXT']:	handleWhatIsNext,
+		qpStates['BULKRX']:		handleBulkRX,
+		qpStates['CHUNKRX']:	handleChunkRX,
+		qpStates['NEXTPACKET']:	handleNextPacket,
+		qpStates['BUFFERFULL']:	respondDone,
+		qpStates['CANTSEND']:	handleCantSend,
+		qpStates['ACCEPTED']:	respondDone,
+		qpStates['DENIED']:		respondDone,
+		qpStates['PENDING']:	respondDone
+	}
+
+	def pseudoStateMachine(packetData):
 		"""
 		This is a "state machine" that is run every iteration over the data received by the WTC.
-		In reality, it's a glorified switch statement.
+		Control bytes are dispatched through controlHandlers and the protocol state is kept in protocol.
 
 		Parameters
 		----------
 		packetData - the raw input by the WTC.
-		configureTimestamp - Boolean - True: we need to set the timestamp. Should only be true on boot.
-									   False: The timestamp has been set already.
-		nextQueue - qph.Queue - the WHATISNEXT queue. Imperitive for operation.
+
 		Returns
 		-------
 		packetData - if the incoming data is not a control character, return it.
-					 if the incoming data is a control character, return nothing (b'')
-		configureTimestamp - returns it so it can access it later.
+					 if the incoming data is a control character, return nothing (None)
 
 		Raises
 		------
 		Any exception gets popped up the stack.
 		"""
 		# Start looking at a pseduo state machine so WTC code doesn't need to change
-		#Check to see if Pi read 2-bytes for command instead of 1
-		#if len(packetData) == 2: 
-		#	return None, configureTimestamp
-
-		if len(packetData) == 1 or (len(packetData) == 4 and configureTimestamp):
-			byte = int.from_bytes(packetData,byteorder='little')
-			logger.logResults('--Read from WTC: {} ({})'.format([ key for key,val in qpStates.items() if val==byte ], hex(byte)))
-			if len(packetData) == 4:
-				logger.logSystem('PseudoSM: Configuring the timestamp.')
-				os.system("sudo date -s '@" + str(byte) +"'")
-				chip.block_write(SC16IS750.REG_THR,packetData)
-				configureTimestamp = False
-				logger.setBoot(newTimestamp=byte)
-				logger.logSystem('Timestamp: {}'.format(str(byte)))
-			elif byte in qpStates.values():
-				logger.logSystem('PseudoSM: State receieved: {} ({})'.format([ key for key,val in qpStates.items() if val==byte ],hex(byte)))
-				# The byte was found in the list of QPCONTROLs
-				if byte == qpStates['NOOP']:
-					logger.logSystem('PseudoSM: NOOP.')
-					wtc_respond('DONE')
-				elif byte == qpStates['SHUTDOWN']:
-					logger.logSystem('PseudoSM: Shutdown was set!')
-					wtc_respond('DONE')
-					shutdownEvent.set()	# Set for shutdown
-				elif byte == qpStates['REBOOT']:
-					logger.logSystem('PseudoSM: Reboot was set!')
-					wtc_respond('DONE')
-					shutdownEvent.set() # Set for shutdown
-				elif byte == qpStates['TIMESTAMP']:
-					print("Test: We got the timestamp from the WTC")
-					logger.logSystem('PseudoSM: TIMESTAMP from WTC.')
-					wtc_respond('TIMESTAMP')
-					# Yo, configure the timestamp after this
-					configureTimestamp = True
-					logger.clearBoot()
-				elif byte == qpStates['WHATISNEXT']:
-					next = nextQueue.peek()
-
-					if not next and packetQueue.peek():
-						next = 'SENDPACKET'
-					if not next:
-						next = 'IDLE'
-					wtc_respond(next) # Respond with what the Pi would like the WTC to know.
-					if next == qpStates['SOLON'] or next == qpStates['STEPON']:
-						# Wait for a response from the WTC.
-						logger.logSystem('PseudoSM: Waiting {}s for a response from WTC'.format(WHATISNEXT_WAIT))
-						# Possibly might need to cancel the callback and restart it here.
-						disableCallback.set()
-						if waitForBytesFromCCDR(chip,1,timeout=WHATISNEXT_WAIT): # Wait for 15s for a response from the WTC
-							response = chip.byte_read(SC16IS750.REG_RHR)
-							# THIS IS A BLOCKING CALL
-							nextQueue.blockWithResponse(response,timeout=1) # Blocking until the response is read or timeout.
-
-							if not nextQueue.isEmpty():
-								# If SENDPACKET was queued, but a BUFFERFUL came in as a response, then dont dequeue the SENDPACKET
-								if (next == 'SENDPACKET' or next == qpStates['SENDPACKET']) and response != qpStates['BUFFERFULL']:
-									nextQueue.dequeue() # After "waiting" for the bytes, dequeue the items.
-
-						# If we cancel the callback earlier, re-initialize it here.
-						disableCallback.clear()
-						if next != 'SENDPACKET' and next != qpStates['SENDPACKET']:
-							wtc_respond('DONE') # Always respond with done for an "ACCEPTED or PENDING"
-				elif byte == qpStates['NEXTPACKET']:
-					sendPacketToWTC()
-				elif byte == qpStates['BUFFERFULL']:
-					wtc_respond('DONE')
-				elif byte == qpStates['CANTSEND']:
-					packetQueue.clear()
-					wtc_respond('DONE')
-				elif byte == qpStates['ACCEPTED']:
-					wtc_respond('DONE')
-				elif byte == qpStates['DENIED']:
-					wtc_respond('DONE')
-				elif byte == qpStates['PENDING']:
-					wtc_respond('DONE')
-				else:
-					logger.logSystem('PseudoSM: State existed for {} but a method is not written for it.'.format(hex(byte)))
+		if len(packetData) == 4 and protocol.state == ProtocolState.AWAITING_TIMESTAMP:
+			start = time.time()
+			configureTimestamp(packetData)
+			protocol.record('TIMESTAMP (value)', time.time() - start)
+		elif len(packetData) == 1:
+			byte = packetData[0]
+			names = qpNames.get(byte, [])
+			logger.logResults('--Read from WTC: %s (%#x)', names, byte)
+			handler = controlHandlers.get(byte)
+			if handler:
+				logger.logSystem('PseudoSM: State receieved: %s (%#x)', names, byte)
+				start = time.time()
+				with qpaceTracer.span('/'.join(names), 'control'):
+					handler(byte)
+				protocol.record('/'.join(names), time.time() - start)
+			elif names:
+				logger.logSystem('PseudoSM: State receieved: %s (%#x)', names, byte)
+				logger.logSystem('PseudoSM: State existed for %#x but a method is not written for it.', byte)
+				protocol.record('/'.join(names), 0)
 			else:
-				logger.logSystem('PseudoSM: Unknown value {}. Not command or timestamp.'.format(hex(byte)))
+				logger.logSystem('PseudoSM: Unknown value %#x. Not command or timestamp.', byte)
+				protocol.record(None, 0)
 		else:
-			return packetData, configureTimestamp # Return the data if it's not actually a control character.
+			return packetData # Return the data if it's not actually a control character.
 
-		return None,configureTimestamp # Return nothing if the packetData was handled as a WTC control
+		return None # Return nothing if the packetData was handled as a WTC control
 
 
 
@@ -625,24 +1174,33 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 			# create an instance of a ChunkPacket
 			chunkPacket = fh.ChunkPacket(chip,logger)
 			runEvent.wait() # Mutex for the run
-			time.sleep(.18)  # wait for a moment
+			packetBuffer.waitForData(RX_WORKER_IDLE) # Wakes as soon as the RX worker hands something over
 			while(len(packetBuffer)>0): # If there is data in the buffer
 				runEvent.wait() # Mutex for running.
 				if shutdownEvent.is_set():
 					raise StopIteration('Shutdown was set. The buffer will be dropped.')
-				packetData = packetBuffer.pop(0) # Get that input
+				packetData = packetBuffer.pop() # Get that input
 
 				# Determine if the data is a control character or not.
-				packetData, configureTimestamp = pseudoStateMachine(packetData,configureTimestamp,nextQueue)
+				# A bulk frame that stalled mid-packet may hand off a single byte, so keep feeding the framer.
+				# Unless the frame went stale: then the WTC gave up on it and the byte is a control byte again.
+				if fh.ChunkPacket.bulkMode and protocol.state == ProtocolState.IN_TRANSFER and fh.ChunkPacket.dropStale():
+					logger.logSystem('Interpreter: Dropped a bulk frame that stalled partway.')
+					protocol.enter(ProtocolState.IDLE)
+				if not (fh.ChunkPacket.bulkMode and protocol.state == ProtocolState.IN_TRANSFER and fh.ChunkPacket.inProgress()):
+					packetData = pseudoStateMachine(packetData)
 				# If the data was not a control character, then process it.
 				if packetData:
 					#print("Packet data chunk was received.")
 					# We'll just assume that the input is a chunk.
 					chunkPacket.push(packetData)
+					protocol.transfer(not chunkPacket.complete)
 					# If, after pushing, the chunk is complete continue on. Otherwise skip.
 					if chunkPacket.complete:
 						#print("All chunks received, build packet.")
 						packetData = chunkPacket.build()
+						packetsIn.inc()
+						protocol.transfer(fh.ChunkPacket.inProgress()) # Bulk frames may carry the start of the next packet
 						fieldData = decodePacket(packetData) # Return a nice dictionary for the packets
 						# Check if the packet is valid.
 						# If it's XTEA, decode it at this step and modify the field data appropriately.
@@ -664,7 +1222,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 						if isValid:
 							#TODO These prints are for DEBUG only.
 							logger.logSuccess('Packet has passed Validation.')
-							logger.logResults("fieldData['Type'] = {}".format(fieldData['TYPE']))
+							logger.logResults("fieldData['Type'] = %s", fieldData['TYPE'])
 							# If the opcode is that of a DataPacket procecss as incoming data.
 							# If the opcode is a command, process it as a command.
 							# If we don't know what it is at this point, then let's log it and
@@ -672,7 +1230,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 							if fieldData['TYPE'] == 'DATA':
 								processIncomingPacketData(chip,fieldData)
 							elif fieldData['TYPE'] == 'DLACK':
-								logger.logResults("fieldData['response'] = {}".format(fieldData['response']))
+								logger.logResults("fieldData['response'] = %s", fieldData['response'])
 									# If the DLACK is good, then clear the queue of lastPackets.
 								if fieldData['response'] == b'GOOD':
 									lastPacketsSent.clear()
@@ -712,6 +1270,7 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 							failValidPacket = fh.DummyPacket()
 							failValidPacket.rid = b'\x00' 
 							failValidPacket.opcode = b'~NVAL' # Not Valid -- OP can only be 5-byte
+							nvalSent.inc()
 							packetQueue.enqueue(failValidPacket.build()) # Add failed packet to send queue
 
 		except KeyboardInterrupt: # Really only needed for DEBUG. Forces a re-check for shutdownEvent.
@@ -719,5 +1278,13 @@ def run(chip,nextQueue,packetQueue,experimentEvent, runEvent, shutdownEvent,disa
 		except StopIteration:	  # Used for control flow.
 			break
 	logger.logSystem("Interpreter: Starting cleanup for shutdown.")
-	cb_hndlr.join()
+	rx_wrkr.join()
+	dropped = executor.shutdown()
+	aggregator.clear()
+	if dropped:
+		logger.logSystem("Interpreter: Dropped %d queued command(s).", dropped)
+	if callback is not None:
+		callback.cancel()
+	if isinstance(disableCallback, CallbackSwitch):
+		disableCallback.removeListener(callbackChanged)
 	logger.logSystem("Interpreter: Shutting down...")
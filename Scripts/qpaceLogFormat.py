@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# qpaceLogFormat.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# The binary log format (.qlb) written by qpaceLogger.LogWriter, and the decoder that turns it back into
+# the text log. Nothing here needs the Pi, so ground can run it as a tool:
+#
+#	python3 qpaceLogFormat.py 20180920-101500_3.qlb [more.qlb or archived .qlb.gz ...] [--plain]
+#
+# A file starts with MAGIC and is a sequence of entries, each starting with its kind byte:
+#	RESET	base time (8 byte double). Starts a session: forgets every level and string defined before it.
+#	LEVEL	id, type string, color, end. Defines a level the first time a session uses it.
+#	STRING	id, text. Defines a template or subsystem the first time a session uses it.
+#	RECORD	time delta in microseconds (signed), level id, subsystem id, template id, argument count, arguments.
+#	RAW		text. A line that was already formatted.
+# Numbers are varints (7 bits a byte, least significant first), texts are a varint length and UTF-8. String
+# id 0 is the empty string. Arguments are a tag byte and a value (see ARG_*), so they are only formatted
+# into their template by the decoder.
+#
+# Next to each log the writer keeps an index (<log>.idx, see INDEX_ENTRY) with one entry per batch it wrote:
+# where the batch starts, where the session it belongs to starts, its first and last times and a mask of
+# the levels in it. query() uses it to read and decode only the batches that can hold a match:
+#
+#	python3 qpaceLogFormat.py --query [from=T] [to=T] [level=error,warn,...] [sub=Interpreter,...] [re=REGEX] logs...
+
+import gzip
+import os
+import re
+import struct
+import sys
+
+MAGIC = b'QLB1'
+RESET = 0
+LEVEL = 1
+STRING = 2
+RECORD = 3
+RAW = 4
+STRINGS_MAX = 4096 # Strings defined per session before a new session is started
+
+ARG_INT = b'i'
+ARG_FLOAT = b'f'
+ARG_BYTES = b'b'
+ARG_STR = b's'
+ARG_BOOL = b'B'
+ARG_NONE = b'N'
+
+INDEX_ENTRY = struct.Struct('>IIddH') # batch offset, session offset, first time, last time, level mask
+INDEX_EXTENSION = '.idx'
+# The bit of each type string (qpaceLogger.Logger.LEVEL_NAMES) in a level mask. Lines without a level use OTHER_LEVEL.
+INDEX_LEVELS = ('systm', 'error', 'info ', 'warn ', 'result', 'succ ', 'fail ', 'debug')
+OTHER_LEVEL = 1 << 15
+
+def packVarint(n):
+	"""Unsigned varint of n."""
+	out = bytearray()
+	while True:
+		byte = n & 0x7F
+		n >>= 7
+		if n:
+			out.append(byte | 0x80)
+		else:
+			out.append(byte)
+			return bytes(out)
+
+def packSigned(n):
+	"""Zigzag varint of a signed n, so small negative numbers stay small."""
+	return packVarint(n << 1 if n >= 0 else (-n << 1) - 1)
+
+def packText(text):
+	data = text.encode('utf-8', 'replace')
+	return packVarint(len(data)) + data
+
+def packArg(arg):
+	if arg is None:
+		return ARG_NONE
+	if isinstance(arg, bool):
+		return ARG_BOOL + (b'\x01' if arg else b'\x00')
+	if isinstance(arg, int):
+		return ARG_INT + packSigned(arg)
+	if isinstance(arg, float):
+		return ARG_FLOAT + struct.pack('>d', arg)
+	if isinstance(arg, (bytes, bytearray)):
+		return ARG_BYTES + packVarint(len(arg)) + bytes(arg)
+	return ARG_STR + packText(str(arg))
+
+class Encoder():
+	"""
+	Turns log records into entries for one file. Keeps the levels and strings defined so far, so the
+	caller must start a session with reset() every time it (re)opens the file.
+	"""
+	def __init__(self):
+		self.levels = {}
+		self.strings = {'': 0}
+		self.last = 0
+
+	def reset(self, now):
+		"""
+		Start a session.
+
+		Parameters: now - float - time.time()
+
+		Returns: bytes - the RESET entry
+
+		Raises: None
+		"""
+		self.levels = {}
+		self.strings = {'': 0}
+		self.last = now
+		return bytes([RESET]) + struct.pack('>d', now)
+
+	def _string(self, text, out):
+		id = self.strings.get(text)
+		if id is None:
+			id = len(self.strings)
+			self.strings[text] = id
+			out.append(bytes([STRING]) + packVarint(id) + packText(text))
+		return id
+
+	def encode(self, when, typeStr, color, end, subsystem, template, args):
+		"""
+		Parameters:
+		when - float - time.time() of the record
+		typeStr, color, end - str - the level and the color codes around the message
+		subsystem - str - see qpaceLogger.Logger.subsystem()
+		template - str - the message, with % placeholders if there are args
+		args - tuple - the arguments for the template
+
+		Returns: bytes - the entries for the record, with any definitions it needs first
+
+		Raises: None
+		"""
+		out = []
+		if len(self.strings) >= STRINGS_MAX:
+			out.append(self.reset(self.last))
+		level = (typeStr, color, end)
+		levelId = self.levels.get(level)
+		if levelId is None:
+			levelId = len(self.levels)
+			self.levels[level] = levelId
+			out.append(bytes([LEVEL]) + packVarint(levelId) + packText(typeStr) + packText(color) + packText(end))
+		subsystemId = self._string(subsystem, out)
+		templateId = self._string(template, out)
+		delta = int(round((when - self.last) * 1000000))
+		self.last += delta / 1000000
+		entry = bytes([RECORD]) + packSigned(delta) + packVarint(levelId) + packVarint(subsystemId) + packVarint(templateId)
+		entry += packVarint(len(args)) + b''.join(packArg(arg) for arg in args)
+		out.append(entry)
+		return b''.join(out)
+
+	@staticmethod
+	def raw(text):
+		return bytes([RAW]) + packText(text)
+
+class Reader():
+	"""Reads entries back out of .qlb data."""
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+
+	def byte(self):
+		self.pos += 1
+		return self.data[self.pos - 1]
+
+	def varint(self):
+		n = 0
+		shift = 0
+		while True:
+			byte = self.byte()
+			n |= (byte & 0x7F) << shift
+			shift += 7
+			if not byte & 0x80:
+				return n
+
+	def signed(self):
+		n = self.varint()
+		return -((n + 1) >> 1) if n & 1 else n >> 1
+
+	def bytes(self, n):
+		self.pos += n
+		if self.pos > len(self.data):
+			raise IndexError('Entry runs past the end of the data')
+		return self.data[self.pos - n:self.pos]
+
+	def text(self):
+		return self.bytes(self.varint()).decode('utf-8', 'replace')
+
+	def arg(self):
+		tag = self.bytes(1)
+		if tag == ARG_NONE:
+			return None
+		if tag == ARG_BOOL:
+			return self.byte() == 1
+		if tag == ARG_INT:
+			return self.signed()
+		if tag == ARG_FLOAT:
+			return struct.unpack('>d', self.bytes(8))[0]
+		if tag == ARG_BYTES:
+			return self.bytes(self.varint())
+		if tag == ARG_STR:
+			return self.text()
+		raise ValueError('Unknown argument tag {}'.format(tag))
+
+def decode(data):
+	"""
+	Decode .qlb data.
+
+	Parameters: data - bytes - a whole file or the part of one starting at a RESET entry
+
+	Returns: generator of dicts with 'time', 'level' (type string), 'color', 'end', 'subsystem', 'template',
+	'args' and 'offset' (where the entry starts). A RAW line has level None and its text as the template.
+	A truncated last entry (the writer was cut off) is skipped.
+
+	Raises: ValueError if the data is not a .qlb log.
+	"""
+	reader = Reader(data)
+	if data[:len(MAGIC)] == MAGIC:
+		reader.pos = len(MAGIC)
+	elif data and data[0] != RESET:
+		raise ValueError('Not a qlb log')
+	levels = {}
+	strings = {0: ''}
+	now = 0.0
+	while reader.pos < len(data):
+		offset = reader.pos
+		try:
+			kind = reader.byte()
+			if kind == RESET:
+				now = struct.unpack('>d', reader.bytes(8))[0]
+				levels = {}
+				strings = {0: ''}
+			elif kind == LEVEL:
+				id = reader.varint()
+				levels[id] = (reader.text(), reader.text(), reader.text())
+			elif kind == STRING:
+				id = reader.varint()
+				strings[id] = reader.text()
+			elif kind == RECORD:
+				now += reader.signed() / 1000000
+				typeStr, color, end = levels[reader.varint()]
+				subsystem = strings[reader.varint()]
+				template = strings[reader.varint()]
+				args = tuple(reader.arg() for _ in range(reader.varint()))
+				yield {'time': now, 'level': typeStr, 'color': color, 'end': end, 'subsystem': subsystem,
+					   'template': template, 'args': args, 'offset': offset}
+			elif kind == RAW:
+				yield {'time': now, 'level': None, 'color': '', 'end': '', 'subsystem': '', 'template': reader.text(),
+					   'args': (), 'offset': offset}
+			else:
+				raise ValueError('Unknown entry kind {} at {}'.format(kind, offset))
+		except IndexError:
+			return # Cut off in the middle of an entry
+
+def message(template, args):
+	"""Format a template the way qpaceLogger.Logger.message() does."""
+	if args:
+		try:
+			return template % args
+		except (TypeError, ValueError):
+			return template + ''.join(str(arg) for arg in args)
+	return template
+
+def render(record, plain = False):
+	"""
+	Parameters:
+	record - dict from decode()
+	plain - if True leave out the color codes
+
+	Returns: str - the line as the text log has it (without the surrounding newlines)
+	"""
+	if record['level'] is None:
+		return record['template'].strip('\n')
+	color, end = ('', '') if plain else (record['color'], record['end'])
+	return record['level'] + ' > [' + str(record['time']) + '] ' + color + message(record['template'], record['args']) + end
+
+def levelBit(typeStr):
+	"""The bit of a type string in an index entry's level mask."""
+	try:
+		return 1 << INDEX_LEVELS.index(typeStr)
+	except ValueError:
+		return OTHER_LEVEL
+
+def indexEntry(offset, session, lines):
+	"""
+	Parameters:
+	offset - int - where the batch starts in the log
+	session - int - where the session (RESET entry) the batch belongs to starts. Text logs use offset.
+	lines - list of (type string or None, time) - what the batch holds
+
+	Returns: bytes - the INDEX_ENTRY for the batch
+
+	Raises: None
+	"""
+	mask = 0
+	for typeStr, when in lines:
+		mask |= OTHER_LEVEL if typeStr is None else levelBit(typeStr)
+	times = [when for typeStr, when in lines]
+	return INDEX_ENTRY.pack(offset, session, min(times), max(times), mask)
+
+def indexPath(path):
+	"""The index of a log, archived (.gz) or not."""
+	return (path[:-3] if path.endswith('.gz') else path) + INDEX_EXTENSION
+
+def readIndex(path):
+	"""
+	Parameters: path - str - a log, archived or not
+
+	Returns: list of (batch offset, session offset, first time, last time, level mask), or None if the log has no index.
+
+	Raises: None
+	"""
+	try:
+		with open(indexPath(path), 'rb') as indexFile:
+			data = indexFile.read()
+	except OSError:
+		return None
+	size = INDEX_ENTRY.size
+	return [INDEX_ENTRY.unpack_from(data, n) for n in range(0, len(data) - size + 1, size)]
+
+TEXT_LINE = re.compile(r'^(\S+ *) > \[([^\]]*)\] (.*)$')
+COLOR_CODE = re.compile(r'\x1b\[[0-9;]*m')
+
+def decodeText(data, base = 0):
+	"""
+	Parse the lines of a text log into records shaped like decode()'s, with the color codes left out. Lines that
+	don't start a record (e.g. a traceback) are added to the message before them.
+
+	Parameters:
+	data - bytes - the log, or part of it starting at a line
+	base - int - the offset of data in the log
+
+	Returns: generator of dicts. 'time' is None where the log has a boot label instead of a time.
+	"""
+	record = None
+	offset = base
+	for line in data.split(b'\n'):
+		text = COLOR_CODE.sub('', line.decode('utf-8', 'replace'))
+		match = TEXT_LINE.match(text)
+		if match:
+			if record:
+				yield record
+			typeStr, label, message = match.groups()
+			try:
+				when = float(label)
+			except ValueError:
+				when = None
+			head, colon, rest = message.partition(':')
+			record = {'time': when, 'level': typeStr, 'color': '', 'end': '', 'subsystem': head if colon and ' ' not in head else '',
+					  'template': message, 'args': (), 'offset': offset}
+		elif text and record:
+			record['template'] += '\n' + text
+		offset += len(line) + 1
+	if record:
+		yield record
+
+def _spans(index, start, end, mask):
+	"""
+	Turn the index entries that can hold a match into (read from, keep from, read to) spans of the log. Neighbouring
+	batches are merged. read to is None for the end of the file.
+	"""
+	spans = []
+	for n, (offset, session, first, last, levels) in enumerate(index):
+		if (start is not None and last < start) or (end is not None and first > end) or (mask is not None and not levels & mask):
+			continue
+		stop = index[n + 1][0] if n + 1 < len(index) else None
+		if spans and spans[-1][2] == offset:
+			spans[-1][2] = stop
+		else:
+			spans.append([session, offset, stop])
+	return spans
+
+def query(paths, start = None, end = None, levels = None, subsystems = None, pattern = None, stats = None):
+	"""
+	Find the records in some logs that match every filter given (None matches everything). Where a log has an index
+	only the batches that can hold a match are read and decoded, so narrow queries stay cheap on big logs.
+
+	Parameters:
+	paths - list of str - .qlb or .log logs, or their archived .gz, searched in that order
+	start, end - float - time.time() range, inclusive
+	levels - set of str - type strings, e.g. {'error', 'warn '}
+	subsystems - set of str - see qpaceLogger.Logger.subsystem()
+	pattern - compiled regex searched for in the message
+	stats - dict - optional, 'logs', 'bytes' (read) and 'records' (decoded) are added to it
+
+	Returns: generator of (path, record) with records as decode() gives them plus their 'message'.
+
+	Raises: None. Logs that can't be read are skipped.
+	"""
+	stats = {} if stats is None else stats
+	for key in ('logs', 'bytes', 'records'):
+		stats.setdefault(key, 0)
+	mask = None
+	if levels is not None:
+		mask = 0
+		for typeStr in levels:
+			mask |= levelBit(typeStr)
+	for path in paths:
+		index = readIndex(path)
+		spans = [[0, 0, None]] if index is None else _spans(index, start, end, mask)
+		if not spans:
+			continue
+		text = path.endswith(('.log', '.log.gz'))
+		try:
+			with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as logFile:
+				stats['logs'] += 1
+				for session, keep, stop in spans:
+					logFile.seek(session)
+					data = logFile.read() if stop is None else logFile.read(stop - session)
+					stats['bytes'] += len(data)
+					for record in (decodeText(data, session) if text else decode(data)):
+						if not text:
+							record['offset'] += session
+						if record['offset'] < keep:
+							continue
+						stats['records'] += 1
+						if levels is not None and record['level'] not in levels:
+							continue
+						if subsystems is not None and record['subsystem'] not in subsystems:
+							continue
+						if (start is not None or end is not None) and record['time'] is None:
+							continue
+						if (start is not None and record['time'] < start) or (end is not None and record['time'] > end):
+							continue
+						record['message'] = message(record['template'], record['args'])
+						if pattern is not None and not pattern.search(record['message']):
+							continue
+						yield path, record
+		except (OSError, EOFError, ValueError):
+			continue
+
+if __name__ == '__main__' and '--query' in sys.argv:
+	filters = {}
+	paths = []
+	for arg in sys.argv[1:]:
+		key, equals, value = arg.partition('=')
+		if equals and key in ('from', 'to', 'level', 'sub', 're'):
+			filters[key] = value
+		elif arg != '--query':
+			paths.append(arg)
+	for path, record in query(paths, float(filters['from']) if 'from' in filters else None,
+							  float(filters['to']) if 'to' in filters else None,
+							  set(t for t in INDEX_LEVELS if t.strip() in filters['level'].split(',')) if 'level' in filters else None,
+							  set(filters['sub'].split(',')) if 'sub' in filters else None,
+							  re.compile(filters['re']) if 're' in filters else None):
+		sys.stdout.write('\n' + render(record, True) + '\n')
+elif __name__ == '__main__':
+	plain = '--plain' in sys.argv
+	for path in [arg for arg in sys.argv[1:] if arg != '--plain']:
+		with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as logFile:
+			for record in decode(logFile.read()):
+				sys.stdout.write('\n' + render(record, plain) + '\n')
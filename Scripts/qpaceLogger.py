@@ -10,12 +10,19 @@
 
 import os
 import datetime
+import atexit
+import threading
+import gzip
+import shutil
+from collections import deque, OrderedDict
 from time import strftime,gmtime,time, sleep
 
 import sys
 import pigpio
 import SC16IS750
 import traceback
+import qpaceLogFormat
+import qpaceMetrics
 
 ERROR_LOG = "ErrorLog.txt"
 
@@ -83,6 +90,339 @@ class Errors():
         """
         open(ERROR_LOG, 'w').close()
 
+class Repeats():
+    """The last message held back by storm suppression. Only formatted when the summary is written."""
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return Logger.message(self.data)
+
+class StormBucket():
+    """Token bucket and repeat counter for one call site (level and template)."""
+    __slots__ = ('tokens', 'stamp', 'suppressed', 'first', 'last', 'record')
+
+    def __init__(self, now):
+        self.tokens = LogWriter.STORM_BURST
+        self.stamp = now
+        self.suppressed = 0
+        self.first = None
+        self.last = None
+        self.record = None
+
+class LogWriter():
+    """
+    Writes log lines to one file from a background thread so logging never waits on the SD card.
+
+    Records (see Logger.logData) are held in a bounded ring, then formatted and written in one batch every
+    FLUSH_INTERVAL seconds, or as soon as the ring is half full. If it fills up before the writer gets to it
+    the oldest lines are dropped and a note says how many. A binary writer writes the records in the
+    qpaceLogFormat format instead of formatting them.
+    The file is kept open between batches and fsync'd according to the fsync policy:
+        'always'   - after every batch
+        'interval' - at most every FSYNC_INTERVAL seconds
+        'never'    - left to the OS
+    flush() writes everything held right away, for errors and shutdown.
+
+    Once the file reaches SEGMENT_BYTES, or has been written to for SEGMENT_SECONDS, it is rotated: renamed to
+    <name>.<n><ext> and gzip'd into ARCHIVE_PATH on another thread, and writing carries on in a fresh file
+    under the same name. Logs left from earlier boots are archived the same way when a writer starts. The
+    oldest archives are deleted whenever they add up to more than RETENTION_BYTES.
+
+    Each call site (level and template) gets a token bucket of STORM_BURST lines refilled at STORM_RATE lines
+    a second. Lines past that are counted instead of written, and one 'repeats ... were suppressed' line with
+    the first and last times replaces them when the call site is let through again or has been quiet for
+    STORM_WINDOW seconds (or at a synchronous flush). Errors are never suppressed.
+
+    Every batch also appends an entry to <file>.idx (see qpaceLogFormat.INDEX_ENTRY) with its offset, times and
+    levels, so a query only has to read the batches that can match. A binary writer starts a new session every
+    SESSION_BYTES so a batch never needs more than that read before it to be decoded. The index follows its log
+    through renames, rotation, archiving and retention.
+    """
+    RING_SIZE = 8192 # lines
+    FLUSH_INTERVAL = 1.0 # seconds
+    FSYNC_POLICY = 'interval'
+    FSYNC_INTERVAL = 10.0 # seconds
+    SEGMENT_BYTES = 1024 * 1024
+    SEGMENT_SECONDS = 6 * 3600
+    ARCHIVE_PATH = '/home/pi/data/backup/'
+    ARCHIVE_EXTENSIONS = ('.log.gz', '.qlb.gz')
+    RETENTION_BYTES = 64 * 1024 * 1024
+    STORM_BURST = 20 # lines
+    STORM_RATE = 2.0 # lines a second
+    STORM_WINDOW = 5.0 # seconds
+    STORM_KEYS = 1024 # call sites tracked at once
+    SESSION_BYTES = 64 * 1024
+    writers = [] # Every writer that was started, so they can all be flushed before exiting.
+    archiveLock = threading.Lock() # One archive job at a time
+
+    def __init__(self, path, interval=FLUSH_INTERVAL, fsync=FSYNC_POLICY, size=RING_SIZE, binary=False):
+        self.path = path
+        self.encoder = qpaceLogFormat.Encoder() if binary else None
+        self.interval = interval
+        self.fsync = fsync
+        self.ring = deque(maxlen=size)
+        self.cv = threading.Condition()
+        self.ioLock = threading.Lock() # Held while writing so batches land in order
+        self.file = None
+        self.indexFile = None
+        self.session = 0 # Where the session the next batch belongs to starts
+        self.dropped = 0
+        self.lastSync = time()
+        self.segmentStart = time()
+        self.segments = 0
+        self.buckets = OrderedDict()
+        self.suppressed = 0
+        self.stopped = False
+        self.thread = threading.Thread(name='logWriter', target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        LogWriter.writers.append(self)
+        self._startArchive(self.archiveOld)
+
+    def write(self, line, key=None):
+        """
+        Queue a line or a record. Costs a lock and an append.
+
+        Parameters:
+        line - str or a record from Logger.logData()
+        key - optional - the call site of a record, for storm suppression. None is never suppressed.
+
+        Returns: None
+
+        Raises: None
+        """
+        with self.cv:
+            if key is not None and not self._admit(key, line):
+                return
+            self._append(line)
+
+    def _append(self, line):
+        """Caller holds self.cv."""
+        if len(self.ring) == self.ring.maxlen:
+            self.dropped += 1
+        self.ring.append(line)
+        if len(self.ring) == self.ring.maxlen // 2:
+            self.cv.notify()
+
+    def _admit(self, key, record):
+        """Take a token for the call site, or count the record as a repeat. Caller holds self.cv."""
+        now = record[1]
+        try:
+            bucket = self.buckets.get(key)
+        except TypeError: # Unhashable arguments
+            return True
+        if bucket is None:
+            if len(self.buckets) >= LogWriter.STORM_KEYS:
+                oldKey, old = self.buckets.popitem(last=False)
+                if old.suppressed:
+                    self._append(self._summary(old))
+            bucket = self.buckets[key] = StormBucket(now)
+        bucket.tokens = min(LogWriter.STORM_BURST, bucket.tokens + (now - bucket.stamp) * LogWriter.STORM_RATE)
+        bucket.stamp = now
+        if bucket.tokens < 1:
+            if not bucket.suppressed:
+                bucket.first = now
+            bucket.suppressed += 1
+            bucket.last = now
+            bucket.record = record
+            self.suppressed += 1
+            return False
+        bucket.tokens -= 1
+        if bucket.suppressed:
+            self._append(self._summary(bucket))
+        return True
+
+    def _summary(self, bucket):
+        """The record standing in for the repeats a bucket held back. Resets the bucket's count."""
+        typeStr, when, color, data, end, label = bucket.record
+        summary = (typeStr, bucket.last, color, ('Logger: %d repeats of <%s> were suppressed from %s to %s.',
+                   bucket.suppressed, Repeats(data), repr(bucket.first), repr(bucket.last)), end, label)
+        bucket.suppressed = 0
+        bucket.record = None
+        return summary
+
+    def _run(self):
+        while True:
+            with self.cv:
+                if self.stopped:
+                    return
+                self.cv.wait(self.interval)
+            self.flush()
+
+    def flush(self, sync=False):
+        """
+        Write every held line now.
+
+        Parameters: sync - if True fsync the file afterwards whatever the policy is.
+
+        Returns: None
+
+        Raises: None. Write errors count towards Logger.MAX_LOG_ATTEMPTS.
+        """
+        with self.ioLock:
+            with self.cv:
+                now = time()
+                for bucket in self.buckets.values():
+                    if bucket.suppressed and (sync or now - bucket.last >= LogWriter.STORM_WINDOW):
+                        self._append(self._summary(bucket))
+                lines = list(self.ring)
+                self.ring.clear()
+                dropped, self.dropped = self.dropped, 0
+            if not lines and not sync:
+                return
+            if dropped:
+                lines.insert(0, '\nsystm > [{}] Logger: {} lines were dropped, the log ring was full.\n'.format(time(), dropped))
+            try:
+                header = b''
+                if self.file is None:
+                    self.file = open(self.path, 'ab' if self.encoder else 'a')
+                    self.indexFile = open(qpaceLogFormat.indexPath(self.path), 'ab')
+                    if self.encoder:
+                        # Every time the file is opened starts a new session for the decoder.
+                        header = qpaceLogFormat.MAGIC if self.file.tell() == 0 else b''
+                        self.session = self.file.tell() + len(header)
+                        header += self.encoder.reset(time())
+                offset = self.file.tell()
+                if not self.encoder:
+                    self.session = offset
+                elif lines and not header and offset - self.session >= LogWriter.SESSION_BYTES:
+                    header = self.encoder.reset(time())
+                    self.session = offset
+                if self.encoder:
+                    self.file.write(header + b''.join(self.encode(line) for line in lines))
+                else:
+                    self.file.write(''.join(line if isinstance(line, str) else '\n' + Logger.render(line) + '\n' for line in lines))
+                self.file.flush()
+                now = time()
+                if lines:
+                    self.indexFile.write(qpaceLogFormat.indexEntry(offset, self.session,
+                        [(None, now) if isinstance(line, str) else (line[0], line[1]) for line in lines]))
+                    self.indexFile.flush()
+                if sync or self.fsync == 'always' or (self.fsync == 'interval' and now - self.lastSync >= LogWriter.FSYNC_INTERVAL):
+                    os.fsync(self.file.fileno())
+                    self.lastSync = now
+                size = self.file.tell()
+                if size >= LogWriter.SEGMENT_BYTES or (size and now - self.segmentStart >= LogWriter.SEGMENT_SECONDS):
+                    self._rotate()
+            except Exception:
+                Logger.LOG_ATTEMPTS += 1
+
+    def _rotate(self):
+        """Move the full file out of the way and archive it. Caller holds self.ioLock."""
+        self._close()
+        base, ext = os.path.splitext(self.path)
+        self.segments += 1
+        segment = '{}.{}{}'.format(base, self.segments, ext)
+        LogWriter.move(self.path, segment)
+        self.segmentStart = time()
+        self._startArchive(self.archive, segment)
+
+    def _startArchive(self, target, *args):
+        thread = threading.Thread(name='logArchiver', target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def archive(self, path):
+        """
+        gzip a finished log into ARCHIVE_PATH, delete it and enforce the retention budget.
+
+        Parameters: path - the finished log
+
+        Returns: None
+
+        Raises: None. Failures are noted in the log.
+        """
+        with LogWriter.archiveLock:
+            try:
+                with open(path, 'rb') as src, gzip.open(LogWriter.ARCHIVE_PATH + os.path.basename(path) + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(path)
+                index = qpaceLogFormat.indexPath(path)
+                if os.path.exists(index):
+                    shutil.move(index, LogWriter.ARCHIVE_PATH + os.path.basename(index))
+            except Exception as e:
+                self.write('\nsystm > [{}] Logger: Could not archive {} {}\n'.format(time(), path, e.args))
+            LogWriter.enforceRetention()
+
+    def archiveOld(self):
+        """Archive the logs in this writer's folder that no writer is using, i.e. the ones from earlier boots."""
+        folder = os.path.dirname(self.path)
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return
+        live = [os.path.abspath(writer.path) for writer in LogWriter.writers]
+        for name in sorted(names):
+            path = os.path.join(folder, name)
+            if name.endswith(tuple(Logger.EXTENSIONS.values())) and os.path.abspath(path) not in live:
+                self.archive(path)
+
+    @staticmethod
+    def enforceRetention():
+        """Delete the oldest archived logs until they fit in RETENTION_BYTES."""
+        try:
+            archives = [os.path.join(LogWriter.ARCHIVE_PATH, name) for name in os.listdir(LogWriter.ARCHIVE_PATH)
+                        if name.endswith(LogWriter.ARCHIVE_EXTENSIONS)]
+            archives.sort(key=os.path.getmtime)
+            total = sum(os.path.getsize(path) for path in archives)
+            while archives and total > LogWriter.RETENTION_BYTES:
+                oldest = archives.pop(0)
+                total -= os.path.getsize(oldest)
+                os.remove(oldest)
+                if os.path.exists(qpaceLogFormat.indexPath(oldest)):
+                    os.remove(qpaceLogFormat.indexPath(oldest))
+        except OSError:
+            pass
+
+    def encode(self, line):
+        """Turn a line or a record into qpaceLogFormat entries."""
+        if isinstance(line, str):
+            return qpaceLogFormat.Encoder.raw(line)
+        typeStr, when, color, data, end, label = line
+        template, args = Logger.split(data)
+        return self.encoder.encode(when, typeStr, color, end, Logger.subsystem(data), template, args)
+
+    def rename(self, path):
+        """Write what is held to the current file, then rename it to path and carry on writing there."""
+        self.flush()
+        with self.ioLock:
+            self._close()
+            LogWriter.move(self.path, path)
+            self.path = path
+
+    def _close(self):
+        """Close the file and its index. Caller holds self.ioLock."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.indexFile is not None:
+            self.indexFile.close()
+            self.indexFile = None
+
+    @staticmethod
+    def move(path, newPath):
+        """Rename a log and its index."""
+        os.rename(path, newPath)
+        if os.path.exists(qpaceLogFormat.indexPath(path)):
+            os.rename(qpaceLogFormat.indexPath(path), qpaceLogFormat.indexPath(newPath))
+
+    def close(self):
+        """Write and fsync what is held, then stop the thread."""
+        with self.cv:
+            self.stopped = True
+            self.cv.notify_all()
+        self.flush(sync=True)
+        with self.ioLock:
+            self._close()
+
+    @staticmethod
+    def flushAll():
+        for writer in LogWriter.writers:
+            writer.flush(sync=True)
+
+atexit.register(LogWriter.flushAll)
+
 class Logger():
     """ Handles logging information to file and outputting to terminal during debug sessions"""
     # Defined Paths.
@@ -92,17 +432,30 @@ class Logger():
 
     LOG_ATTEMPTS = 0
     MAX_LOG_ATTEMPTS = 5
+    ERROR_SYNC_INTERVAL = 1.0 # seconds. Errors are fsync'd at most this often, so an error every packet can't wear the card.
+    lastErrorSync = 0
     DEBUG = True
     #MODE should contain all sys arguments from the user when running qpaceMain.py independantly from startQPACE.sh
     #debug purposes only!
     MODE = sys.argv[1:]
-
-    def __init__(self):
+    # 'binary' writes .qlb logs (decode them with qpaceLogFormat.py), 'text' writes the plain .log files.
+    FORMAT = 'binary'
+    EXTENSIONS = {'text': '.log', 'binary': '.qlb'}
+    # Level names used by setLevel() and the lg command, and the type string each one writes.
+    LEVEL_NAMES = {'system': 'systm', 'error': 'error', 'info': 'info ', 'warning': 'warn ', 'result': 'result',
+                   'success': 'succ ', 'failure': 'fail ', 'debug': 'debug'}
+    # Shared by every Logger so a change made by a command applies everywhere.
+    disabledLevels = set() # type strings
+    disabledSubsystems = set() # the word before the first colon of a message, e.g. 'Entered' or 'Interpreter'
+
+    def __init__(self, flushInterval=LogWriter.FLUSH_INTERVAL, fsync=LogWriter.FSYNC_POLICY):
         """
         Constructor for the Logger. Opens up a log called unknownBootTime_# where # is the
         next number in the serialization of logs in the log directory.
 
-        Parameters: None
+        Parameters:
+        flushInterval - optional - seconds between batched writes to the log file
+        fsync - optional - 'always', 'interval' or 'never'. See LogWriter.
 
         Returns: None
 
@@ -114,7 +467,11 @@ class Logger():
         # take everything after 15 characters. Log names are in the format YYYYmmdd-HHMMSS_C.log where C is the counter.
         try:
 
-            fileList = [int(x.replace('.log','')[16:]) for x in os.listdir('../logs/') if x.endswith('.log') and not x.endswith('null.log')]
+            # Archived logs (and their rotated segments, name_C.N.qlb) count too so a counter is never reused.
+            names = os.listdir('../logs/')
+            if os.path.isdir(LogWriter.ARCHIVE_PATH):
+                names += [x[:-3] for x in os.listdir(LogWriter.ARCHIVE_PATH) if x.endswith(LogWriter.ARCHIVE_EXTENSIONS)]
+            fileList = [int(x.split('.')[0][16:]) for x in names if x.endswith(tuple(Logger.EXTENSIONS.values())) and x.split('.')[0][16:].isdigit()]
             if fileList:
                 self.counter = max(fileList) + 1
             else:
@@ -125,6 +482,9 @@ class Logger():
         self.Errors = Errors()
         self.Colors = Colors()
         self.filename = 'unknownBootTime' # Must be 15 characters for the serialization.
+        self.flushInterval = flushInterval
+        self.fsync = fsync
+        self._writer = None # Started on the first log so loggers that never log don't start a thread.
 
 
     def bootWasSet(self):
@@ -157,9 +517,40 @@ class Logger():
         if newTimestamp:
             try:
                 newTimestamp = datetime.datetime.fromtimestamp(newTimestamp).strftime('%Y%m%d-%H%M%S')
-                os.rename('{}{}_{}.log'.format(Logger.LOG_PATH,self.filename,self.counter),'{}{}_{}.log'.format(Logger.LOG_PATH,newTimestamp,self.counter))
+                self.writer().rename('{}{}_{}{}'.format(Logger.LOG_PATH,newTimestamp,self.counter,Logger.EXTENSIONS[Logger.FORMAT]))
                 self.filename = newTimestamp
             except:pass
+
+    def writer(self):
+        """
+        Get the LogWriter for this log, starting it if needed.
+
+        Parameters: None
+
+        Returns: LogWriter
+
+        Raises: None
+
+        """
+        if self._writer is None:
+            self._writer = LogWriter('{}{}_{}{}'.format(Logger.LOG_PATH,self.filename,self.counter,Logger.EXTENSIONS[Logger.FORMAT]),
+                                     interval=self.flushInterval, fsync=self.fsync, binary=Logger.FORMAT == 'binary')
+        return self._writer
+
+    def flush(self):
+        """
+        Write and fsync everything logged so far. Call before shutting down or rebooting.
+
+        Parameters: None
+
+        Returns: None
+
+        Raises: None
+
+        """
+        if self._writer is not None:
+            self._writer.flush(sync=True)
+
     def clearBoot(self):
         """
         Sets the _boot flag to false
@@ -173,6 +564,137 @@ class Logger():
         """
         self._boot = False
         
+    @staticmethod
+    def logFiles():
+        """
+        Every log on the Pi, oldest first: the archived ones in LogWriter.ARCHIVE_PATH, then the ones in LOG_PATH.
+
+        Parameters: None
+
+        Returns: list of str - paths
+
+        Raises: None
+
+        """
+        paths = []
+        for folder, extensions in ((LogWriter.ARCHIVE_PATH, LogWriter.ARCHIVE_EXTENSIONS), (Logger.LOG_PATH, tuple(Logger.EXTENSIONS.values()))):
+            try:
+                found = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(extensions)]
+            except OSError:
+                continue
+            paths += sorted(found, key=os.path.getmtime)
+        return paths
+
+    @staticmethod
+    def setLevel(name, enabled):
+        """
+        Turn a level on or off for every Logger. Errors can't be turned off.
+
+        Parameters:
+        name - str - a key of LEVEL_NAMES
+        enabled - bool
+
+        Returns: True if the level was changed, False if it is unknown or can't be turned off.
+
+        Raises: None
+
+        """
+        typeStr = Logger.LEVEL_NAMES.get(name)
+        if typeStr is None or (typeStr == 'error' and not enabled):
+            return False
+        if enabled:
+            Logger.disabledLevels.discard(typeStr)
+        else:
+            Logger.disabledLevels.add(typeStr)
+        return True
+
+    @staticmethod
+    def setSubsystem(name, enabled):
+        """Turn every level of a subsystem (see subsystem()) on or off for every Logger."""
+        if enabled:
+            Logger.disabledSubsystems.discard(name)
+        else:
+            Logger.disabledSubsystems.add(name)
+
+    @staticmethod
+    def describeLevels():
+        """Returns: str - what is turned off, for the lg command and the status file."""
+        levels = sorted(name for name, typeStr in Logger.LEVEL_NAMES.items() if typeStr in Logger.disabledLevels)
+        return 'Levels off: {} Subsystems off: {}'.format(','.join(levels) or 'none', ','.join(sorted(Logger.disabledSubsystems)) or 'none')
+
+    @staticmethod
+    def subsystem(data):
+        """
+        The subsystem of a message is the word before its first colon ('Interpreter: ...' is Interpreter).
+        Placeholders in that word are filled in first, so '%s: Adding...' with 'NextQueue' is NextQueue.
+
+        Parameters: data - tuple - the arguments given to logX()
+
+        Returns: str - the subsystem, or '' if the message doesn't start with one.
+
+        Raises: None
+
+        """
+        if not data or not isinstance(data[0], str):
+            return ''
+        head, colon, rest = data[0].partition(':')
+        if '%' in head and len(data) > 1:
+            try:
+                head = head % tuple(data[1:1 + head.count('%')])
+            except (TypeError, ValueError):
+                return ''
+        head = head.strip()
+        return head if colon and head and ' ' not in head else ''
+
+    @staticmethod
+    def enabled(typeStr, data):
+        """
+        Checked before a message is formatted so turned off logging costs next to nothing.
+
+        Parameters:
+        typeStr - the level's type string
+        data - tuple - the arguments given to logX()
+
+        Returns: True if the message should be logged.
+
+        Raises: None
+
+        """
+        if typeStr in Logger.disabledLevels:
+            return False
+        if Logger.disabledSubsystems and Logger.subsystem(data) in Logger.disabledSubsystems:
+            return False
+        return True
+
+    @staticmethod
+    def message(data):
+        """
+        Build the text of a message. If the first argument has a % placeholder and there are more arguments, they are
+        %-formatted into it (logDebug('Got %d bytes', n)). Otherwise the arguments are joined, as they always were.
+        """
+        if len(data) > 1 and '%' in data[0]:
+            try:
+                return data[0] % tuple(data[1:])
+            except (TypeError, ValueError):
+                pass
+        try:
+            return ''.join(data)
+        except TypeError:
+            return ''.join(str(x) for x in data)
+
+    @staticmethod
+    def split(data):
+        """Returns: (template, args) - the %-template and its arguments, or the joined message and ()."""
+        if len(data) > 1 and '%' in data[0]:
+            return data[0], tuple(data[1:])
+        return Logger.message(data), ()
+
+    @staticmethod
+    def render(record):
+        """Turn a record from logData() into its log line (without the surrounding newlines)."""
+        typeStr, when, color, data, end, label = record
+        return typeStr + ' > [' + (label or str(when)) + '] ' + color + Logger.message(data) + end
+
     def logPrint(self, typeStr, log):
 
         '''
@@ -207,19 +729,22 @@ class Logger():
             print(log)   
       
     
-    def logData(self,typeStr,*strings):
+    def logData(self,typeStr,data,color='',end=''):
         """
         This function handles logging the actual data. It should not be called by a user.
 
+        The message is not formatted here. The record (type, time, color, data, end, time label) goes to the LogWriter,
+        which formats it on its own thread, so arguments passed to logX() must not be changed afterwards.
+        It is only formatted here as well when printing to the terminal.
+
         Parameters
         ----------
-        fileName - String - Name of the file to write to.
-        timestamp - datetime.datetime timestamp
-        *strings - Any number of strings to write. each string will be on a new line.
+        typeStr - String - the level's type string, e.g. 'systm'
+        data - tuple - the arguments given to logX(). See message().
+        color, end - String - the color codes around the message
         Returns
         -------
-        String - This will be the filename of the file it just wrote.
-        system_###.log OR error_###.log - The log which just got written to.
+        None
 
         Raises
         ------
@@ -228,25 +753,16 @@ class Logger():
         """
         if Logger.LOG_ATTEMPTS >= Logger.MAX_LOG_ATTEMPTS:
             return None
-        try:
-
-            #add time string
-            if self._boot:
-                timeStr = self.filename
-            else:
-                timeStr = str(time())
-            # concat string: " 'log type' > ['time'] + 'log data'
-            log = typeStr + ' > [' + timeStr + '] ' + ''.join(strings)
-            
-            #write to log file.
-            with open('{}{}_{}.log'.format(Logger.LOG_PATH,self.filename,self.counter),'a') as f:
-                f.write('\n' + log + '\n')
+        #text logs show the boot timestamp instead of the time once it is set. Binary logs always keep the time.
+        label = self.filename if self._boot else None
+        record = (typeStr, time(), color, data, end, label)
+        #hand it to the writer thread. The call site is the template, or the whole message if it has no arguments.
+        key = None if typeStr == 'error' else (typeStr, data[0]) if len(data) > 1 and '%' in data[0] else (typeStr,) + data
+        self.writer().write(record, key)
 
-            #Used for Debugging only!
-            return self.logPrint(typeStr, log)
-
-        except Exception as e:
-            raise # Pass all and any exceptions back to the caller.
+        #Used for Debugging only!
+        if Logger.MODE and 'n' not in Logger.MODE:
+            return self.logPrint(typeStr, Logger.render(record))
 
     def logError(self,description, exception = None):
         """
@@ -274,12 +790,19 @@ class Logger():
             if exception is not None:
                 description += ' {}'.format(str(exception.args))
             self.Errors.inc()
-            log = Colors.RED + description + Colors.DEFAULT 
 
-            if "I2C" in description:
-                print("Critical Error encountered - Restarting script")
-                restart_script()
-            return self.logData('error', log) # Actually log the data.
+            # Bus errors are recovered in place by qpaceInterpreter.LinkRecovery, which calls
+            # restart_script() itself if the link can't be brought back.
+            retval = self.logData('error', (description,), Colors.RED, Colors.DEFAULT) # Actually log the data.
+            # Errors go to the card straight away in case they are the last thing logged. The fsync is rate limited;
+            # in between they are still written right away, so only a power loss could lose them.
+            now = time()
+            if now - Logger.lastErrorSync >= Logger.ERROR_SYNC_INTERVAL:
+                Logger.lastErrorSync = now
+                self.flush()
+            else:
+                self.writer().flush()
+            return retval
         except Exception:
             Logger.LOG_ATTEMPTS += 1
 
@@ -289,7 +812,8 @@ class Logger():
 
         Parameters
         ----------
-        *data - Strings - multiple strings to be written to the system log. Each string will be written on a new line.
+        *data - Strings - multiple strings to be written to the system log, joined together. If the first one has
+            % placeholders the rest are its arguments, formatted only if the message is logged.
 
         Returns
         -------
@@ -301,10 +825,10 @@ class Logger():
         and then ignored.
 
         """
-        #Add Color to Text
-        log = Colors.HEADER + ''.join(data) + Colors.END
+        if not Logger.enabled('systm', data):
+            return None
         try:
-            return self.logData('systm', log)
+            return self.logData('systm', data, Colors.HEADER, Colors.END)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
@@ -320,11 +844,10 @@ class Logger():
 
         Suggested Color: white
         """
-        #Add Color to Text
-        log = Colors.NC + ''.join(data) + Colors.END
-    
+        if not Logger.enabled('info ', data):
+            return None
         try:
-            return self.logData('info ', log)
+            return self.logData('info ', data, Colors.NC, Colors.END)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
@@ -340,10 +863,10 @@ class Logger():
 
         Suggested Color: yellow or orange
         """
-        #Add Color to Text
-        log = Colors.WARNING + ''.join(data) + Colors.END
+        if not Logger.enabled('warn ', data):
+            return None
         try:
-            return self.logData('warn ', log)
+            return self.logData('warn ', data, Colors.WARNING, Colors.END)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
@@ -359,10 +882,10 @@ class Logger():
 
         Suggested Color: yellow or orange
         """
-        #Add Color to Text
-        log = Colors.LIGHT_CYAN + ''.join(data) + Colors.DEFAULT
+        if not Logger.enabled('result', data):
+            return None
         try:
-            return self.logData('result', log)
+            return self.logData('result', data, Colors.LIGHT_CYAN, Colors.DEFAULT)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
@@ -378,10 +901,10 @@ class Logger():
         
         Suggested Color: green
         """
-        #Add Color to Text
-        log = Colors.OKGREEN + ''.join(data) + Colors.END
+        if not Logger.enabled('succ ', data):
+            return None
         try:
-            return self.logData('succ ', log)
+            return self.logData('succ ', data, Colors.OKGREEN, Colors.END)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
@@ -398,10 +921,10 @@ class Logger():
 
         Suggested Color: red or orange
         """
-        #Add Color to Text
-        log = Colors.FAIL + ''.join(data) + Colors.END
+        if not Logger.enabled('fail ', data):
+            return None
         try:
-            return self.logData('fail ', log)
+            return self.logData('fail ', data, Colors.FAIL, Colors.END)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
@@ -417,13 +940,18 @@ class Logger():
         
         Suggested Color: blue
         """
-        #Add Color to Text
-        log = Colors.OKBLUE + ''.join(data) + Colors.END
+        if not Logger.enabled('debug', data):
+            return None
         try:
-            return self.logData('debug', log)
+            return self.logData('debug', data, Colors.OKBLUE, Colors.END)
         except Exception as e:
             Logger.LOG_ATTEMPTS += 1
 
+# The logging counters, for the metrics registry.
+qpaceMetrics.gauge('logger.errors', Errors.get)
+qpaceMetrics.gauge('logger.writeFailures', lambda: Logger.LOG_ATTEMPTS)
+qpaceMetrics.gauge('logger.suppressed', lambda: sum(writer.suppressed for writer in LogWriter.writers))
+
 # Utilit y script
 def restart_script():
     """
@@ -431,6 +959,7 @@ def restart_script():
     TODO: Need to cleanup threads, as well as let the WTC and ground know whats 
     going on
     """
+    LogWriter.flushAll()
     pi = pigpio.pi()
     sleep(1)
 
@@ -32,6 +32,9 @@ import qpaceScheduler as schedule
 import SC16IS750
 import sys
 import qpaceControl as states
+import qpaceMetrics
+import qpaceTimeSeries
+import qpaceTracer
 
 
 try:
@@ -88,17 +91,22 @@ def initWTCConnection():
 		chip.packetBuffer = []
 
 		# Reset TX and RX FIFOs
+		# The reset needs two XTAL1 clocks, which is far less than one I2C transaction, so the
+		# next write can go out in the same batch.
 		fcr = SC16IS750.FCR_TX_FIFO_RESET | SC16IS750.FCR_RX_FIFO_RESET
-		chip.byte_write(SC16IS750.REG_FCR, fcr)
-		time.sleep(2.0/XTAL_FREQ)
+		chip.queue_register('FCR', fcr)
 
 		# Enable FIFOs and set RX FIFO trigger level
 		fcr = SC16IS750.FCR_FIFO_ENABLE | SC16IS750.FCR_RX_TRIGGER_56_BYTES
-		chip.byte_write(SC16IS750.REG_FCR, fcr)
+		chip.queue_register('FCR', fcr)
 
-		# Enable RX error and RX ready interrupts
+		# Enable RX error and RX ready interrupts. TX ready is left off: the driver waits out the wire time for FIFO space.
 		ier = SC16IS750.IER_RX_ERROR | SC16IS750.IER_RX_READY
-		chip.byte_write_verify(SC16IS750.REG_IER, ier)
+		chip.queue_register('IER', ier)
+
+		# All of the above is one bus transaction. IER is read back as a check.
+		if not chip.commit('IER'):
+			logger.logError('SC16IS740 IER did not match the value written during init')
 
 		return chip
 
@@ -142,7 +150,10 @@ class Queue():
 		self.name = name
 		self.suppress = suppressLog
 		self.response = None
+		self.cv = threading.Condition()
 		self.logger=logger
+		qpaceMetrics.gauge('queue.{}.depth'.format(name), self.__len__)
+		self.peak = qpaceMetrics.gauge('queue.{}.peak'.format(name)) # The most items it has held at once
 		if self.logger:
 			self.logger.logSystem('{}: Initializing...'.format(name))
 		else:
@@ -171,6 +182,7 @@ class Queue():
 	# def NextQueue.isFull():
 	# 	return len(internalQueue) >= NextQueue.MAX
 
+	@qpaceTracer.traced('Queue.enqueue', 'queue')
 	def enqueue(self,item,prepend=False):
 		"""
 		Enqueue an item to the queue.
@@ -188,12 +200,11 @@ class Queue():
 		"""
 
 		if not self.suppress:
+			# The message is only formatted if system logging for this queue is on.
 			if not isinstance(item,int) and len(item) > 32:# If we are logging something quite long, don't include it in the log
-				logMessage = 'data (len:{}) [{}]'.format(len(item),item[:10])
+				self.logger.logSystem("%s: Adding data (len:%d) [%s] to the queue.",self.name,len(item),item[:10])
 			else:
-				logMessage = "'{}'".format(item)
-
-			self.logger.logSystem("{}: Adding {} to the queue.".format(self.name,logMessage))
+				self.logger.logSystem("%s: Adding '%s' to the queue.",self.name,item)
 
 		if item in states.QPCONTROL:
 			item = states.QPCONTROL[item]
@@ -203,6 +214,7 @@ class Queue():
 		else:
 			self.internalQueue.append(item)
 		self.enqueueCount += 1
+		self.peak.max(len(self.internalQueue))
 
 	def peek(self):
 		"""
@@ -242,10 +254,9 @@ class Queue():
 
 			if not self.suppress:
 				if not isinstance(item,int) and len(item) > 32:# If we are logging something quite long, don't include it in the log
-					logMessage = 'data (len:{}) [{}]'.format(len(item),item[:10])
+					self.logger.logSystem("%s: Removed item from queue: data (len:%d) [%s]",self.name,len(item),item[:10])
 				else:
-					logMessage = "'{}'".format(item)
-				self.logger.logSystem("{}: Removed item from queue: {}".format(self.name,logMessage))
+					self.logger.logSystem("%s: Removed item from queue: '%s'",self.name,item)
 
 			return item
 
@@ -293,23 +304,15 @@ class Queue():
 		Raises: None
 
 		"""
-		if type(response) is int:
-			response = hex(response)
-		self.logger.logSystem("{}: Adding a response. '{}' must be read before continuing... Will wait {} seconds before removing the response".format(self.name,response,timeout))
+		self.logger.logSystem("{}: Adding a response. '{}' must be read before continuing... Will wait {} seconds before removing the response".format(self.name,hex(response) if type(response) is int else response,timeout))
 		try:
-			self.response = response
-			pollingDelay = .5
-			fragments = timeout/pollingDelay
-			counter = 0
-			while True:
-				if self.response is None:
+			with self.cv:
+				self.response = response
+				self.cv.notify_all()
+				if self.cv.wait_for(lambda: self.response is None, timeout):
 					self.logger.logSystem("{}: Response was read... continuing on.".format(self.name))
-					break
-				if counter >= fragments:
+				else:
 					self.logger.logSystem("{}: Response was not read: Timeout!".format(self.name))
-					break
-				time.sleep(pollingDelay)
-				counter+=1
 		except:
 			self.logger.logError("{}: Was not able to wait for response to be read.".format(self.name))
 
@@ -328,21 +331,15 @@ class Queue():
 		"""
 		self.logger.logSystem("{}: Someone is waiting for the response to be read. (Timeout={})".format(self.name,timeout))
 		try:
-			pollingDelay = .5
-			fragments = timeout/pollingDelay
-			counter = 0
-			while True:
-				if self.response is not None:
+			with self.cv:
+				if self.cv.wait_for(lambda: self.response is not None, timeout):
 					self.logger.logSystem("{}: Response was found... continuing on. Response: {}".format(self.name,self.response))
-					break
-				if counter >= fragments:
+				else:
 					self.logger.logSystem("{}: Response was not read: Timeout!".format(self.name))
-					break
-				time.sleep(pollingDelay)
-				counter+=1
-			response = self.response
-			self.response = None
-			return response
+				response = self.response
+				self.response = None
+				self.cv.notify_all()
+				return response
 		except:
 			self.logger.logError("{}: Was not able to wait for response to be read.".format(self.name))
 
@@ -357,7 +354,9 @@ class Queue():
 		Raises: None
 
 		"""
-		self.response = None
+		with self.cv:
+			self.response = None
+			self.cv.notify_all()
 
 def graveyardHandler(runEvent,shutdownEvent,logger):
 	"""
@@ -480,11 +479,11 @@ def healthCheck(logger):
 	#logger.logSystem('HealthCheck: Beginning health check to ensure all directories and files exist.')
 	# Important scripts. If one of them are missing, then abort.
 	criticalFiles = ('qpaceExperiment.py','qpaceExperimentParser.py','qpaceTagChecker.py','qpaceFileHandler.py','qpaceInterpreter.py','qpaceLogger.py','qpaceMain.py',
-					'qpacePiCommands.py','qpaceControl.py', 'qpaceScheduler.py', 'SC16IS750.py')
+					'qpacePiCommands.py','qpaceControl.py', 'qpaceScheduler.py', 'qpaceExecutor.py', 'qpaceLogFormat.py', 'qpaceMetrics.py', 'qpaceTimeSeries.py', 'qpaceTracer.py', 'SC16IS750.py')
 	# Paths/files that must exist for proper operation. Create them if necessary. Non-critical
 	importantPaths = ('graveyard/grave.ledger')
 	# Directories that must exist for proper operation. Create them if necessary. Critical to have, but can be created at runtime.
-	importantDir = ('data','data/backup','data/exp','data/misc','data/pic','data/text','data/vid',
+	importantDir = ('data','data/backup','data/exp','data/misc','data/misc/macros','data/pic','data/text','data/vid',
 					'graveyard', 'logs', 'Scripts', 'temp')
 	paths = []
 	directories = []
@@ -554,7 +553,7 @@ def run(logger):
 			runEvent = threading.Event()
 			shutdownEvent = threading.Event()
 			scheduleEmpty = threading.Event()
-			disableCallback = threading.Event()
+			disableCallback = qpi.CallbackSwitch()
 			# Ensure these are in the state we want them in.
 			runEvent.set()
 			experimentRunningEvent.clear()
@@ -570,16 +569,25 @@ def run(logger):
 			interpreter = threading.Thread(target=qpi.run,args=(chip,nextQueue,packetQueue,experimentRunningEvent,runEvent,shutdownEvent,disableCallback,logger))
 			scheduler = threading.Thread(target=schedule.run,args=(chip,nextQueue,packetQueue,experimentRunningEvent,runEvent,shutdownEvent,scheduleEmpty,disableCallback,logger))
 			graveyardThread = threading.Thread(target=graveyardHandler,args=(runEvent,shutdownEvent,logger))
+			# The telemetry history is nice to have. If its file can't be opened QPACE runs without it.
+			try:
+				collector = qpaceTimeSeries.Collector(qpaceTimeSeries.shared())
+			except (OSError, ValueError) as err:
+				logger.logError('Main: Could not open the time series store. Not collecting telemetry.', err)
+				collector = None
+			collectorThread = threading.Thread(target=collector.run,args=(shutdownEvent,logger)) if collector else None
 
 			logger.logSystem("Main: Starting up threads.")
 			interpreter.start() # Run the Interpreter
 			scheduler.start() # Run the Scheduler
 			graveyardThread.start() # Run the graveyard
+			if collectorThread: collectorThread.start() # Run the telemetry collector
 
 
 			interpreterAttempts = 0
 			schedulerAttempts = 0
 			graveyardAttempts = 0
+			collectorAttempts = 0
 
 			# The big boy main loop. Good luck QPACE.
 			while True:
@@ -589,7 +597,7 @@ def run(logger):
 						break
 
 					# Check the interpreter, restart if necessary. The Interpreter should always be running and never shutdown early.
-					if not interpreter.isAlive() and interpreterAttempts < THREAD_ATTEMPT_MAX:
+					if not interpreter.is_alive() and interpreterAttempts < THREAD_ATTEMPT_MAX:
 						logger.logSystem("Main: Interpreter is shutdown when it should not be. Attempt {} at restart.".format(interpreterAttempts + 1))
 						disableCallback.clear()
 						interpreter = threading.Thread(target=qpi.run,args=(chip,nextQueue,packetQueue,experimentRunningEvent,runEvent,shutdownEvent,disableCallback,logger))
@@ -597,19 +605,26 @@ def run(logger):
 						interpreterAttempts += 1
 
 					# Check the Scheduler, restart it if necessary. The Scheduler is allowed to be shutdown early.
-					if not scheduler.isAlive() and not scheduleEmpty.is_set() and schedulerAttempts < THREAD_ATTEMPT_MAX:
+					if not scheduler.is_alive() and not scheduleEmpty.is_set() and schedulerAttempts < THREAD_ATTEMPT_MAX:
 						logger.logSystem('Main: Scheduler is shutdown when it should not be.  Attempt {} at restart.'.format(schedulerAttempts + 1))
-						scheduler = threading.Thread(target=todo.run,args=(chip,nextQueue,packetQueue,experimentRunningEvent,runEvent,shutdownEvent,scheduleEmpty,disableCallback,logger))
+						scheduler = threading.Thread(target=schedule.run,args=(chip,nextQueue,packetQueue,experimentRunningEvent,runEvent,shutdownEvent,scheduleEmpty,disableCallback,logger))
 						scheduler.start()
-						scheduler += 1
+						schedulerAttempts += 1
 
 					# Check the graveyard, restart it if necessary. The graveyard shouldn't be shutdown but it doesn't really matter
-					if not graveyardThread.isAlive() and graveyardAttempts < THREAD_ATTEMPT_MAX:
+					if not graveyardThread.is_alive() and graveyardAttempts < THREAD_ATTEMPT_MAX:
 						logger.logSystem('Main: Graveyard is shutdown when it should not be.  Attempt {} at restart.'.format(graveyardAttempts + 1))
 						graveyardThread = threading.Thread(target=graveyardHandler,args=(runEvent,shutdownEvent,logger))
 						graveyardThread.start()
 						graveyardAttempts += 1
 
+					# Check the collector, restart it if necessary. Nothing depends on it, so it doesn't count towards giving up.
+					if collectorThread and not collectorThread.is_alive() and collectorAttempts < THREAD_ATTEMPT_MAX:
+						logger.logSystem('Main: Collector is shutdown when it should not be.  Attempt {} at restart.'.format(collectorAttempts + 1))
+						collectorThread = threading.Thread(target=collector.run,args=(shutdownEvent,logger))
+						collectorThread.start()
+						collectorAttempts += 1
+
 					# If all the threads have tried to start and they couln't then just thrown an exception and leave. there's not point to life anymore.
 					if interpreterAttempts + schedulerAttempts + graveyardAttempts == THREAD_ATTEMPT_MAX * 3:
 						welp_oh_no = "Main: All threads are closed and could not be started. Exiting."
@@ -646,6 +661,8 @@ def run(logger):
 	if interpreter.ident is not None: interpreter.join()
 	if scheduler.ident is not None: scheduler.join()
 	if graveyardThread.ident is not None: graveyardThread.join()
+	if collectorThread and collectorThread.ident is not None: collectorThread.join()
+	logger.flush() # The log writer holds lines in memory; get them onto the card first.
 
 	# If we want the pi to shutdown automattically, then do so.
 	if ALLOW_SHUTDOWN:
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# qpaceMetrics.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Counters, gauges and fixed-bucket histograms shared by every part of the flight software, so the numbers
+# performance tuning needs can come down from orbit. A metric is registered the first time it is asked for
+# by name, and every later call gets the same one back, so instrumenting code is one line:
+#
+#	qpaceMetrics.counter('interpreter.packetsIn').inc()
+#	qpaceMetrics.histogram('interpreter.handshakeMs', qpaceMetrics.LATENCY_MS).observe(ms)
+#
+# The registry packs into TELEM packets (pack()) for the tm command and the status response, and
+# formats as text for the status file, which also lists the id each name has in the packets. Ground
+# decodes TELEM packets with unpack(), or by running this file with the hex of a packet's data.
+
+import struct
+import sys
+import threading
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+
+import qpaceLogFormat
+
+# Bucket upper bounds. Anything above the last one lands in an overflow bucket.
+LATENCY_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+SECONDS = (1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+COUNTER = 0
+GAUGE = 1
+HISTOGRAM = 2
+TELEM_HEADER = struct.Struct('>IBBB') # time.time() of the snapshot, part, number of parts, metrics in this part
+
+class Counter():
+	"""A number that only goes up."""
+	kind = COUNTER
+
+	def __init__(self, name):
+		self.name = name
+		self.lock = threading.Lock()
+		self.count = 0
+
+	def inc(self, n = 1):
+		with self.lock:
+			self.count += n
+
+	def value(self):
+		return self.count
+
+class Gauge():
+	"""
+	A number that goes up and down. If function is given the gauge reads it when a snapshot is taken instead
+	of being set, so existing counters (e.g. qpaceLogger.Errors) can be exposed without touching them.
+	"""
+	kind = GAUGE
+
+	def __init__(self, name, function = None):
+		self.name = name
+		self.lock = threading.Lock()
+		self.level = 0
+		self.function = function
+
+	def set(self, level):
+		self.level = level
+
+	def inc(self, n = 1):
+		with self.lock:
+			self.level += n
+
+	def dec(self, n = 1):
+		self.inc(-n)
+
+	def max(self, level):
+		"""Set the gauge to level if that is higher, for high water marks."""
+		with self.lock:
+			if level > self.level:
+				self.level = level
+
+	def value(self):
+		if self.function is not None:
+			try:
+				return self.function()
+			except Exception:
+				return 0
+		return self.level
+
+class Histogram():
+	"""Counts observations into fixed buckets, and keeps their number and sum."""
+	kind = HISTOGRAM
+
+	def __init__(self, name, buckets):
+		self.name = name
+		self.lock = threading.Lock()
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.total = 0.0
+
+	def observe(self, value):
+		i = bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.count += 1
+			self.total += value
+
+	def value(self):
+		with self.lock:
+			return {'count': self.count, 'sum': self.total, 'counts': list(self.counts)}
+
+class Registry():
+	"""Every metric by name, in the order they were registered."""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics = OrderedDict()
+		self.ids = {} # metricId: name, so two names sharing an id are caught when the second registers
+
+	def _get(self, name, cls, *args):
+		with self.lock:
+			metric = self.metrics.get(name)
+			if metric is None:
+				id = metricId(name)
+				if id in self.ids:
+					raise ValueError('Metric {} has the same TELEM id {:04x} as {}. Rename one of them.'.format(name, id, self.ids[id]))
+				self.ids[id] = name
+				metric = self.metrics[name] = cls(name, *args)
+			elif not isinstance(metric, cls):
+				raise TypeError('Metric {} is a {}, not a {}'.format(name, type(metric).__name__, cls.__name__))
+			return metric
+
+	def counter(self, name):
+		return self._get(name, Counter)
+
+	def gauge(self, name, function = None):
+		gauge = self._get(name, Gauge)
+		if function is not None:
+			gauge.function = function # The latest owner wins, e.g. a queue made again after a restart
+		return gauge
+
+	def histogram(self, name, buckets = LATENCY_MS):
+		return self._get(name, Histogram, buckets)
+
+	def snapshot(self):
+		"""
+		Returns: OrderedDict of name: (kind, value). A histogram's value is a dict with 'count', 'sum', 'counts'
+		and 'buckets'.
+		"""
+		with self.lock:
+			metrics = list(self.metrics.values())
+		snapshot = OrderedDict()
+		for metric in metrics:
+			value = metric.value()
+			if metric.kind == HISTOGRAM:
+				value['buckets'] = metric.buckets
+			snapshot[metric.name] = (metric.kind, value)
+		return snapshot
+
+	@staticmethod
+	def format(snapshot):
+		lines = ['Metrics: {} registered'.format(len(snapshot))]
+		for name, (kind, value) in snapshot.items():
+			if kind == HISTOGRAM:
+				mean = value['sum'] / value['count'] if value['count'] else 0
+				buckets = ' '.join('<={}:{}'.format(bound, n) for bound, n in zip(value['buckets'], value['counts']) if n)
+				overflow = value['counts'][-1]
+				lines.append('  {} [{:04x}] n={} mean={:.1f} {}{}'.format(name, metricId(name), value['count'], mean, buckets,
+					' >{}:{}'.format(value['buckets'][-1], overflow) if overflow else ''))
+			else:
+				lines.append('  {} [{:04x}] {}'.format(name, metricId(name), value))
+		return '\n'.join(lines)
+
+def metricId(name):
+	"""The 2 byte id a metric has in TELEM packets. Ground computes it from the name too."""
+	return zlib.crc32(name.encode('ascii')) & 0xFFFF
+
+def packMetric(name, kind, value):
+	"""
+	id (2 bytes), kind (1 byte), then varints: a counter's value, a gauge's value rounded and zigzag'd, or a
+	histogram's count, rounded sum, number of buckets and bucket counts.
+	"""
+	out = struct.pack('>HB', metricId(name), kind)
+	if kind == COUNTER:
+		return out + qpaceLogFormat.packVarint(int(value))
+	if kind == GAUGE:
+		return out + qpaceLogFormat.packSigned(int(round(value)))
+	out += qpaceLogFormat.packVarint(value['count']) + qpaceLogFormat.packSigned(int(round(value['sum'])))
+	out += qpaceLogFormat.packVarint(len(value['counts']))
+	return out + b''.join(qpaceLogFormat.packVarint(n) for n in value['counts'])
+
+def pack(snapshot, when, size):
+	"""
+	Split a snapshot into TELEM packet data. Each part is TELEM_HEADER then whole metrics, padded with 0x04.
+
+	Parameters:
+	snapshot - from Registry.snapshot()
+	when - float - time.time() of the snapshot
+	size - int - bytes of data in a packet
+
+	Returns: list of bytes
+
+	Raises: None
+	"""
+	room = size - TELEM_HEADER.size
+	parts = [[b'', 0]]
+	for name, (kind, value) in snapshot.items():
+		metric = packMetric(name, kind, value)
+		if len(metric) > room:
+			continue
+		if len(parts[-1][0]) + len(metric) > room:
+			parts.append([b'', 0])
+		parts[-1][0] += metric
+		parts[-1][1] += 1
+	return [TELEM_HEADER.pack(int(when), n, len(parts), count) + part + b'\x04' * (room - len(part)) for n, (part, count) in enumerate(parts)]
+
+def unpack(data):
+	"""
+	Decode the data of one TELEM packet.
+
+	Returns: (time, part, parts, list of (id, kind, value))
+
+	Raises: IndexError, ValueError if the data is damaged.
+	"""
+	when, part, parts, count = TELEM_HEADER.unpack_from(data)
+	reader = qpaceLogFormat.Reader(data)
+	reader.pos = TELEM_HEADER.size
+	metrics = []
+	for _ in range(count):
+		id, kind = struct.unpack('>HB', reader.bytes(3))
+		if kind == COUNTER:
+			value = reader.varint()
+		elif kind == GAUGE:
+			value = reader.signed()
+		elif kind == HISTOGRAM:
+			observations, total = reader.varint(), reader.signed()
+			value = {'count': observations, 'sum': total, 'counts': [reader.varint() for _ in range(reader.varint())]}
+		else:
+			raise ValueError('Unknown metric kind {}'.format(kind))
+		metrics.append((id, kind, value))
+	return when, part, parts, metrics
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+if __name__ == '__main__':
+	for arg in sys.argv[1:]:
+		when, part, parts, metrics = unpack(bytes.fromhex(arg))
+		print('TELEM {} part {}/{}'.format(when, part + 1, parts))
+		for id, kind, value in metrics:
+			print('  {:04x} {}'.format(id, value))
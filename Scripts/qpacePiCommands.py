@@ -14,10 +14,21 @@ from subprocess import check_output,Popen
 from math import ceil
 from time import strftime,gmtime,sleep
 import threading
+import time
+import hashlib
+from collections import OrderedDict
 import datetime
 import random
 import tarfile
+import re
+import json
+import struct
+import zlib
 import qpaceLogger as qpLog
+import qpaceLogFormat
+import qpaceMetrics
+import qpaceTimeSeries
+import qpaceTracer
 import traceback
 import qpaceExperimentParser as exp
 import socket
@@ -35,6 +46,7 @@ MISCPATH = '/home/pi/data/misc/'
 TEXTPATH = '/home/pi/data/text/'
 TEMPPATH = '/home/pi/temp/'
 ROOTPATH = '/home/pi/'
+MACROPATH = MISCPATH + 'macros/'
 
 def generateChecksum(data):
 	"""
@@ -59,6 +71,431 @@ def generateChecksum(data):
 	checksum &= 0xFFFFFFFF
 	return checksum.to_bytes(4,byteorder='big')
 
+class ReplayCache():
+	"""
+	Remembers the response packets of recent commands so a command ground re-sends because the response
+	was lost is answered from here instead of being run again.
+
+	Entries are keyed by (command, digest of the arguments, tag) and kept for REPLAY_WINDOW seconds, at most
+	REPLAY_MAX of them. Responses are captured as CMDPacket.send() enqueues them on the thread running the command.
+	"""
+	REPLAY_WINDOW = 1200 # in seconds
+	REPLAY_MAX = 32
+	local = threading.local() # Packets sent by the command running on this thread
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.entries = OrderedDict() # key: {'time', 'packets' (None while running), 'hits'}
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def key(command, args, tag):
+		return (bytes(command), hashlib.sha1(bytes(args)).hexdigest(), bytes(tag))
+
+	@staticmethod
+	def capture(packet):
+		"""Record a packet sent by a command that is being recorded on this thread."""
+		recorder = getattr(ReplayCache.local, 'packets', None)
+		if recorder is not None:
+			recorder.append(packet)
+
+	def _expire(self):
+		now = time.time()
+		while self.entries:
+			key, entry = next(iter(self.entries.items()))
+			if now - entry['time'] <= ReplayCache.REPLAY_WINDOW and len(self.entries) <= ReplayCache.REPLAY_MAX:
+				break
+			self.entries.popitem(last=False)
+
+	def contains(self, key):
+		"""
+		Parameters: key - from ReplayCache.key()
+
+		Returns: True if the command was run (or is running) inside the window.
+
+		Raises: None
+		"""
+		with self.lock:
+			self._expire()
+			return key in self.entries
+
+	def begin(self, key):
+		"""
+		Claim key for a command that is about to run.
+
+		Parameters: key - from ReplayCache.key()
+
+		Returns:
+		(True, None) if the command should run.
+		(False, packets) if it is a replay. packets is None if the first copy is still running.
+
+		Raises: None
+		"""
+		with self.lock:
+			self._expire()
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				self.entries[key] = {'time': time.time(), 'packets': None, 'hits': 0}
+				self._expire()
+				return True, None
+			self.hits += 1
+			entry['hits'] += 1
+			return False, entry['packets']
+
+	def run(self, key, function, *args):
+		"""
+		Run a command claimed with begin() and store the packets it sends. If it fails the key is released so a
+		retry runs it again.
+
+		Parameters:
+		key - from ReplayCache.key()
+		function - the Command method
+		*args - its arguments
+
+		Returns: None
+
+		Raises: Whatever the command raises.
+		"""
+		ReplayCache.local.packets = []
+		try:
+			function(*args)
+		except BaseException:
+			self.release(key)
+			raise
+		finally:
+			packets = ReplayCache.local.packets
+			ReplayCache.local.packets = None
+		with self.lock:
+			if key in self.entries:
+				self.entries[key]['packets'] = packets
+
+	def release(self, key):
+		"""Forget key so the next copy of the command runs. Used when the command failed or could not be started."""
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def snapshot(self):
+		with self.lock:
+			self._expire()
+			return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+class ResponseAggregator():
+	"""
+	Packs short command responses into one AGGRG packet so they cost one download instead of one each.
+
+	A response is held for up to LATENCY_BUDGET seconds waiting for others to share its packet. It goes out sooner if
+	the next one does not fit, if its opcode is in CRITICAL or if the WTC asks for a packet while the queue is empty.
+	A response held alone is sent as it was built, so nothing changes when there is nothing to pack it with.
+
+	Each record is type (1 byte, index of the response's opcode in RECORD_TYPES) + length (1 byte) + payload. The payload
+	is the response's data (the plaintext for a privileged response) with the trailing padding removed, so ground gets
+	the original back by padding it again. A packet holding a privileged response is sent as a PrivilegedPacket with
+	opcode AGGR* instead of AGGRG.
+	"""
+	LATENCY_BUDGET = .2 # in seconds
+	RECORD_TYPES = (b'NOOP*', b'STATS', b'TOMP4', b'DOWNR', b'HANDB', b'EXPMT', b'BATCH', b'MACRO', b'LOGLV', b'LOGQR', b'LOGQD', b'LOGTH', b'LOGTA', b'TELEM', b'TSDAT', b'TRACE')
+	CRITICAL = (b'STATS', b'DOWNR') # Ground waits on status, and DOWNR has to go ahead of the file's data packets.
+	RECORD_HEADER = 2 # Bytes
+
+	def __init__(self, packetQueue, budget = LATENCY_BUDGET):
+		self.packetQueue = packetQueue
+		self.budget = budget
+		self.lock = threading.RLock()
+		self.records = [] # (type, payload, the packet as it was built)
+		self.privileged = False
+		self.size = 0
+		self.timer = None
+		self.responses = 0
+		self.aggregated = 0
+		self.packets = 0
+		self.direct = 0
+
+	@staticmethod
+	def capacity(privileged):
+		return Command.PrivilegedPacket.encoded_data_length if privileged else Command.CMDPacket.data_size
+
+	@staticmethod
+	def record(packet):
+		"""
+		Parameters: packet - Command.CMDPacket or Command.PrivilegedPacket
+
+		Returns: (type, payload, privileged), or None if the packet can't be packed.
+
+		Raises: None
+		"""
+		if packet.opcode not in ResponseAggregator.RECORD_TYPES:
+			return None
+		privileged = isinstance(packet, Command.PrivilegedPacket)
+		payload = packet.plainText if privileged else packet.packetData
+		if payload is None:
+			return None
+		return ResponseAggregator.RECORD_TYPES.index(packet.opcode), payload.rstrip(Command.CMDPacket.padding_byte), privileged
+
+	def add(self, packet, sendData):
+		"""
+		Hold a response to be packed with others.
+
+		Parameters:
+		packet - Command.CMDPacket - the response
+		sendData - bytes - the response as it was built, sent unchanged if nothing joins it
+
+		Returns: True if the response is held. False if the caller should enqueue sendData itself, which it can do
+		straight away since anything held before it has been flushed.
+
+		Raises: None
+		"""
+		record = ResponseAggregator.record(packet)
+		with self.lock:
+			self.responses += 1
+			if record is None or ResponseAggregator.RECORD_HEADER + len(record[1]) > ResponseAggregator.capacity(record[2]):
+				self._flush()
+				self.direct += 1
+				return False
+			type, payload, privileged = record
+			size = self.size + ResponseAggregator.RECORD_HEADER + len(payload)
+			if size > ResponseAggregator.capacity(privileged or self.privileged):
+				self._flush()
+			self.records.append((type, payload, sendData))
+			self.privileged = self.privileged or privileged
+			self.size += ResponseAggregator.RECORD_HEADER + len(payload)
+			if packet.opcode in ResponseAggregator.CRITICAL:
+				self._flush()
+			elif self.timer is None:
+				self.timer = threading.Timer(self.budget, self.flush)
+				self.timer.daemon = True
+				self.timer.start()
+			return True
+
+	def _flush(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if not self.records:
+			return
+		if len(self.records) == 1:
+			self.packetQueue.enqueue(self.records[0][2])
+			self.direct += 1
+		else:
+			data = b''.join(bytes([type, len(payload)]) + payload for type, payload, sendData in self.records)
+			data += Command.CMDPacket.padding_byte * (ResponseAggregator.capacity(self.privileged) - len(data))
+			if self.privileged:
+				packet = Command.PrivilegedPacket(opcode='AGGR*', plainText=data)
+			else:
+				packet = Command.CMDPacket(opcode='AGGRG', data=data)
+			self.packetQueue.enqueue(packet.build())
+			self.aggregated += len(self.records)
+			self.packets += 1
+		self.records = []
+		self.privileged = False
+		self.size = 0
+
+	def flush(self):
+		"""Enqueue whatever is held now."""
+		with self.lock:
+			self._flush()
+
+	def pending(self):
+		with self.lock:
+			return len(self.records)
+
+	def clear(self):
+		"""Drop whatever is held, for when the packetQueue is cleared."""
+		with self.lock:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+			self.records = []
+			self.privileged = False
+			self.size = 0
+
+	def snapshot(self):
+		with self.lock:
+			return {'responses': self.responses, 'aggregated': self.aggregated, 'packets': self.packets, 'direct': self.direct,
+					'pending': len(self.records), 'saved': self.aggregated - self.packets}
+
+	@staticmethod
+	def format(snapshot):
+		return ('Aggregator: {responses} responses, {aggregated} packed into {packets} packets ({saved} packets saved), '
+				'{direct} sent alone, {pending} held').format(**snapshot)
+
+class LogTail():
+	"""
+	Sends ground only the part of the current log it doesn't have yet.
+
+	Ground acknowledges how far it has each log (la), and the offset is kept in TAIL_STATE so it survives reboots. A tail
+	is the bytes after it, as many as fit in the packets allowed once zlib compressed: a LOGTH packet (HEADER, then
+	the log's name) followed by LOGTL packets (sequence number, then compressed bytes). Ground appends the
+	decompressed bytes to its copy of the log and acknowledges the end offset.
+
+	Logs are told apart by inode as well as name, so a log renamed by setBoot keeps its offset. A different file
+	under the same name was rotated (see qpaceLogger.LogWriter), so its tail starts again from 0 with ROTATED set in
+	the flags. The segment rotated out is in the archive, where lq can search it.
+
+	With fill on, the interpreter asks for a tail whenever the WTC polls and nothing else is waiting, at most every
+	FILL_INTERVAL seconds and once FILL_BYTES are new. It answers the poll first and runs the tail on the executor,
+	so the reading and compressing never hold up the handshake. Fill carries on from what was last sent instead of what was
+	acknowledged so it doesn't send the same bytes twice. lt always starts from the acknowledged offset.
+	"""
+	TAIL_STATE = MISCPATH + 'logtail.json'
+	TAIL_PACKETS = 16 # LOGTL packets in a tail unless lt asks for another number
+	FILL_INTERVAL = 60 # in seconds
+	FILL_BYTES = 2048
+	FILL_PACKETS = 8
+	HEADER = struct.Struct('>IIIBB') # start offset, end offset, compressed length, LOGTL packets, flags
+	MAX_PACKETS = 255 # LOGTL packets a tail can take: the count in HEADER and the sequence number are a byte each
+	ROTATED = 1
+
+	def __init__(self, logger):
+		self.logger = logger
+		self.lock = threading.Lock()
+		self.fill = False
+		self.lastFill = 0
+		self.sent = {} # name: offset sent up to, for fill
+		self.tails = 0
+		self.rawBytes = 0
+		self.packets = 0
+		try:
+			with open(LogTail.TAIL_STATE, 'r') as stateFile:
+				self.acked = json.load(stateFile) # name: {'inode', 'offset'}
+		except (OSError, ValueError):
+			self.acked = {}
+
+	def _save(self):
+		"""Write the acknowledged offsets, forgetting logs that are gone. Caller holds self.lock."""
+		for name in [name for name in self.acked if not os.path.exists(qpLog.Logger.LOG_PATH + name)]:
+			del self.acked[name]
+		try:
+			with open(LogTail.TAIL_STATE + '.tmp', 'w') as stateFile:
+				json.dump(self.acked, stateFile)
+			os.replace(LogTail.TAIL_STATE + '.tmp', LogTail.TAIL_STATE)
+		except OSError as e:
+			self.logger.logError('LogTail: Could not save the acknowledged offsets.', e)
+
+	def _entry(self, name, inode):
+		"""The acknowledged entry for the current log, following a rename or starting over after a rotation. Caller holds self.lock."""
+		entry = self.acked.get(name)
+		if entry is not None and entry['inode'] == inode:
+			return entry, 0
+		renamed = [old for old, other in self.acked.items() if other['inode'] == inode]
+		if renamed:
+			entry = self.acked[name] = self.acked.pop(renamed[0])
+			self.sent[name] = self.sent.pop(renamed[0], entry['offset'])
+			return entry, 0
+		flags = LogTail.ROTATED if name in self.acked else 0
+		entry = self.acked[name] = {'inode': inode, 'offset': 0}
+		self.sent[name] = 0
+		return entry, flags
+
+	def acknowledge(self, name, offset):
+		"""
+		Record that ground has a log up to offset.
+
+		Parameters:
+		name - str - the log's name as the LOGTH packet gave it
+		offset - int - the end offset of the last tail ground has
+
+		Returns: False if the log is not being tailed.
+
+		Raises: None
+		"""
+		with self.lock:
+			entry = self.acked.get(name)
+			if entry is None:
+				return False
+			entry['offset'] = offset
+			self.sent[name] = max(self.sent.get(name, 0), offset)
+			self._save()
+			return True
+
+	def tail(self, maxPackets = TAIL_PACKETS, minBytes = 0, fromAcked = True):
+		"""
+		Build the next tail of the current log.
+
+		Parameters:
+		maxPackets - int - LOGTL packets the tail may take. Kept to 1..MAX_PACKETS.
+		minBytes - int - return nothing if fewer new bytes than this are waiting
+		fromAcked - bool - start at the acknowledged offset (True) or after what was last sent (False)
+
+		Returns: list of Command.CMDPacket - LOGTH then the LOGTL packets. Only LOGTH if nothing is new. Empty if
+		fewer than minBytes are new.
+
+		Raises: OSError if the log can't be read.
+		"""
+		size = Command.CMDPacket.data_size
+		chunk = size - 1
+		maxPackets = min(max(maxPackets, 1), LogTail.MAX_PACKETS)
+		with self.lock:
+			path = self.logger.writer().path
+			name = os.path.basename(path)
+			info = os.stat(path)
+			entry, flags = self._entry(name, info.st_ino)
+			start = entry['offset'] if fromAcked else max(entry['offset'], self.sent.get(name, 0))
+			if start > info.st_size:
+				start, flags = 0, flags | LogTail.ROTATED
+			if minBytes and info.st_size - start < minBytes:
+				return []
+			with open(path, 'rb') as logFile:
+				logFile.seek(start)
+				raw = logFile.read(maxPackets * chunk * 8) # Logs compress well, so read more than fits uncompressed
+			compressed = zlib.compress(raw, 9)
+			while len(compressed) > maxPackets * chunk:
+				raw = raw[:len(raw) * maxPackets * chunk * 9 // (len(compressed) * 10)]
+				compressed = zlib.compress(raw, 9)
+			end = start + len(raw)
+			count = (len(compressed) + chunk - 1) // chunk
+			self.sent[name] = end
+			self.tails += 1
+			self.rawBytes += len(raw)
+			self.packets += count + 1
+		header = LogTail.HEADER.pack(start, end, len(compressed), count, flags) + name.encode('ascii')
+		packets = [Command.CMDPacket(opcode='LOGTH', data=header + Command.CMDPacket.padding_byte * (size - len(header)))]
+		for n in range(count):
+			data = bytes([n]) + compressed[n * chunk:(n + 1) * chunk]
+			packets.append(Command.CMDPacket(opcode='LOGTL', data=data + Command.CMDPacket.padding_byte * (size - len(data))))
+		return packets
+
+	def fillDue(self):
+		"""
+		Called by the interpreter when the WTC polls and nothing is waiting to go down. Cheap: only looks at the clock.
+
+		Returns: True if fill is on and a fill is due. The interval starts again, so call fillIdle() next.
+
+		Raises: None
+		"""
+		if not self.fill or time.time() - self.lastFill < LogTail.FILL_INTERVAL:
+			return False
+		self.lastFill = time.time()
+		return True
+
+	def fillIdle(self):
+		"""
+		Send a tail carrying on from what fill last sent, if FILL_BYTES are new. Run off the interpreter thread once
+		fillDue() says so.
+
+		Returns: True if packets were sent.
+
+		Raises: None
+		"""
+		try:
+			packets = self.tail(LogTail.FILL_PACKETS, LogTail.FILL_BYTES, fromAcked = False)
+		except OSError as e:
+			self.logger.logError('LogTail: Could not read the log for fill.', e)
+			return False
+		for packet in packets:
+			packet.send()
+		return bool(packets)
+
+	def snapshot(self):
+		with self.lock:
+			return {'fill': 'on' if self.fill else 'off', 'tails': self.tails, 'raw': self.rawBytes, 'packets': self.packets,
+					'acked': dict((name, entry['offset']) for name, entry in self.acked.items())}
+
+	@staticmethod
+	def format(snapshot):
+		return 'Log tail: fill {fill}, {tails} tails of {raw} bytes in {packets} packets, acknowledged {acked}'.format(**snapshot)
+
 class Command():
 	"""
 	Handler class for all commands. These will be invoked from the Interpreter.
@@ -74,6 +511,19 @@ class Command():
 	_packetQueue = None
 	_nextQueue = None
 	_tagChecker = None
+	_chip = None
+	_executor = None
+	_replayCache = None
+	_aggregator = None
+	_logTail = None
+	_experimentThread = None # The parser thread of the last experiment started by startExperiment
+	local = threading.local() # held: responses of the macro step running on this thread
+	BATCH_ARGS_LENGTH = 92 # Bytes of arguments a command gets in a NORM packet
+	BATCH_RESULTS = {'done': b'D', 'failed': b'F', 'unknown': b'U'} # Per record result in the BATCH response
+	MACRO_RESULTS = {'done': b'D', 'failed': b'F', 'skipped': b'S', 'missing': b'M'} # Per step result in the MACRO response
+	QUERY_PACKETS = 8 # LOGQR packets a log query sends unless it asks for another number
+	QUERY_LINE = 160 # Characters of a matching message that are sent
+	SERIES_PACKETS = 8 # TSDAT packets a time series range is downsampled to fit unless it asks for another number
 
 	def __init__(self,packetQueue=None,nextQueue=None,experimentEvent=None,shutdownEvent = None,disableCallback=None,tagChecker=None):
 		Command._packetQueue = packetQueue
@@ -115,6 +565,51 @@ class Command():
 	def setDisableCallback(self, disableCallback):
 		self.disableCallback = disableCallback
 
+	# Getters and Setters for self.chip (the SC16IS750 connection, used for bus statistics)
+	@property
+	def chip(self):
+		return Command._chip
+
+	@chip.setter
+	def chip(self,chip):
+		Command._chip = chip
+
+	# Getters and Setters for self.executor (the qpaceExecutor.CommandExecutor running slow commands)
+	@property
+	def executor(self):
+		return Command._executor
+
+	@executor.setter
+	def executor(self,executor):
+		Command._executor = executor
+
+	# Getters and Setters for self.replayCache (the ReplayCache answering re-sent commands)
+	@property
+	def replayCache(self):
+		return Command._replayCache
+
+	@replayCache.setter
+	def replayCache(self,replayCache):
+		Command._replayCache = replayCache
+
+	# Getters and Setters for self.aggregator (the ResponseAggregator packing short responses together)
+	@property
+	def aggregator(self):
+		return Command._aggregator
+
+	@aggregator.setter
+	def aggregator(self,aggregator):
+		Command._aggregator = aggregator
+
+	# Getters and Setters for self.logTail (the LogTail sending ground the new part of the log)
+	@property
+	def logTail(self):
+		return Command._logTail
+
+	@logTail.setter
+	def logTail(self,logTail):
+		Command._logTail = logTail
+
 	class CMDPacket():
 		"""
 		This is a class dedicated to handling packets used in responding to commands from Ground.
@@ -153,7 +648,7 @@ class Command():
 		def send(self):
 			"""
 			This method sends the data to the WTC  by enquing the data into the packetQueue and
-			then queining a SENDPACKET
+			then queining a SENDPACKET. Short responses go through the ResponseAggregator first.
 
 			Parameters
 			----------
@@ -168,8 +663,15 @@ class Command():
 			Any exception gets popped up the stack.
 			"""
 			if self.packetData:
+				held = getattr(Command.local, 'held', None)
+				if held is not None:
+					# A macro step's response feeds the later steps instead of going to ground.
+					held.append(self)
+					return
 				sendData = self.build()
-				Command._packetQueue.enqueue(sendData)
+				ReplayCache.capture(sendData)
+				if Command._aggregator is None or not Command._aggregator.add(self, sendData):
+					Command._packetQueue.enqueue(sendData)
 				#Command._nextQueue.enqueue('SENDPACKET')
 
 		def build(self):
@@ -227,6 +729,7 @@ class Command():
 			Any exception gets popped up the stack.
 			"""
 			tag = Command._tagChecker.getTag()
+			self.plainText = plainText
 			if self.tryEncryption:
 				self.getEncryptionKeys()
 
@@ -320,9 +823,26 @@ class Command():
 			status += b'LC('+LastCommand.type.encode('ascii')+b')'
 		except Exception as err:
 			logger.logError("Could not import LastCommand",err)
+		try:
+			# Share of time on the I2C bus and the number of pigpio errors, if it fits.
+			bus = Command._chip.snapshot()
+			bus = ':B({:.1f}%,{})'.format(100 * bus['busy'], sum(bus['errors'].values())).encode('ascii')
+			if len(status) + len(bus) <= 111:
+				status += bus
+		except Exception as err:
+			logger.logError("Could not get the bus statistics",err)
+		try:
+			# Running and queued commands, if it fits.
+			jobs = Command._executor.snapshot()
+			jobs = ':X({},{})'.format(len(jobs['running']), len(jobs['queued'])).encode('ascii')
+			if len(status) + len(jobs) <= 111:
+				status += jobs
+		except Exception as err:
+			logger.logError("Could not get the executor status",err)
 		data += status + b' '*(111-len(status)) # 111 defined in packet structure document r4a
 		if not silent:
 			Command.CMDPacket(opcode='STATS',data=data).send()
+		self.telemetry(logger, b'', silent)
 		if thread:
 			thread.join() # Make sure we wait for the thread to close if it's still going.
 
@@ -477,11 +997,10 @@ class Command():
 		if args[0].endswith('/'):
 			args[0] = args[0][:-1]
 		newFile = ROOTPATH + args[0][args[0].rfind('/')+1:]+'.tar'
-		tarDir = '{}.tar.gz'.format(newFile)
 		try:
 			with tarfile.open(newFile, "w:gz") as tar:
 				tar.add(ROOTPATH+args[0])
-			message = tarDir.encode('ascii')
+			message = newFile.encode('ascii')
 			logger.logSuccess('Successfully created ' + newFile)
 		except Exception as e:
 			logger.logError("Failed to make tar.\nException: {}".format(e))
@@ -500,10 +1019,11 @@ class Command():
 
 		encoded_filename = "{0}.encode".format(path)
 
-		if os.path.isfile(encoded_filename):
-			os.remove(encoded_filename)
+		# Next to the original, under ROOTPATH, where the size below and the Transmitter look for it.
+		if os.path.isfile(ROOTPATH + encoded_filename):
+			os.remove(ROOTPATH + encoded_filename)
 
-		with open(encoded_filename, "wb") as encodedFile:
+		with open(ROOTPATH + encoded_filename, "wb") as encodedFile:
 			encodedFile.write(data)
 
 		path = encoded_filename
@@ -535,8 +1055,9 @@ class Command():
 		import qpaceFileHandler as qfh
 		path = args[:].replace(b'\x04',b'').decode('ascii') # Now just reads the entire list
 
-		encodeThread = threading.Thread(name='file encoder',target=self.encodeFile, args=(path, silent))
-		encodeThread.start()
+		# Runs on the command executor, so the encode no longer needs its own thread. Doing it here
+		# also lets the replay cache see the DOWNR response.
+		self.encodeFile(path, silent)
 		"""
 		Create Encoded file for possible transmission.
 		If the file is able to be sent, then we will send
@@ -695,11 +1216,442 @@ class Command():
 		logger.logSystem("Command recieved: Running an experiment.", filename) # Placeholder
 		parserThread = threading.Thread(name='experimentParser',target=exp.run, args=(filename,self.experimentEvent,runEvent,logger,self.nextQueue,self.disableCallback))
 		parserThread.start()
+		Command._experimentThread = parserThread
 		if not silent:
 			data = bytes('Attempting to start experiment <{}> if it exists.'.format(filename), 'ascii')
 			data += Command.CMDPacket.padding_byte * (Command.CMDPacket.data_size - len(data))
 			Command.CMDPacket(opcode='EXPMT',data=data).send()
 
+	def batch(self,logger,args, silent=False):
+		"""
+		Run several commands from one uplinked packet, in order, and answer with one BATCH packet.
+
+		args holds records of command (2 bytes) + length (1 byte) + arguments (length bytes), packed back to
+		back and ended by padding. Each command still sends its own response. The BATCH packet has one
+		command (2 bytes) + result (1 byte) entry per record, where the result is one of BATCH_RESULTS.
+		Records are independent; one failing does not stop the rest. Each record runs as its own job (see
+		runRecord), one after another.
+		"""
+		from qpaceInterpreter import COMMANDS, BATCH_EXCLUDED
+		results = b''
+		for command, recordArgs in Command.parseBatch(args):
+			if command in BATCH_EXCLUDED or command not in COMMANDS:
+				logger.logSystem('Batch: Skipping unknown command <{}>.'.format(command))
+				result = Command.BATCH_RESULTS['unknown']
+			else:
+				logger.logSystem('Batch: Running <{}>.'.format(command))
+				# Commands expect arguments padded like a full packet.
+				recordArgs += Command.CMDPacket.padding_byte * (Command.BATCH_ARGS_LENGTH - len(recordArgs))
+				try:
+					self.runRecord(logger,command,recordArgs,silent=silent)
+					result = Command.BATCH_RESULTS['done']
+				except StopIteration as e:
+					logger.logSystem('Batch: <{}> stopped early <{}>.'.format(command, e))
+					result = Command.BATCH_RESULTS['failed']
+				except Exception as e:
+					logger.logError('Batch: <{}> failed.'.format(command), e)
+					result = Command.BATCH_RESULTS['failed']
+			results += command + result
+		if not silent:
+			data = results[:Command.CMDPacket.data_size]
+			data += Command.CMDPacket.padding_byte * (Command.CMDPacket.data_size - len(data))
+			Command.CMDPacket(opcode='BATCH',data=data).send()
+
+	def runRecord(self, logger, command, args, silent=False):
+		"""
+		Run one command of a batch or macro and wait for it. A command in COMMAND_RESOURCES is submitted to the executor
+		with its class and limit, like one uplinked on its own; the rest are quick and run on this thread. Either way its
+		responses go where they would from this thread (a macro's held responses, the replay cache).
+
+		Parameters:
+		logger - for logging
+		command - bytes - the command, not in BATCH_EXCLUDED
+		args - bytes - its arguments, padded
+		silent - passed on to the command
+
+		Returns: None
+
+		Raises: StopIteration if the executor is full or shut down, or whatever the command raised.
+		"""
+		from qpaceInterpreter import COMMANDS, COMMAND_RESOURCES
+		if command not in COMMAND_RESOURCES:
+			COMMANDS[command](logger,args,silent=silent)
+			return
+		held = getattr(Command.local, 'held', None)
+		packets = getattr(ReplayCache.local, 'packets', None)
+		def record():
+			Command.local.held, ReplayCache.local.packets = held, packets
+			try:
+				COMMANDS[command](logger,args,silent=silent)
+			finally:
+				Command.local.held = ReplayCache.local.packets = None
+		resource, limit = COMMAND_RESOURCES[command]
+		job = Command._executor.submit(command.decode('ascii'), record, (), resource, limit)
+		if job is None:
+			raise StopIteration('Command executor is full.')
+		job.wait()
+		if job.error is not None:
+			raise job.error
+		if job.state != 'done':
+			raise StopIteration('Job was {}.'.format(job.state))
+
+	@staticmethod
+	def parseBatch(args):
+		"""
+		Split the arguments of a batch command into its records.
+
+		Parameters: args - bytes - command (2) + length (1) + arguments records, ended by padding or the end of args
+
+		Returns: list of (command, arguments) tuples. A record cut short by the end of args is dropped.
+
+		Raises: None
+		"""
+		records = []
+		i = 0
+		while i + 3 <= len(args) and args[i:i+1] != Command.CMDPacket.padding_byte:
+			command = args[i:i+2]
+			length = args[i+2]
+			if i + 3 + length > len(args):
+				break
+			records.append((command, args[i+3:i+3+length]))
+			i += 3 + length
+		return records
+
+	def macro(self,logger,args, silent=False):
+		"""
+		Run a named macro stored on the Pi and answer with one MACRO packet.
+
+		args is the macro name followed by its parameters, separated by spaces. The macro is MACROPATH<name>.json:
+
+			{"steps": [{"command": "tc", "args": "$1"},
+					   {"command": "dr", "args": "@1"},
+					   {"task": "BACKUP", "args": "$1", "output": "data/backup/$1.tar.gz"},
+					   {"wait": "experiment"}]}
+
+		A step runs one of the interpreter COMMANDS, one of the scheduler tasks, or waits ("experiment" for the
+		running experiment to finish, or a number of seconds). In args and output, $N is the Nth parameter and @N is
+		the output of step N. A command's output is the text of its first response (with ROOTPATH removed), unless
+		the step gives its own output. Step responses feed the later steps and are not sent to ground.
+
+		The steps run in order, a command step as its own job (see runRecord), and the macro stops at the first step that fails. The MACRO packet
+		holds the name, a result per step from MACRO_RESULTS and the last step's output.
+		"""
+		args = args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii').split(' ')
+		name = args[0].replace('/', '').replace('..', '')
+		results = b''
+		output = ''
+		try:
+			with open('{}{}.json'.format(MACROPATH, name), 'r') as macroFile:
+				steps = json.load(macroFile)['steps']
+		except Exception as e:
+			logger.logError('Macro: Could not load <{}>.'.format(name), e)
+			steps = []
+			results = Command.MACRO_RESULTS['missing']
+		outputs = []
+		for number, step in enumerate(steps, 1):
+			try:
+				logger.logSystem('Macro: {} step {} <{}>.'.format(name, number, step))
+				output = self.runMacroStep(logger, step, args[1:], outputs)
+				outputs.append(output)
+				results += Command.MACRO_RESULTS['done']
+			except StopIteration as e:
+				logger.logSystem('Macro: {} step {} stopped early <{}>.'.format(name, number, e))
+				results += Command.MACRO_RESULTS['failed']
+				break
+			except Exception as e:
+				logger.logError('Macro: {} step {} failed.'.format(name, number), e)
+				results += Command.MACRO_RESULTS['failed']
+				break
+		results += Command.MACRO_RESULTS['skipped'] * (len(steps) - len(results))
+		if not silent:
+			data = '{} '.format(name).encode('ascii') + results + b' ' + output.encode('ascii', 'replace')
+			data = data[:Command.CMDPacket.data_size]
+			data += Command.CMDPacket.padding_byte * (Command.CMDPacket.data_size - len(data))
+			Command.CMDPacket(opcode='MACRO',data=data).send()
+
+	def runMacroStep(self, logger, step, params, outputs):
+		"""
+		Run one step of a macro.
+
+		Parameters:
+		logger - for logging
+		step - dict - the step from the macro file
+		params - list of str - the macro's parameters, for $N
+		outputs - list of str - the outputs of the steps before this one, for @N
+
+		Returns: the step's output as a str
+
+		Raises: StopIteration or any other exception if the step failed.
+		"""
+		def fill(text):
+			def value(match):
+				values = params if match.group(1) == '$' else outputs
+				index = int(match.group(2)) - 1
+				if index < 0 or index >= len(values):
+					raise ValueError('Macro: {} does not exist yet.'.format(match.group(0)))
+				return values[index]
+			return re.sub(r'([$@])(\d+)', value, str(text))
+
+		stepArgs = fill(step.get('args', ''))
+		if 'command' in step:
+			from qpaceInterpreter import COMMANDS, BATCH_EXCLUDED
+			command = step['command'].encode('ascii')
+			if command in BATCH_EXCLUDED or command not in COMMANDS:
+				raise ValueError('Macro: Unknown command <{}>.'.format(command))
+			stepArgs = stepArgs.encode('ascii')
+			stepArgs += Command.CMDPacket.padding_byte * (Command.BATCH_ARGS_LENGTH - len(stepArgs))
+			Command.local.held = []
+			try:
+				self.runRecord(logger,command,stepArgs)
+			finally:
+				held, Command.local.held = Command.local.held, None
+			output = ''
+			if held:
+				packet = held[0]
+				payload = packet.plainText if isinstance(packet, Command.PrivilegedPacket) else packet.packetData
+				output = (payload or b'').rstrip(Command.CMDPacket.padding_byte).decode('ascii', 'replace').replace(ROOTPATH, '')
+		elif 'task' in step:
+			import qpaceScheduler
+			runEvent = threading.Event()
+			runEvent.set()
+			task = [None, step['task']] + stepArgs.split(' ')
+			if not qpaceScheduler._processTask(self.chip,task,self.shutdownEvent,self.experimentEvent,runEvent,self.nextQueue,self.disableCallback,logger):
+				raise StopIteration('Task {} failed.'.format(step['task']))
+			output = ''
+		elif step.get('wait') == 'experiment':
+			thread = Command._experimentThread
+			while (thread is not None and thread.is_alive()) or (self.experimentEvent is not None and self.experimentEvent.is_set()):
+				self.macroWait(1)
+			output = ''
+		elif 'wait' in step:
+			self.macroWait(float(step['wait']))
+			output = ''
+		else:
+			raise ValueError('Macro: Step has no command, task or wait.')
+		return fill(step['output']) if 'output' in step else output
+
+	def macroWait(self, seconds):
+		"""Sleep between macro steps, or raise StopIteration if a shutdown is requested meanwhile."""
+		if self.shutdownEvent is None:
+			sleep(seconds)
+		elif self.shutdownEvent.wait(seconds):
+			raise StopIteration('Shutting down.')
+
+	def logLevel(self,logger,args, silent=False):
+		"""
+		Turn logging levels or subsystems on or off while running, and respond with what is off.
+
+		args are pairs of name and on/off separated by spaces, e.g. b'debug off Entered off Interpreter on'.
+		A name in qpaceLogger.Logger.LEVEL_NAMES is a level, anything else is a subsystem (the word before the
+		colon of a message). Errors can't be turned off. With no args nothing changes.
+		"""
+		words = args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii').split()
+		for name, state in zip(words[0::2], words[1::2]):
+			enabled = state.lower() == 'on'
+			if name.lower() in qpLog.Logger.LEVEL_NAMES:
+				if not qpLog.Logger.setLevel(name.lower(), enabled):
+					logger.logSystem('LogLevel: <{}> can not be turned off.'.format(name))
+			else:
+				qpLog.Logger.setSubsystem(name, enabled)
+		logger.logSystem('LogLevel: {}'.format(qpLog.Logger.describeLevels()))
+		if not silent:
+			data = qpLog.Logger.describeLevels().encode('ascii')[:Command.CMDPacket.data_size]
+			data += Command.CMDPacket.padding_byte * (Command.CMDPacket.data_size - len(data))
+			Command.CMDPacket(opcode='LOGLV',data=data).send()
+
+	def logQuery(self,logger,args, silent=False):
+		"""
+		Search the Pi's logs (archived ones included) and respond with only the matching records.
+
+		args are filters separated by spaces, each optional:
+			from=T to=T			time.time() range. A negative T is seconds before now (from=-600).
+			level=error,warning	names in qpaceLogger.Logger.LEVEL_NAMES
+			sub=Interpreter,...	subsystems (the word before the colon of a message)
+			max=N				LOGQR packets to send at most (QUERY_PACKETS)
+			text=...			substring of the message. Takes the rest of args, so it goes last.
+			re=...				regex searched for in the message. Also takes the rest of args.
+		e.g. b'from=-3600 level=error,warning text=Could not'
+
+		The matches, oldest first, are sent as '<time> <level> <message>' lines packed into LOGQR packets. Then one
+		LOGQD packet tells how many matched, how many were sent and how much of the logs had to be read. If the
+		packets fill up the query stops there and LOGQD holds the time of the last line sent, to carry on from.
+		Logs are indexed as they are written (see qpaceLogFormat.query), so only the parts that can match are read.
+
+		Raises: ValueError if a filter can't be parsed.
+		"""
+		text = args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii')
+		filters = {}
+		while text:
+			word, space, rest = text.partition(' ')
+			key, equals, value = word.partition('=')
+			if key in ('text', 're'):
+				filters[key] = text.partition('=')[2]
+				break
+			if not equals:
+				raise ValueError('Filter <{}> is not key=value'.format(word))
+			filters[key] = value
+			text = rest.strip()
+		now = time.time()
+		times = [float(filters[key]) if key in filters else None for key in ('from', 'to')]
+		start, end = [now + t if t is not None and t < 0 else t for t in times]
+		levels = None
+		if 'level' in filters:
+			levels = set(qpLog.Logger.LEVEL_NAMES[name.lower()] for name in filters['level'].split(','))
+		subsystems = set(filters['sub'].split(',')) if 'sub' in filters else None
+		pattern = re.compile(filters['re']) if 're' in filters else re.compile(re.escape(filters['text'])) if 'text' in filters else None
+		maxPackets = int(filters.get('max', Command.QUERY_PACKETS))
+
+		logger.flush() # So the index covers everything logged up to now
+		stats = {}
+		size = Command.CMDPacket.data_size
+		buffer = b''
+		sent = matched = 0
+		last = None
+		stopped = False
+		for path, record in qpaceLogFormat.query(qpLog.Logger.logFiles(), start, end, levels, subsystems, pattern, stats):
+			line = '{} {} {}\n'.format('-' if record['time'] is None else '{:.2f}'.format(record['time']),
+				(record['level'] or '-').strip(), record['message'][:Command.QUERY_LINE].replace('\n', ' ')).encode('ascii', 'replace')
+			if len(buffer) + len(line) > size * (maxPackets - sent):
+				stopped = True
+				break
+			matched += 1
+			last = record['time']
+			buffer += line
+			while len(buffer) >= size:
+				if not silent:
+					Command.CMDPacket(opcode='LOGQR',data=buffer[:size]).send()
+				buffer = buffer[size:]
+				sent += 1
+		if buffer:
+			if not silent:
+				Command.CMDPacket(opcode='LOGQR',data=buffer + Command.CMDPacket.padding_byte * (size - len(buffer))).send()
+			sent += 1
+		summary = 'Query: {} matched{} in {} packets. Read {} bytes ({} records) of {} logs.{}'.format(matched,
+			'+' if stopped else '', sent, stats['bytes'], stats['records'], stats['logs'],
+			' Stopped at {}'.format(last) if stopped else '')
+		logger.logSystem('LogQuery: <{}> {}'.format(args.rstrip(Command.CMDPacket.padding_byte), summary))
+		if not silent:
+			data = summary.encode('ascii')[:size]
+			Command.CMDPacket(opcode='LOGQD',data=data + Command.CMDPacket.padding_byte * (size - len(data))).send()
+
+	def telemetry(self,logger,args, silent=False):
+		"""
+		Respond with every metric in qpaceMetrics.registry packed into TELEM packets (see qpaceMetrics.pack). Most of
+		the time they fit in one. Also sent after the STATS packet by status.
+		"""
+		parts = qpaceMetrics.pack(qpaceMetrics.registry.snapshot(), time.time(), Command.CMDPacket.data_size)
+		logger.logSystem('Telemetry: Sending {} metrics in {} packets.'.format(len(qpaceMetrics.registry.metrics), len(parts)))
+		if not silent:
+			for data in parts:
+				Command.CMDPacket(opcode='TELEM',data=data).send()
+
+	def timeSeries(self,logger,args, silent=False):
+		"""
+		Respond with a range of the on-board telemetry history (see qpaceTimeSeries), downsampled to fit.
+
+		args are optional, separated by spaces:
+			from=T to=T			time.time() range. A negative T is seconds before now. Defaults to the last hour.
+			res=S				seconds a row at least. Defaults to the finest resolution that still holds all of from.
+			series=cpuPercent,...	names in qpaceTimeSeries.SERIES. Defaults to all of them.
+			max=N				TSDAT packets to send at most (SERIES_PACKETS)
+		e.g. b'from=-86400 series=tempC,cpuPercent max=4'
+
+		If the rows don't fit in max packets, adjacent rows are averaged until they do, so the response is always the
+		whole range at the best resolution the packets allow. Each TSDAT packet is qpaceTimeSeries.pack's format.
+
+		Raises: ValueError if an argument can't be parsed, KeyError for an unknown series.
+		"""
+		words = dict(word.partition('=')[::2] for word in args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii').split())
+		now = time.time()
+		times = [float(words.get(key, default)) for key, default in (('from', -3600), ('to', now))]
+		start, end = [now + t if t < 0 else t for t in times]
+		store = qpaceTimeSeries.shared()
+		series = words['series'].split(',') if 'series' in words else list(store.series)
+		if 'res' in words:
+			n = store.resolution(int(words['res']))
+		else:
+			n = next((i for i, (step, slots) in enumerate(store.resolutions) if step * slots >= now - start), len(store.resolutions) - 1)
+		step, first, rows = store.query(n, start, end, series)
+		maxPackets = int(words.get('max', Command.SERIES_PACKETS))
+		size = Command.CMDPacket.data_size
+		perPacket = max((size - qpaceTimeSeries.RANGE_HEADER.size) // (2 * len(series)), 1)
+		factor = max(ceil(len(rows) / (perPacket * maxPackets)), 1)
+		if factor > 1:
+			rows = qpaceTimeSeries.downsample(rows, factor)
+			step *= factor
+		mask = sum(1 << store.series.index(name) for name in series)
+		parts = qpaceTimeSeries.pack(step, first, rows, mask, size)
+		logger.logSystem('TimeSeries: Sending {} rows of {}s from {} ({} series) in {} packets.'.format(len(rows), step, first, len(series), len(parts)))
+		if not silent:
+			for data in parts:
+				Command.CMDPacket(opcode='TSDAT',data=data).send()
+
+	def trace(self,logger,args, silent=False):
+		"""
+		Control the span tracer (see qpaceTracer) and respond with a TRACE packet saying what it holds.
+
+		args are words separated by spaces, done in order:
+			on [size=N]	start tracing. size is the spans kept per thread, for threads that start recording after a clear.
+			off			stop tracing. What was traced is kept.
+			clear		drop everything traced.
+			dump		write what was traced as gzip'd Chrome trace JSON to qpaceTracer.TRACE_PATH. TRACE then starts with
+						'dr <path>', the path relative to ROOTPATH as dr takes it, so it is never cut off. Open the
+						file in ui.perfetto.dev.
+		e.g. b'clear on size=8192', later b'off dump'. With no args nothing changes.
+
+		Raises: ValueError if an argument can't be parsed, OSError if the dump can't be written.
+		"""
+		words = args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii').split()
+		options = dict(word.partition('=')[::2] for word in words if '=' in word)
+		dumped = ''
+		for word in words:
+			word = word.lower()
+			if word == 'on':
+				qpaceTracer.Tracer.enable(True, int(options['size']) if 'size' in options else None)
+			elif word == 'off':
+				qpaceTracer.Tracer.enable(False)
+			elif word == 'clear':
+				qpaceTracer.Tracer.clear()
+			elif word == 'dump':
+				path, size = qpaceTracer.Tracer.export()
+				dumped = 'dr {} ({} bytes). '.format(path[len(ROOTPATH):] if path.startswith(ROOTPATH) else path, size)
+		summary = dumped + qpaceTracer.Tracer.format(qpaceTracer.Tracer.snapshot())
+		logger.logSystem('Trace: <{}> {}'.format(' '.join(words), summary))
+		if not silent:
+			data = summary.encode('ascii')[:Command.CMDPacket.data_size]
+			Command.CMDPacket(opcode='TRACE',data=data + Command.CMDPacket.padding_byte * (Command.CMDPacket.data_size - len(data))).send()
+
+	def logTailSend(self,logger,args, silent=False):
+		"""
+		Send the part of the current log after the offset ground acknowledged, compressed. See LogTail.
+
+		args are optional, separated by spaces: max=N for the LOGTL packets to use at most (LogTail.TAIL_PACKETS, up to
+		LogTail.MAX_PACKETS)
+		and fill=on/off to start or stop sending tails in the background when the link is idle.
+		"""
+		words = dict(word.partition('=')[::2] for word in args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii').split())
+		if 'fill' in words:
+			Command._logTail.fill = words['fill'].lower() == 'on'
+		logger.flush() # So the tail has everything logged up to now
+		packets = Command._logTail.tail(int(words.get('max', LogTail.TAIL_PACKETS)))
+		start, end, length, count, flags = LogTail.HEADER.unpack_from(packets[0].packetData)
+		logger.logSystem('LogTail: Sending {} to {} in {} packets (fill {}).'.format(start, end, count, 'on' if Command._logTail.fill else 'off'))
+		if not silent:
+			for packet in packets:
+				packet.send()
+
+	def logTailAck(self,logger,args, silent=False):
+		"""
+		Ground acknowledges it has a log up to an offset: args are the name from the LOGTH packet and the end offset,
+		separated by a space. Responds with LOGTA holding the name, the offset and whether it was known.
+		"""
+		name, offset = args.replace(Command.CMDPacket.padding_byte, b'').decode('ascii').split()
+		known = Command._logTail.acknowledge(name, int(offset))
+		logger.logSystem('LogTail: Ground has {} up to {}{}.'.format(name, offset, '' if known else ' (not tailed)'))
+		if not silent:
+			data = '{} {} {}'.format(name, offset, 'ok' if known else 'unknown').encode('ascii')[:Command.CMDPacket.data_size]
+			Command.CMDPacket(opcode='LOGTA',data=data + Command.CMDPacket.padding_byte * (Command.CMDPacket.data_size - len(data))).send()
+
 	def immediateShutdown(self,logger,args, silent=False):
 		"""
 		Initiate the shutdown proceedure on the pi and then shut it down. Will send a status to the WTC
@@ -802,6 +1754,25 @@ class Command():
 						"Disk free: {}\n"
 		text_to_write = text_to_write.format(identity,boot,last_command,last_command_when,last_command_from,commands_executed,cpu,cpu_temp,
 								uptime,ram_tot,ram_used,ram_free,disk_total,disk_free)
+		try:
+			import SC16IS750
+			text_to_write += SC16IS750.BusStats.format(Command._chip.snapshot()) + '\n'
+		except Exception as err:
+			logger.logError("There was a problem getting the bus statistics", err)
+		try:
+			import qpaceInterpreter
+			text_to_write += qpaceInterpreter.PacketBuffer.format(qpaceInterpreter.packetBuffer.snapshot()) + '\n'
+			text_to_write += qpaceInterpreter.ProtocolState.format(qpaceInterpreter.protocol.snapshot()) + '\n'
+			import qpaceExecutor
+			text_to_write += qpaceExecutor.CommandExecutor.format(Command._executor.snapshot()) + '\n'
+			text_to_write += 'Replay cache: {entries} entries, {hits} replays, {misses} runs\n'.format(**Command._replayCache.snapshot())
+			text_to_write += ResponseAggregator.format(Command._aggregator.snapshot()) + '\n'
+			text_to_write += LogTail.format(Command._logTail.snapshot()) + '\n'
+			text_to_write += qpaceMetrics.Registry.format(qpaceMetrics.registry.snapshot()) + '\n'
+			text_to_write += qpaceTracer.Tracer.format(qpaceTracer.Tracer.snapshot()) + '\n'
+			text_to_write += 'Logging: {}\n'.format(qpLog.Logger.describeLevels())
+		except Exception as err:
+			logger.logError("There was a problem getting the interpreter statistics", err)
 		text_to_write += ps_data
 
 		timestamp = str(timestamp).replace(' ', '_')
@@ -17,6 +17,8 @@ import threading
 import qpaceLogger as qpLog
 import qpaceExperimentParser as exp
 import qpacePiCommands as cmd
+import qpaceMetrics
+import qpaceTracer
 from qpaceControl import QPCONTROL
 
 Schedule_PATH = "/home/pi/data/text/"
@@ -26,6 +28,10 @@ GRAVEYARD_PATH = '/home/pi/graveyard/'
 ABORT_DELTA = 450 # SECONDS
 Schedule_FILE_PATH = Schedule_PATH + Schedule_FILE
 
+tasksRun = qpaceMetrics.counter('scheduler.tasksRun')
+tasksDropped = qpaceMetrics.counter('scheduler.tasksDropped') # Too late or malformed
+lateS = qpaceMetrics.histogram('scheduler.lateS', qpaceMetrics.SECONDS) # How long after its time a task started
+
 WTC_IRQ = 7
 
 def getScheduleList(logger):
@@ -233,12 +239,15 @@ def executeScheduleList(chip,nextQueue,schedule_list, shutdownEvent, experimentE
 				wait_time = wait_time
 		except TimeoutError:
 			logger.logSystem('Scheduler: The timeDelta for {} is passed so it will not be run <{}>.'.format(schedule_list[0][1],schedule_list[0]))
+			tasksDropped.inc()
 			schedule_list.pop(0) # If we can't run it, then remove it from the list.
 		except SyntaxError:
 			logger.logSystem('Scheduler: The task is formatted incorrectly. Removing the task. {}'.format(str(schedule_list[0])))
+			tasksDropped.inc()
 			schedule_list.pop(0)
 		except Exception as e:
 			logger.logSystem('Scheduler: There is a problem executing {}. It will be removed from the list. Exception: {}'.format(str(schedule_list[0][1]),str(e)))
+			tasksDropped.inc()
 			schedule_list.pop(0) # If there is a problem determining when to execute, remove it from the list
 		else:
 			# Wait until it's time to run our next task. If the time has already passed wait a second and then do it.
@@ -251,7 +260,10 @@ def executeScheduleList(chip,nextQueue,schedule_list, shutdownEvent, experimentE
 				time.sleep(sleep_time)
 			runEvent.wait() # Pause if we need to wait for something.
 			# run the next item on the Schedulelist.
-			taskCompleted = _processTask(chip,schedule_list[0],shutdownEvent,experimentEvent,runEvent,nextQueue,disableCallback,logger)
+			lateS.observe(max(0, (datetime.now() - schedule_list[0][0]).total_seconds()))
+			tasksRun.inc()
+			with qpaceTracer.span('task {}'.format(schedule_list[0][1]), 'scheduler'):
+				taskCompleted = _processTask(chip,schedule_list[0],shutdownEvent,experimentEvent,runEvent,nextQueue,disableCallback,logger)
 			if taskCompleted:
 				logger.logSystem("Scheduler: Task completed.")
 				schedule_list.pop(0) # pop the first item off the list.
@@ -41,7 +41,7 @@ class TagChecker:
 		#initTags()
 		random.seed()
 
-	def initTags(self, filename = DEFAULT_FILEPATH):
+	def initTags(self, filename = None):
 		"""
 		Reads tags from a file, as indicated by filename, for use in this class.
 		Throws an error if the filename does not have a sufficient number of tags
@@ -58,6 +58,8 @@ class TagChecker:
 
 		"""
 		tf = ""
+		if filename is None:
+			filename = TagChecker.DEFAULT_FILEPATH
 		if TagChecker.LOCK_CALLS >= TagChecker.MINIMUM_TAGS:
 			raise ValueError('LOCK_CALLS cannot be greater than MINIMUM_TAGS.')
 		if not os.path.isfile(filename):
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# qpaceTimeSeries.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# A fixed-size, round-robin store of telemetry history kept in one mmap'd file, and the collector thread
+# that fills it. Every sample goes into each resolution in RESOLUTIONS: a slot covers step seconds and
+# holds the mean of the samples that fell in it, so the 10 s ring has the last hour, the 5 min ring
+# the last day and the 1 h ring the last month, without anything ever being rewritten or compacted.
+#
+# File layout: HEADER, a RESOLUTION entry for each resolution, then each resolution's slots. A slot is
+# SLOT (start time, samples) followed by a float32 mean per series and a uint16 count of the samples each
+# mean is over, since a series can be missing from some samples. A slot whose start time isn't the one its
+# index stands for is stale (or empty) and reads as missing.
+
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import qpaceMetrics
+
+STORE_PATH = '/home/pi/data/misc/timeseries.qts'
+MAGIC = b'QTS2'
+RESOLUTIONS = ((10, 360), (300, 288), (3600, 720)) # (seconds a slot, slots): an hour, a day and a month
+# What is kept, in the order it is stored. A series' bit in a TSDAT packet's mask is its index here.
+SERIES = ('cpuPercent', 'tempC', 'ramUsedMB', 'diskFreeMB', 'packetQueue', 'nextQueue', 'packetsIn', 'packetsOut',
+		  'dummyPercent', 'corruptPackets', 'handshakeMs', 'logErrors')
+COLLECT_INTERVAL = 10 # seconds
+
+HEADER = struct.Struct('>4sBB') # MAGIC, series, resolutions
+RESOLUTION = struct.Struct('>II') # seconds a slot, slots
+SLOT = struct.Struct('>IH') # start time, samples
+RANGE_HEADER = struct.Struct('>IIHH') # seconds a row, time of the first row, rows, series mask
+
+_sharedLock = threading.Lock()
+_shared = None
+
+class TimeSeriesStore():
+	"""
+	The store. Safe to use from several threads.
+
+	If the file is missing, or was made for other series or resolutions, it is made again (empty).
+	"""
+	def __init__(self, path = STORE_PATH, series = SERIES, resolutions = RESOLUTIONS):
+		self.path = path
+		self.series = tuple(series)
+		self.resolutions = tuple(resolutions)
+		self.lock = threading.Lock()
+		self.value = struct.Struct('>{}f'.format(len(self.series)))
+		self.counts = struct.Struct('>{}H'.format(len(self.series)))
+		self.slotSize = SLOT.size + self.value.size + self.counts.size
+		header = HEADER.pack(MAGIC, len(self.series), len(self.resolutions))
+		header += b''.join(RESOLUTION.pack(step, slots) for step, slots in self.resolutions)
+		self.offsets = []
+		offset = len(header)
+		for step, slots in self.resolutions:
+			self.offsets.append(offset)
+			offset += slots * self.slotSize
+		size = offset
+		try:
+			with open(path, 'rb') as storeFile:
+				fresh = storeFile.read(len(header)) != header or os.path.getsize(path) != size
+		except OSError:
+			fresh = True
+		if fresh:
+			with open(path, 'wb') as storeFile:
+				storeFile.write(header)
+				storeFile.truncate(size)
+		self.file = open(path, 'r+b')
+		self.map = mmap.mmap(self.file.fileno(), size)
+
+	def _slot(self, n, when):
+		"""The slot start time for when in resolution n, and where that slot is in the file."""
+		step, slots = self.resolutions[n]
+		start = int(when) // step * step
+		return start, self.offsets[n] + (start // step % slots) * self.slotSize
+
+	def record(self, when, values):
+		"""
+		Add a sample to every resolution.
+
+		Parameters:
+		when - float - time.time() of the sample
+		values - dict - series name: value. Missing series, None or NaN leave the slot's mean as it was.
+
+		Returns: None
+
+		Raises: None
+		"""
+		sample = [values.get(name) for name in self.series]
+		with self.lock:
+			for n in range(len(self.resolutions)):
+				start, offset = self._slot(n, when)
+				slotStart, samples = SLOT.unpack_from(self.map, offset)
+				if slotStart != start:
+					samples = 0
+					means = [math.nan] * len(self.series)
+					counts = [0] * len(self.series)
+				else:
+					means = list(self.value.unpack_from(self.map, offset + SLOT.size))
+					counts = list(self.counts.unpack_from(self.map, offset + SLOT.size + self.value.size))
+				samples = min(samples + 1, 0xFFFF)
+				for i, value in enumerate(sample):
+					if value is None or value != value:
+						continue
+					counts[i] = min(counts[i] + 1, 0xFFFF)
+					means[i] = value if counts[i] == 1 else means[i] + (value - means[i]) / counts[i]
+				SLOT.pack_into(self.map, offset, start, samples)
+				self.value.pack_into(self.map, offset + SLOT.size, *means)
+				self.counts.pack_into(self.map, offset + SLOT.size + self.value.size, *counts)
+
+	def resolution(self, step):
+		"""The index of the finest resolution with slots of at least step seconds (the coarsest if none are)."""
+		for n, (seconds, slots) in enumerate(self.resolutions):
+			if seconds >= step:
+				return n
+		return len(self.resolutions) - 1
+
+	def query(self, n, start, end, series = None):
+		"""
+		Read a range of resolution n.
+
+		Parameters:
+		n - int - index into the resolutions
+		start, end - float - time.time() range. It is cut to what the ring still holds.
+		series - list of str - the series to read, all of them if None
+
+		Returns: (seconds a row, time of the first row, rows) where a row is a list of floats in the order of series,
+		NaN where nothing was recorded.
+
+		Raises: KeyError for an unknown series.
+		"""
+		step, slots = self.resolutions[n]
+		columns = [self.series.index(name) for name in (series or self.series)]
+		now = time.time()
+		end = int(min(end, now)) // step * step
+		start = max(int(start) // step * step, end - (slots - 1) * step)
+		rows = []
+		with self.lock:
+			for when in range(start, end + 1, step):
+				slotStart, offset = self._slot(n, when)
+				if SLOT.unpack_from(self.map, offset)[0] == slotStart:
+					means = self.value.unpack_from(self.map, offset + SLOT.size)
+					rows.append([means[i] for i in columns])
+				else:
+					rows.append([math.nan] * len(columns))
+		return step, start, rows
+
+	def flush(self):
+		with self.lock:
+			self.map.flush()
+
+	def close(self):
+		with self.lock:
+			self.map.flush()
+			self.map.close()
+			self.file.close()
+
+def shared():
+	"""The store at STORE_PATH, opened the first time it is asked for. The collector and the ts command share it."""
+	global _shared
+	with _sharedLock:
+		if _shared is None:
+			_shared = TimeSeriesStore(STORE_PATH)
+		return _shared
+
+def downsample(rows, factor):
+	"""Average each factor rows into one, leaving out NaN."""
+	out = []
+	for i in range(0, len(rows), factor):
+		group = rows[i:i + factor]
+		row = []
+		for column in zip(*group):
+			known = [value for value in column if value == value]
+			row.append(sum(known) / len(known) if known else math.nan)
+		out.append(row)
+	return out
+
+def pack(step, start, rows, mask, size):
+	"""
+	Split rows into TSDAT packet data: RANGE_HEADER, then each row's values as float16 (NaN where missing), padded
+	with 0x04. Each packet's header has the time of its own first row.
+
+	Parameters:
+	step, start, rows - from TimeSeriesStore.query() (or downsampled)
+	mask - int - the bits of the series in the rows
+	size - int - bytes of data in a packet
+
+	Returns: list of bytes
+
+	Raises: None
+	"""
+	width = 2 * max(len(rows[0]) if rows else 1, 1)
+	perPacket = max((size - RANGE_HEADER.size) // width, 1)
+	parts = []
+	for i in range(0, max(len(rows), 1), perPacket):
+		chunk = rows[i:i + perPacket]
+		data = RANGE_HEADER.pack(step, start + i * step, len(chunk), mask)
+		for row in chunk:
+			for value in row:
+				try:
+					data += struct.pack('>e', value)
+				except (OverflowError, struct.error):
+					data += struct.pack('>e', math.copysign(65504, value))
+		parts.append(data + b'\x04' * (size - len(data)))
+	return parts
+
+def unpack(data, series = SERIES):
+	"""
+	Decode one TSDAT packet's data.
+
+	Returns: (seconds a row, time of the first row, names of the series, rows)
+	"""
+	step, start, count, mask = RANGE_HEADER.unpack_from(data)
+	names = [name for i, name in enumerate(series) if mask & 1 << i]
+	values = struct.unpack_from('>{}e'.format(count * len(names)), data, RANGE_HEADER.size)
+	return step, start, names, [list(values[i:i + len(names)]) for i in range(0, len(values), len(names) or 1)]
+
+class Collector():
+	"""
+	Samples the Pi and the link every COLLECT_INTERVAL seconds into a TimeSeriesStore. The Pi's numbers come from
+	/proc and /sys, the link's from qpaceMetrics. Counters are stored as the change since the last sample.
+	"""
+	def __init__(self, store, interval = None):
+		self.store = store
+		self.interval = interval or COLLECT_INTERVAL
+		self.lastCpu = None
+		self.lastCounts = {}
+		self.samples = 0
+
+	def _cpu(self):
+		with open('/proc/stat', 'r') as stat:
+			fields = [int(n) for n in stat.readline().split()[1:]]
+		idle, total = fields[3] + fields[4], sum(fields)
+		last, self.lastCpu = self.lastCpu, (idle, total)
+		if last is None or total == last[1]:
+			return None
+		return 100 * (1 - (idle - last[0]) / (total - last[1]))
+
+	@staticmethod
+	def _ramUsedMB():
+		info = {}
+		with open('/proc/meminfo', 'r') as meminfo:
+			for line in meminfo:
+				name, value = line.split(':', 1)
+				info[name] = int(value.split()[0])
+		return (info['MemTotal'] - info.get('MemAvailable', info['MemFree'])) / 1024
+
+	@staticmethod
+	def _tempC():
+		with open('/sys/class/thermal/thermal_zone0/temp', 'r') as temp:
+			return int(temp.read()) / 1000
+
+	def _change(self, name, value):
+		"""How much a counter moved since the last sample. None the first time."""
+		last, self.lastCounts[name] = self.lastCounts.get(name), value
+		return None if last is None else value - last
+
+	def sample(self):
+		"""
+		Returns: dict of series name: value. A series that can't be read is left out.
+		"""
+		values = {}
+		readers = {
+			'cpuPercent': self._cpu,
+			'tempC': Collector._tempC,
+			'ramUsedMB': Collector._ramUsedMB,
+			'diskFreeMB': lambda: os.statvfs('/').f_frsize * os.statvfs('/').f_bavail / 1048576
+		}
+		for name, reader in readers.items():
+			try:
+				values[name] = reader()
+			except (OSError, ValueError, KeyError, IndexError):
+				pass
+		metrics = qpaceMetrics.registry.snapshot()
+		def metric(name):
+			return metrics[name][1] if name in metrics else None
+		values['packetQueue'] = metric('queue.PacketQueue.depth')
+		values['nextQueue'] = metric('queue.NextQueue.depth')
+		values['logErrors'] = metric('logger.errors')
+		changes = {}
+		for name in ('interpreter.packetsIn', 'interpreter.packetsOut', 'interpreter.dummyPackets', 'interpreter.corruptPackets'):
+			if metric(name) is not None:
+				changes[name] = self._change(name, metric(name))
+		values['packetsIn'] = changes.get('interpreter.packetsIn')
+		values['packetsOut'] = changes.get('interpreter.packetsOut')
+		values['corruptPackets'] = changes.get('interpreter.corruptPackets')
+		if changes.get('interpreter.packetsOut'):
+			values['dummyPercent'] = 100 * changes['interpreter.dummyPackets'] / changes['interpreter.packetsOut']
+		handshake = metric('interpreter.handshakeMs')
+		if handshake is not None:
+			count = self._change('handshakeCount', handshake['count'])
+			total = self._change('handshakeSum', handshake['sum'])
+			if count:
+				values['handshakeMs'] = total / count
+		return values
+
+	def run(self, shutdownEvent, logger):
+		"""
+		Thread target. Samples until shutdownEvent is set, then flushes the store.
+
+		Parameters:
+		shutdownEvent - threading.Event - set to stop
+		logger - qpaceLogger.Logger - for logging
+
+		Returns: None
+
+		Raises: None
+		"""
+		logger.logSystem('Collector: Starting. A sample every {}s into {}'.format(self.interval, self.store.path))
+		try:
+			while not shutdownEvent.is_set():
+				try:
+					self.store.record(time.time(), self.sample())
+					self.samples += 1
+				except Exception as e:
+					logger.logError('Collector: Could not take a sample.', e)
+				shutdownEvent.wait(self.interval)
+		finally:
+			self.store.flush()
+			logger.logSystem('Collector: Stopped after {} samples.'.format(self.samples))
+
+if __name__ == '__main__':
+	import sys
+	# Print what a TSDAT packet's data (as hex) holds.
+	for arg in sys.argv[1:]:
+		step, start, names, rows = unpack(bytes.fromhex(arg))
+		print('time ' + ' '.join(names))
+		for i, row in enumerate(rows):
+			print('{} {}'.format(start + i * step, ' '.join('{:g}'.format(value) for value in row)))
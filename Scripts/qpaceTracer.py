@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# qpaceTracer.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# A span tracer for finding where the time goes between an IRQ and the response being queued, and inside
+# the scheduler and experiments. Spans are timed with the monotonic clock in nanoseconds and kept in a
+# ring per thread, so tracing takes no lock and a busy thread only pushes out its own oldest spans.
+# It is off until the tr command turns it on, and while it is off a span costs one attribute check.
+#
+#	with qpaceTracer.span('decodePacket', 'interpreter'):
+#		...
+#	@qpaceTracer.traced('Scheduler.task', 'scheduler')
+#	def task(...):
+#
+# export() writes the rings as Chrome trace JSON (gzip'd), which ui.perfetto.dev and chrome://tracing open.
+
+import functools
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+
+TRACE_PATH = '/home/pi/data/misc/'
+RING_SIZE = 4096 # Spans kept per thread
+MAX_THREADS = 32 # Rings kept. The oldest thread's ring goes first.
+
+# time.monotonic_ns is new in Python 3.7
+monotonicNs = getattr(time, 'monotonic_ns', None) or (lambda: int(time.monotonic() * 1e9))
+
+COMPLETE = 'X'
+INSTANT = 'i'
+
+class Span():
+	"""One timed span. Used through Tracer.span() as a context manager. set() adds args shown in the viewer."""
+	__slots__ = ('name', 'category', 'start', 'args')
+
+	def __init__(self, name, category):
+		self.name = name
+		self.category = category
+		self.args = None
+
+	def set(self, **args):
+		if self.args is None:
+			self.args = {}
+		self.args.update(args)
+
+	def __enter__(self):
+		self.start = monotonicNs()
+		return self
+
+	def __exit__(self, exceptionType, exception, tb):
+		end = monotonicNs()
+		if exceptionType is not None:
+			self.set(error = exceptionType.__name__)
+		Tracer.record(COMPLETE, self.name, self.category, self.start, end - self.start, self.args)
+		return False
+
+class NoSpan():
+	"""What Tracer.span() gives while tracing is off. Does nothing."""
+	__slots__ = ()
+
+	def set(self, **args):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exceptionType, exception, tb):
+		return False
+
+NO_SPAN = NoSpan()
+
+class Steps():
+	"""
+	Spans for a run of steps where each ends when the next begins, e.g. the instructions of an experiment, for
+	loops too long to wrap in a with. Call close() (in a finally) after the last one.
+	"""
+	def __init__(self, category = 'qpace'):
+		self.category = category
+		self.current = NO_SPAN
+
+	def next(self, name, **args):
+		self.close()
+		self.current = Tracer.span(name, self.category).__enter__()
+		if args:
+			self.current.set(**args)
+
+	def close(self):
+		self.current.__exit__(None, None, None)
+		self.current = NO_SPAN
+
+class Tracer():
+	"""
+	The tracer's state. Shared by every thread, so it is all kept on the class.
+	"""
+	enabled = False
+	ringSize = RING_SIZE
+	origin = (monotonicNs(), time.time()) # Trace timestamps count from here
+	lock = threading.Lock()
+	rings = deque(maxlen = MAX_THREADS) # (thread id, thread name, deque of events)
+	local = threading.local()
+	dropped = 0 # Spans pushed out of full rings since the last clear
+
+	@staticmethod
+	def enable(enabled, ringSize = None):
+		"""Turn tracing on or off. A new ringSize applies to rings made after the next clear()."""
+		if ringSize:
+			Tracer.ringSize = ringSize
+		if enabled and not Tracer.enabled and not Tracer.events():
+			Tracer.origin = (monotonicNs(), time.time())
+		Tracer.enabled = enabled
+
+	@staticmethod
+	def clear():
+		"""Drop every span. Threads get a new ring the next time they record."""
+		with Tracer.lock:
+			Tracer.rings = deque(maxlen = MAX_THREADS)
+			Tracer.local = threading.local()
+			Tracer.dropped = 0
+			Tracer.origin = (monotonicNs(), time.time())
+
+	@staticmethod
+	def _ring():
+		ring = getattr(Tracer.local, 'ring', None)
+		if ring is None:
+			ring = Tracer.local.ring = deque(maxlen = Tracer.ringSize)
+			thread = threading.current_thread()
+			with Tracer.lock:
+				Tracer.rings.append((thread.ident, thread.name, ring))
+		return ring
+
+	@staticmethod
+	def record(phase, name, category, start, duration, args = None):
+		"""Add an event to this thread's ring. start and duration are monotonicNs() nanoseconds."""
+		if not Tracer.enabled:
+			return
+		ring = Tracer._ring()
+		if len(ring) == ring.maxlen:
+			Tracer.dropped += 1
+		ring.append((phase, name, category, start, duration, args))
+
+	@staticmethod
+	def span(name, category = 'qpace'):
+		"""
+		A context manager timing its block.
+
+		Parameters:
+		name - str - what the viewer labels the span
+		category - str - a group the viewer can filter on, e.g. the module
+
+		Returns: Span, or NO_SPAN while tracing is off
+
+		Raises: None
+		"""
+		return Span(name, category) if Tracer.enabled else NO_SPAN
+
+	@staticmethod
+	def instant(name, category = 'qpace', **args):
+		"""Mark a moment, e.g. an IRQ edge."""
+		if Tracer.enabled:
+			Tracer.record(INSTANT, name, category, monotonicNs(), 0, args or None)
+
+	@staticmethod
+	def traced(name = None, category = 'qpace'):
+		"""
+		Decorator timing every call of a function. name defaults to the function's qualified name.
+		"""
+		def decorate(function):
+			label = name or function.__qualname__
+			@functools.wraps(function)
+			def wrapper(*args, **kwargs):
+				if not Tracer.enabled:
+					return function(*args, **kwargs)
+				with Span(label, category):
+					return function(*args, **kwargs)
+			return wrapper
+		return decorate
+
+	@staticmethod
+	def events():
+		"""Returns: the number of spans held across every ring."""
+		with Tracer.lock:
+			return sum(len(ring) for ident, threadName, ring in Tracer.rings)
+
+	@staticmethod
+	def chromeTrace():
+		"""
+		Returns: the rings as a Chrome trace (a dict ready for json). Timestamps are microseconds from Tracer.origin,
+		whose wall clock time is in otherData.
+		"""
+		pid = os.getpid()
+		base, wallClock = Tracer.origin
+		with Tracer.lock:
+			rings = [(ident, threadName, list(ring)) for ident, threadName, ring in Tracer.rings]
+		traceEvents = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'qpace'}}]
+		for ident, threadName, events in rings:
+			traceEvents.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ident, 'args': {'name': threadName}})
+			for phase, name, category, start, duration, args in events:
+				event = {'name': name, 'cat': category, 'ph': phase, 'pid': pid, 'tid': ident, 'ts': (start - base) / 1000}
+				if phase == COMPLETE:
+					event['dur'] = duration / 1000
+				else:
+					event['s'] = 't'
+				if args:
+					event['args'] = args
+				traceEvents.append(event)
+		return {'traceEvents': traceEvents, 'displayTimeUnit': 'ms',
+				'otherData': {'origin': wallClock, 'dropped': Tracer.dropped}}
+
+	@staticmethod
+	def export(path = None):
+		"""
+		Write the Chrome trace gzip'd, to be downlinked.
+
+		Parameters: path - str - where to write it. Defaults to TRACE_PATH + trace-<time>.json.gz
+
+		Returns: (path, bytes written)
+
+		Raises: OSError if it can't be written.
+		"""
+		path = path or TRACE_PATH + time.strftime('trace-%Y%m%d-%H%M%S.json.gz', time.gmtime())
+		with gzip.open(path, 'wt') as traceFile:
+			json.dump(Tracer.chromeTrace(), traceFile, separators = (',', ':'))
+		return path, os.path.getsize(path)
+
+	@staticmethod
+	def snapshot():
+		with Tracer.lock:
+			threads = len(Tracer.rings)
+		return {'enabled': Tracer.enabled, 'events': Tracer.events(), 'threads': threads, 'dropped': Tracer.dropped,
+				'ringSize': Tracer.ringSize}
+
+	@staticmethod
+	def format(snapshot):
+		return 'Tracer: {} {} spans in {} threads ({} dropped, {} a thread)'.format('on' if snapshot['enabled'] else 'off',
+			snapshot['events'], snapshot['threads'], snapshot['dropped'], snapshot['ringSize'])
+
+span = Tracer.span
+instant = Tracer.instant
+traced = Tracer.traced